@@ -1,5 +1,7 @@
 # to run model training type 'pyb train_<task>' replacing <task> with the model name
 # to test all the models type 'pyb run_unit_tests'
+# to benchmark a model on synthetic data type 'pyb benchmark_<task>'
+# to export a trained model for inference only type 'pyb export_<task>'
 
 from pybuilder.core import use_plugin, init, task
 import os
@@ -70,6 +72,53 @@ def train_paraphraser(project):
     return metrics
 
 
+@task
+def distill_paraphraser(project):
+    # e.g. DISTILL_ARGS='--hidden_dim 100 --unlabeled_pairs_file ./build/paraphraser/unlabeled.tsv'
+    from deeppavlov.utils.benchmark import predict_overhead, paraphraser_input, save_results
+    teachers = ['./build/paraphraser/paraphraser_{}'.format(i) for i in range(5)]
+    student = './build/paraphraser/paraphraser_student'
+    common = ['-t', 'deeppavlov.tasks.paraphrases.agents',
+              '--batchsize', '256',
+              '--fasttext_embeddings_dict', './build/paraphraser/paraphraser.emb',
+              '--fasttext_model', './build/paraphraser/ft_0.8.3_nltk_yalen_sg_300.bin',
+              '--bagging-folds-number', '5']
+    bu.model(common + ['-m', 'deeppavlov.agents.paraphraser.paraphraser:ParaphraserAgent',
+                       '-mf', student,
+                       '--datatype', 'train:ordered',
+                       '--display-examples', 'False',
+                       '--num-epochs', '-1',
+                       '--log-every-n-secs', '-1',
+                       '--log-every-n-epochs', '1',
+                       '--learning_rate', '0.0001',
+                       '--hidden_dim', '200',
+                       '--validation-every-n-epochs', '5',
+                       '--teacher-random-seed', '50',
+                       '--bagging-fold-index', '0',
+                       '--validation-patience', '3',
+                       '--chosen-metrics', 'f1',
+                       '--teacher_model_files'] + teachers + os.getenv('DISTILL_ARGS', default='').split())
+
+    # F1 and latency of the student and the fold ensemble on the test set
+    results = {}
+    for name, args in [('ensemble', ['-m', 'deeppavlov.agents.paraphraser.paraphraser:EnsembleParaphraserAgent',
+                                     '--model_files', './build/paraphraser/paraphraser']),
+                       ('student', ['-m', 'deeppavlov.agents.paraphraser.paraphraser:ParaphraserAgent',
+                                    '--pretrained_model', student])]:
+        args = common + ['--datatype', 'test'] + args
+        metrics = bu.model(args)
+        opt = bu.arg_parse(args)
+        if opt.get('model_files'):
+            opt['model_files'] = teachers
+        results[name] = {'f1': float(metrics['f1']), 'latency': predict_overhead(opt, paraphraser_input)}
+    print('[ distillation: ensemble f1 {:.4f} {:.1f}us/ex, student f1 {:.4f} {:.1f}us/ex ]'.format(
+        results['ensemble']['f1'], 1e6 * results['ensemble']['latency']['predict'],
+        results['student']['f1'], 1e6 * results['student']['latency']['predict']))
+    create_dir('benchmarks')
+    save_results('distillation', results, './build/benchmarks')
+    return results
+
+
 @task
 def train_ner(project):
     create_dir('ner')
@@ -77,6 +126,7 @@ def train_ner(project):
                         '-m', 'deeppavlov.agents.ner.ner:NERAgent',
                         '-mf', './build/ner/ner',
                         '-dt', 'train:ordered',
+                        '--dict-build-workers', '4',
                         '--learning_rate', '0.01',
                         '--batchsize', '2',
                         '--display-examples', 'False',
@@ -127,6 +177,7 @@ def train_squad(project):
     metrics = bu.model(['-t', 'squad',
                         '-m', 'deeppavlov.agents.squad.squad:SquadAgent',
                         '--batchsize', '64',
+                        '--dict-build-workers', '4',
                         '--display-examples', 'False',
                         '--num-epochs', '-1',
                         '--log-every-n-secs', '60',
@@ -217,3 +268,254 @@ def train_coreference_scorer_model(project):
                         '--embeddings_path', './build/coref/fasttext_embdgs.bin'
                         ])
     return metrics
+
+
+@task
+def export_paraphraser(project):
+    for i in range(5):
+        bu.export(['-t', 'deeppavlov.tasks.paraphrases.agents',
+                   '-m', 'deeppavlov.agents.paraphraser.paraphraser:ParaphraserAgent',
+                   '--pretrained_model', './build/paraphraser/paraphraser_{}'.format(i),
+                   '--datatype', 'test',
+                   '--fasttext_embeddings_dict', './build/paraphraser/paraphraser.emb',
+                   '--fasttext_model', './build/paraphraser/ft_0.8.3_nltk_yalen_sg_300.bin'
+                   ])
+
+
+@task
+def export_ner(project):
+    bu.export(['-t', 'deeppavlov.tasks.ner.agents',
+               '-m', 'deeppavlov.agents.ner.ner:NERAgent',
+               '-mf', './build/ner/ner',
+               '-dt', 'test'
+               ])
+
+
+@task
+def export_insults(project):
+    for i in range(3):
+        bu.export(['-t', 'deeppavlov.tasks.insults.agents',
+                   '-m', 'deeppavlov.agents.insults.insults_agents:InsultsAgent',
+                   '--model_file', './build/insults/cnn_word_{}'.format(i),
+                   '-dt', 'test',
+                   '--model_name', 'cnn_word',
+                   '--raw-dataset-path', './build/insults/',
+                   '--max_sequence_length', '100',
+                   '--embedding_dim', '100',
+                   '--fasttext_model', './build/insults/reddit_fasttext_model.bin',
+                   '--fasttext_embeddings_dict', './build/insults/emb_dict.emb'
+                   ])
+
+
+@task
+def export_squad(project):
+    bu.export(['-t', 'squad',
+               '-m', 'deeppavlov.agents.squad.squad:SquadAgent',
+               '-dt', 'test',
+               '--type', 'fastqa_default',
+               '--model-file', './build/squad/squad1',
+               '--embedding_file', './build/squad/glove.840B.300d.txt'
+               ])
+
+
+@task
+def export_coreference(project):
+    mf = './build/coreference/'
+    compile_coreference(mf)
+    bu.export(['-t', 'deeppavlov.tasks.coreference.agents',
+               '-m', 'deeppavlov.agents.coreference.agents:CoreferenceAgent',
+               '-mf', mf,
+               '--language', 'russian',
+               '--name', 'main',
+               '--pretrained_model', 'True',
+               '-dt', 'test'
+               ])
+
+
+@task
+def benchmark_predict_paraphraser(project):
+    from deeppavlov.utils.benchmark import predict_overhead, paraphraser_input
+    opt = bu.arg_parse(['-t', 'deeppavlov.tasks.paraphrases.agents',
+                        '-m', 'deeppavlov.agents.paraphraser.paraphraser:ParaphraserAgent',
+                        '--pretrained_model', './build/paraphraser/paraphraser_0',
+                        '--datatype', 'valid',
+                        '--batchsize', '256',
+                        '--fasttext_embeddings_dict', './build/paraphraser/paraphraser.emb',
+                        '--fasttext_model', './build/paraphraser/ft_0.8.3_nltk_yalen_sg_300.bin',
+                        '--bagging-folds-number', '5'
+                        ])
+    return predict_overhead(opt, paraphraser_input)
+
+
+@task
+def benchmark_predict_insults(project):
+    from deeppavlov.utils.benchmark import predict_overhead, text_input
+    opt = bu.arg_parse(['-t', 'deeppavlov.tasks.insults.agents',
+                        '-m', 'deeppavlov.agents.insults.insults_agents:InsultsAgent',
+                        '--model_file', './build/insults/cnn_word_0',
+                        '--datatype', 'valid',
+                        '--model_name', 'cnn_word',
+                        '--raw-dataset-path', './build/insults/',
+                        '--batchsize', '64',
+                        '--max_sequence_length', '100',
+                        '--embedding_dim', '100',
+                        '--fasttext_model', './build/insults/reddit_fasttext_model.bin',
+                        '--fasttext_embeddings_dict', './build/insults/emb_dict.emb',
+                        '--bagging-folds-number', '3'
+                        ])
+    return predict_overhead(opt, text_input)
+
+
+def benchmark_synthetic(skill, args):
+    from deeppavlov.utils.benchmark import run_synthetic
+    create_dir('benchmarks/' + skill)
+    # e.g. BENCHMARK_ARGS='--cpu-affinity 0-3 --inter-op-threads 1'
+    return run_synthetic(skill, bu.arg_parse(args + os.getenv('BENCHMARK_ARGS', default='').split()))
+
+
+PARAPHRASER_BENCHMARK_ARGS = [
+    '-m', 'deeppavlov.agents.paraphraser.paraphraser:ParaphraserAgent',
+    '--model_file', './build/benchmarks/paraphraser/paraphraser',
+    '--fasttext_model', './build/benchmarks/paraphraser/random_fasttext.bin',
+    '--max_sequence_length', '28',
+    '--embedding_dim', '16',
+    '--hidden_dim', '16',
+    '--attention_dim', '8',
+    '--perspective_num', '4',
+    '--aggregation_dim', '16',
+    '--dense_dim', '8'
+    ]
+
+
+@task
+def benchmark_paraphraser(project):
+    return benchmark_synthetic('paraphraser', PARAPHRASER_BENCHMARK_ARGS)
+
+
+@task
+def benchmark_paraphraser_models(project):
+    # training and inference time per batch of every model, e.g. to compare them before and after a change
+    from deeppavlov.utils.benchmark import run_isolated, run_synthetic
+    results = {}
+    for model_name in ['full_match', 'maxpool_match', 'att_match', 'maxatt_match', 'bilstm_split',
+                       'bmwacor', 'bilstm_woatt']:
+        create_dir('benchmarks/paraphraser/' + model_name)
+        opt = bu.arg_parse(PARAPHRASER_BENCHMARK_ARGS + ['--model_name', model_name,
+                                                         '--perspective_num', '10',
+                                                         '--model_file', './build/benchmarks/paraphraser/' +
+                                                         model_name + '/paraphraser'] +
+                           os.getenv('BENCHMARK_ARGS', default='').split())
+        results[model_name] = run_isolated(run_synthetic, 'paraphraser', opt,
+                                           out_dir='./build/benchmarks/paraphraser/' + model_name)
+    return results
+
+
+@task
+def benchmark_insults(project):
+    return benchmark_synthetic('insults', [
+        '-m', 'deeppavlov.agents.insults.insults_agents:InsultsAgent',
+        '--model_file', './build/benchmarks/insults/cnn_word',
+        '--model_name', 'cnn_word',
+        '--fasttext_model', './build/benchmarks/insults/random_fasttext.bin',
+        '--max_sequence_length', '100',
+        '--embedding_dim', '16',
+        '--filters_cnn', '16',
+        '--kernel_sizes_cnn', '1 2 3',
+        '--dense_dim', '16'
+        ])
+
+
+@task
+def benchmark_ner(project):
+    return benchmark_synthetic('ner', [
+        '-m', 'deeppavlov.agents.ner.ner:NERAgent',
+        '-mf', './build/benchmarks/ner/ner',
+        '--dict-file', './build/benchmarks/ner/ner.dict'
+        ])
+
+
+@task
+def benchmark_squad(project):
+    return benchmark_synthetic('squad', [
+        '-m', 'deeppavlov.agents.squad.squad:SquadAgent',
+        '--model-file', './build/benchmarks/squad/squad',
+        '--dict-file', './build/benchmarks/squad/squad.dict',
+        '--embedding_file', './build/benchmarks/squad/random_vectors.txt',
+        '--type', 'fastqa_default',
+        '--word_embedding_dim', '16',
+        '--context_embedding_dim', '19',
+        '--question_embedding_dim', '16',
+        '--aligned_question_dim', '16',
+        '--context_enc_layers', '1',
+        '--question_enc_layers', '1',
+        '--encoder_hidden_dim', '16',
+        '--projection_dim', '16',
+        '--pointer_dim', '16'
+        ])
+
+
+@task
+def benchmark_coreference(project):
+    mf = './build/benchmarks/coreference/'
+    create_dir('benchmarks/coreference')
+    compile_coreference(mf)
+    return benchmark_synthetic('coreference', [
+        '-t', 'deeppavlov.tasks.coreference.agents',
+        '-m', 'deeppavlov.agents.coreference.agents:CoreferenceAgent',
+        '-mf', mf,
+        '--language', 'russian',
+        '--embedding_size', '16',
+        '--char_embedding_size', '8',
+        '--filter_size', '8',
+        '--lstm_size', '16',
+        '--ffnn_size', '16',
+        '--feature_size', '8',
+        '--max_antecedents', '50'
+        ])
+
+
+@task
+def benchmark_coreference_scorer_model(project):
+    return benchmark_synthetic('coreference_scorer_model', [
+        '-m', 'deeppavlov.agents.coreference_scorer_model.agents:CoreferenceAgent',
+        '--model-file', './build/benchmarks/coreference_scorer_model',
+        '--dense_hidden_size', '16'
+        ])
+
+
+@task
+def benchmark_imports(project):
+    from deeppavlov.utils.benchmark import run_imports
+    create_dir('benchmarks')
+    return run_imports()
+
+
+@task
+def benchmark_tokenization(project):
+    from deeppavlov.utils.benchmark import paraphraser_tokenization
+    create_dir('benchmarks')
+    return paraphraser_tokenization(bu.arg_parse(PARAPHRASER_BENCHMARK_ARGS +
+                                                 os.getenv('BENCHMARK_ARGS', default='').split()))
+
+
+@task
+def sweep(project):
+    import sweep_utils
+    return sweep_utils.sweep(os.getenv('SWEEP_CONFIG', default='./build/sweep.json'))
+
+
+@task
+def serve(project):
+    from deeppavlov.utils.inference_server import main
+    main(['--config', os.getenv('SERVER_CONFIG', default='./build/skills.json'),
+          '--port', os.getenv('SERVER_PORT', default='8080')])
+
+
+@task
+def load_test(project):
+    from deeppavlov.utils.load_generator import main
+    return main(['--port', os.getenv('SERVER_PORT', default='8080'),
+                 '--skill', os.getenv('LOAD_SKILL', default='insults'),
+                 '--inputs', os.getenv('LOAD_INPUTS', default='./build/load_inputs.json'),
+                 '--concurrency', os.getenv('LOAD_CONCURRENCY', default='32'),
+                 '--duration', os.getenv('LOAD_DURATION', default='30')])
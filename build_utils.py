@@ -22,17 +22,34 @@ python examples/train_model.py -m drqa -t babi:Task10k:1 -mf /tmp/model -bs 10
 TODO List:
 - More logging (e.g. to files), make things prettier.
 """
+import contextlib
 import copy
+import glob
+import inspect
 import math
+import multiprocessing
+import queue
+import shutil
 import sys
 import os
 
-from parlai.core.agents import create_agent
+from parlai.core.agents import create_agent, create_task_agent_from_taskname
 from parlai.core.params import ParlaiParser, str2class
 from parlai.core.utils import Timer
 from parlai.core.worlds import DialogPartnerWorld, create_task
 from parlai.core.dict import DictionaryAgent
 
+from deeppavlov.utils import dict_builder, parallel_eval
+from deeppavlov.utils.perf import PhaseTimer, instrument_world, format_summary, write_summary
+from deeppavlov.utils.saving import AsyncSaver
+from deeppavlov.utils.prefetch import PrefetchWorld
+from deeppavlov.utils.resources import print_memory_report
+from deeppavlov.utils.tf_session import set_cpu_affinity
+
+# functions called as hook(opt, valid_report) after every intermediate validation,
+# training stops when one of them returns True (see sweep_utils)
+validation_hooks = []
+
 
 def arg_parse(args=None):
     # Get command line arguments
@@ -65,10 +82,36 @@ def arg_parse(args=None):
     train.add_argument('-dbf', '--dict-build-first',
                         type='bool', default=True,
                         help='build dictionary first before training agent')
+    train.add_argument('--dict-build-workers', type=int, default=0,
+                       help='processes tokenizing the train data read directly from the teacher when '
+                            'building the dictionary, 0 parleys the teacher with the dictionary in a world') # custom arg
     train.add_argument('--chosen-metrics', default='accuracy',
                        help='metrics chosen to measure improvement') # custom arg
     train.add_argument('--lr-drop', '--lr-drop-patience', type=float, default=-1,
                        help='drop learning rate if validation metric is not improving') # custom arg
+    train.add_argument('--parallel-folds', type=int, default=0,
+                       help='number of bagging folds trained at the same time in separate processes, '
+                            '0 or 1 trains folds one after another') # custom arg
+    train.add_argument('--prefetch-batches', type=int, default=0,
+                       help='number of training batches prepared in background while the model '
+                            'is updated, 0 disables prefetching') # custom arg
+    train.add_argument('--prefetch-workers', type=int, default=1,
+                       help='number of threads preparing batches when prefetching '
+                            'is not deterministic') # custom arg
+    train.add_argument('--prefetch-deterministic', type='bool', default=True,
+                       help='prepare prefetched batches one by one in teacher order') # custom arg
+    train.add_argument('--async-validation', type='bool', default=False,
+                       help='validate a snapshot of the weights in a background process '
+                            'while training continues') # custom arg
+    train.add_argument('--async-save', type='bool', default=False,
+                       help='snapshot the best model in memory and write it in a background thread, '
+                            'a newer best model replaces the snapshot waiting to be written') # custom arg
+    train.add_argument('--eval-threads', type=int, default=1,
+                       help='number of threads evaluating a model on valid and test data, '
+                            'each thread takes batchsize / eval-threads examples at a time') # custom arg
+    train.add_argument('--perf-log', default=None,
+                       help='file to append per log interval throughput and phase timings '
+                            'to as JSON lines') # custom arg
 
     opt = parser.parse_args(args=args)
 
@@ -103,6 +146,11 @@ def __build_bag_of_words(opt):
     else:
         # Default dictionary class
         dictionary = DictionaryAgent(opt)
+    if opt['dict_build_workers'] > 0:
+        cnt = dict_builder.build(dictionary, opt, workers=opt['dict_build_workers'])
+        print('[ dictionary built from {} exs. ]'.format(cnt))
+        dictionary.save(opt['dict_file'], sort=True)
+        return
     ordered_opt = copy.deepcopy(opt)
     cnt = 0
     # we use train set to build dictionary
@@ -125,17 +173,29 @@ def __build_bag_of_words(opt):
     # print('[ num words =  %d ]' % len(dictionary))
 
 
-def __evaluate_model(valid_world, batchsize, datatype, display_examples, max_exs=-1):
+def __evaluate_model(valid_world, batchsize, datatype, display_examples, max_exs=-1, agent=None, threads=1):
     """Evaluate on validation/test data.
     - valid_world created before calling this function
     - batchsize obtained from opt['batchsize']
     - datatype is the datatype to use, such as "valid" or "test"
     - display_examples is bool
     - max_exs limits the number of examples if max_exs > 0
+    - agent of the world and the number of threads to evaluate it with
     """
     print('[ running eval: ' + datatype + ' ]')
 
     valid_world.reset()
+    # the world may be reused between validations, so clear teachers' metrics
+    for world in getattr(valid_world, 'worlds', [valid_world]):
+        teacher = world.get_agents()[0]
+        if hasattr(teacher, 'reset_metrics'):
+            teacher.reset_metrics()
+
+    if parallel_eval.supported(valid_world, agent, threads):
+        valid_report = parallel_eval.evaluate_in_threads(valid_world, agent, threads, max_exs)
+        print(datatype + ':' + str(valid_report))
+        return valid_report, valid_world
+
     cnt = 0
     for _ in valid_world:
         valid_world.parley()
@@ -154,12 +214,13 @@ def __evaluate_model(valid_world, batchsize, datatype, display_examples, max_exs
     return valid_report, valid_world
 
 
-def __train_log(opt, world, agent, input_train_dict):
+def __train_log(opt, world, agent, input_train_dict, perf=None):
     """Log training procedure.
     - opt is a dictionary returned by arg_parse
     - world used for training
     - agent to be trained
     - train_dict is dictionary of parameters for training, logging, intermediate validation
+    - perf is a PhaseTimer of the training loop
     """
     train_dict = copy.deepcopy(input_train_dict)
 
@@ -208,61 +269,259 @@ def __train_log(opt, world, agent, input_train_dict):
     # join log string and add full metrics report to end of log
     log = '[ {} ] {}'.format(' '.join(logs), train_dict['train_report'])
     print(log)
+    if perf is not None:
+        summary = perf.summary()
+        print(format_summary(summary))
+        if opt.get('perf_log'):
+            write_summary(opt['perf_log'], summary,
+                          time=train_dict['train_time'].time(),
+                          parleys=train_dict['parleys'],
+                          epochs_done=train_dict['epochs_done'])
     train_dict['log_time'].reset()
     return world, agent, train_dict
 
 
-def __intermediate_validation(opt, valid_world, agent, input_train_dict):
-    train_dict = copy.deepcopy(input_train_dict)
-    if 0 < opt['validation_every_n_secs'] < train_dict['validate_time'].time() or \
-            (opt['validation_every_n_epochs'] > 0 and train_dict['new_epoch'] and (
-                    train_dict['epochs_done'] % opt['validation_every_n_epochs']) == 0):
-
-        iopt = copy.deepcopy(opt)
-        if iopt.get('evaltask'):
-            iopt['task'] = iopt['evaltask']
-            print(iopt['task'])
-        iopt['datatype'] = 'valid'
-        ivalid_world = create_task(iopt, agent)
-
-        valid_report, valid_world = __evaluate_model(ivalid_world, iopt['batchsize'], 'valid',
-                                                     iopt['display_examples'], iopt['validation_max_exs'])
-
-        if train_dict['best_metrics'] not in valid_report and 'accuracy' in valid_report:
-            train_dict['best_metrics'] = 'accuracy'
-        if valid_report[train_dict['best_metrics']] > train_dict['best_metrics_value']:
-            train_dict['best_metrics_value'] = valid_report[train_dict['best_metrics']]
-            train_dict['impatience'] = 0
-            train_dict['lr_drop_impatience'] = 0
-            print('[ new best ' + train_dict['best_metrics'] + ': ' + str(train_dict['best_metrics_value']) + ' ]')
-            valid_world.save_agents()
-            train_dict['saved'] = True
+def __validation_due(opt, train_dict):
+    return 0 < opt['validation_every_n_secs'] < train_dict['validate_time'].time() or \
+        (opt['validation_every_n_epochs'] > 0 and train_dict['new_epoch'] and (
+            train_dict['epochs_done'] % opt['validation_every_n_epochs']) == 0)
+
+
+def __update_best(opt, agent, train_dict, valid_report, save_best, perf=None):
+    """Update the best metrics, patience and learning rate with a validation report.
+    save_best is called to persist the model if it is the best one so far.
+    """
+    if train_dict['best_metrics'] not in valid_report and 'accuracy' in valid_report:
+        train_dict['best_metrics'] = 'accuracy'
+    if valid_report[train_dict['best_metrics']] > train_dict['best_metrics_value']:
+        train_dict['best_metrics_value'] = valid_report[train_dict['best_metrics']]
+        train_dict['impatience'] = 0
+        train_dict['lr_drop_impatience'] = 0
+        print('[ new best ' + train_dict['best_metrics'] + ': ' + str(train_dict['best_metrics_value']) + ' ]')
+        with __phase(perf, 'save'):
+            save_best()
+        train_dict['saved'] = True
+        train_dict['best_valid_report'] = valid_report
+        best = True
+    else:
+        train_dict['impatience'] += 1
+        train_dict['lr_drop_impatience'] += 1
+        print('[ did not beat best ' + train_dict['best_metrics'] + ': {} impatience: {} ]'.format(
+            round(train_dict['best_metrics_value'], 4), train_dict['impatience']))
+        best = False
+    if 0 < opt['validation_patience'] <= train_dict['impatience']:
+        print('[ ran out of patience! stopping training. ]')
+        train_dict['break'] = True
+    if any([hook(opt, valid_report) for hook in validation_hooks]):
+        print('[ stopped by a validation hook. ]')
+        train_dict['break'] = True
+    if 'lr_drop_patience' in opt and 0 < opt['lr_drop_patience'] <= train_dict['lr_drop_impatience']:
+        if hasattr(agent, 'drop_lr'):
+            print('[ validation metric is decreasing, dropping learning rate ]')
+            train_dict['train_report'] = agent.drop_lr()
+            agent.reset_metrics()
         else:
-            train_dict['impatience'] += 1
-            train_dict['lr_drop_impatience'] += 1
-            print('[ did not beat best ' + train_dict['best_metrics'] + ': {} impatience: {} ]'.format(
-                round(train_dict['best_metrics_value'], 4), train_dict['impatience']))
-        train_dict['validate_time'].reset()
-        if 0 < opt['validation_patience'] <= train_dict['impatience']:
-            print('[ ran out of patience! stopping training. ]')
-            train_dict['break'] = True
-        if 'lr_drop_patience' in opt and 0 < opt['lr_drop_patience'] <= train_dict['lr_drop_impatience']:
-            if hasattr(agent, 'drop_lr'):
-                print('[ validation metric is decreasing, dropping learning rate ]')
-                train_dict['train_report'] = agent.drop_lr()
-                agent.reset_metrics()
+            print('[ there is no drop_lr method in agent, ignoring ]')
+    return best
+
+
+def __validate_snapshot(opt, results):
+    """Evaluate a weight snapshot in a background process and send the report to the parent.
+    - opt is a dictionary returned by arg_parse with the snapshot as the model file
+    - results is a queue shared with the parent process
+    """
+    try:
+        agent = create_agent(opt)
+        valid_world = create_task(opt, agent)
+        valid_report, _ = __evaluate_model(valid_world, opt['batchsize'], 'valid',
+                                           False, opt['validation_max_exs'])
+        valid_world.shutdown()
+        results.put((opt['model_file'], valid_report, None))
+    except BaseException as e:
+        results.put((opt['model_file'], None, repr(e)))
+
+
+def __snapshot_files(snapshot):
+    return [path for path in glob.glob(snapshot + '*') if path[len(snapshot):] == '' or
+            not path[len(snapshot)].isdigit()]
+
+
+def __promote_snapshot(opt, snapshot):
+    """Move the files of a snapshot over the model file."""
+    for path in __snapshot_files(snapshot):
+        target = opt['model_file'] + path[len(snapshot):]
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.replace(path, target)
+    print('[ saved snapshot ' + snapshot + ' as ' + opt['model_file'] + ' ]')
+
+
+def __remove_snapshot(snapshot):
+    for path in __snapshot_files(snapshot):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def __save_snapshot(opt, agent, snapshot):
+    """Save the agent to the files of a snapshot, raising an error if saving fails."""
+    if os.path.isdir(opt['model_file']) or opt['model_file'].endswith(os.sep):
+        os.makedirs(snapshot, exist_ok=True)
+    elif os.path.dirname(snapshot):
+        os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+    if callable(getattr(agent, 'save_snapshot', None)):
+        agent.save_snapshot(snapshot)()
+    else:
+        # save() of some agents prints errors instead of raising them
+        agent.save(snapshot)
+    if not __snapshot_files(snapshot) or (os.path.isdir(snapshot) and not os.listdir(snapshot)):
+        raise RuntimeError('Saving snapshot ' + snapshot + ' failed')
+
+
+def __start_async_validation(opt, agent, async_valid, perf=None):
+    """Save a snapshot of the agent and validate it in a background process."""
+    async_valid['count'] += 1
+    snapshot = '{}.snapshot{}'.format(opt['model_file'], async_valid['count'])
+    with __phase(perf, 'save'):
+        __save_snapshot(opt, agent, snapshot)
+
+    vopt = copy.deepcopy(opt)
+    if vopt.get('evaltask'):
+        vopt['task'] = vopt['evaltask']
+    vopt['datatype'] = 'valid'
+    vopt['model_file'] = snapshot
+    vopt['pretrained_model'] = snapshot
+    print('[ validating snapshot ' + snapshot + ' in background ]')
+    async_valid['process'] = async_valid['ctx'].Process(target=__validate_snapshot,
+                                                         args=(vopt, async_valid['results']))
+    async_valid['process'].start()
+
+
+def __collect_async_validation(opt, agent, train_dict, async_valid, perf=None, wait=False):
+    """Fold the result of a finished background validation into train_dict.
+    With wait the running validation is waited for.
+    """
+    process = async_valid['process']
+    if process is None:
+        return
+    while True:
+        try:
+            if wait:
+                snapshot, valid_report, error = async_valid['results'].get(timeout=1)
+            else:
+                # called every parley, it must not block training
+                snapshot, valid_report, error = async_valid['results'].get_nowait()
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                try:
+                    snapshot, valid_report, error = async_valid['results'].get(timeout=1)
+                except queue.Empty:
+                    snapshot, valid_report, error = None, None, 'exit code {}'.format(process.exitcode)
+                break
+            if not wait:
+                return
+    process.join()
+    async_valid['process'] = None
+    snapshot = snapshot or '{}.snapshot{}'.format(opt['model_file'], async_valid['count'])
+
+    if error is not None:
+        print('[ validation of snapshot ' + snapshot + ' failed: ' + error + ' ]')
+        __remove_snapshot(snapshot)
+        return
+    print('valid:' + str(valid_report))
+    if not __update_best(opt, agent, train_dict, valid_report,
+                         lambda: __promote_snapshot(opt, snapshot), perf):
+        __remove_snapshot(snapshot)
+
+
+def __intermediate_validation(opt, valid_world, agent, input_train_dict, perf=None, async_valid=None,
+                              saver=None, train_world=None):
+    """Validate the agent if it is time to.
+    valid_world is created on the first validation and should be passed back
+    on the next calls to be reused.
+    saver is an AsyncSaver writing the best model in the background.
+    train_world stops preparing batches while the agent is validated and saved.
+    """
+    train_dict = copy.deepcopy(input_train_dict)
+    if async_valid is not None:
+        __collect_async_validation(opt, agent, train_dict, async_valid, perf)
+        if __validation_due(opt, train_dict):
+            if async_valid['process'] is None:
+                with __paused(train_world):
+                    __start_async_validation(opt, agent, async_valid, perf)
+            else:
+                print('[ previous snapshot is still being validated, skipping validation ]')
+            train_dict['validate_time'].reset()
+        return valid_world, agent, train_dict
+
+    if __validation_due(opt, train_dict):
+        with __paused(train_world):
+            iopt = copy.deepcopy(opt)
+            if iopt.get('evaltask'):
+                iopt['task'] = iopt['evaltask']
+                print(iopt['task'])
+            iopt['datatype'] = 'valid'
+            with __phase(perf, 'validation'):
+                if valid_world is None:
+                    valid_world = create_task(iopt, agent)
+                valid_report, valid_world = __evaluate_model(valid_world, iopt['batchsize'], 'valid',
+                                                             iopt['display_examples'], iopt['validation_max_exs'],
+                                                             agent, iopt['eval_threads'])
+            if saver is not None:
+                # only the snapshot is taken in the loop, writing it is timed as save_write
+                save_best = lambda: saver.submit('best', agent.save_snapshot())
             else:
-                print('[ there is no drop_lr method in agent, ignoring ]')
+                save_best = valid_world.save_agents
+            __update_best(opt, agent, train_dict, valid_report, save_best, perf)
+        train_dict['validate_time'].reset()
     return valid_world, agent, train_dict
 
 
+def __paused(world):
+    """Stop a prefetching world from preparing batches with the agent."""
+    if world is None or not hasattr(world, 'paused'):
+        return contextlib.suppress()
+    return world.paused()
+
+
+def __phase(perf, name):
+    """Time a phase with the loop's PhaseTimer if there is one."""
+    if perf is None:
+        return contextlib.suppress()
+    return perf.phase(name, absorb=True)
+
+
 def __train_single_model(opt):
     """Train single model.
     opt is a dictionary returned by arg_parse
     """
     # Create model and assign it to the specified task
     agent = create_agent(opt)
+    print_memory_report()
     world = create_task(opt, agent)
+    perf = PhaseTimer()
+    instrument_world(world, perf)
+    if opt.get('prefetch_batches', 0) > 0:
+        if PrefetchWorld.supported(world):
+            world = PrefetchWorld(opt, world)
+        else:
+            print('[ prefetching is not supported for this task and model, ignoring ]')
+    async_valid = None
+    if opt.get('async_validation'):
+        if 'fname' in inspect.signature(agent.save).parameters:
+            # spawn gives the validation process its own TF runtime
+            ctx = multiprocessing.get_context('spawn')
+            async_valid = {'ctx': ctx, 'results': ctx.Queue(), 'process': None, 'count': 0}
+        else:
+            print('[ agent can not save snapshots, validating synchronously ]')
+    saver = None
+    if opt.get('async_save') and async_valid is None:
+        if callable(getattr(agent, 'save_snapshot', None)):
+            saver = AsyncSaver(perf)
+        else:
+            print('[ agent can not save in background, saving synchronously ]')
     print('[ training... ]')
 
     train_dict = {'train_time': Timer(),
@@ -279,11 +538,13 @@ def __train_single_model(opt):
                   'impatience': 0,
                   'lr_drop_impatience': 0,
                   'saved': False,
+                  'best_valid_report': None,
                   'train_report': None,
                   'train_report_agent': None,
                   'train_report_world': None,
                   'break': None}
 
+    valid_world = None
     try:
         while True:
             world.parley()
@@ -292,26 +553,44 @@ def __train_single_model(opt):
             if train_dict['new_epoch']:
                 world.reset()
                 train_dict['epochs_done'] += 1
-            world, agent, train_dict = __train_log(opt, world, agent, train_dict)
+            world, agent, train_dict = __train_log(opt, world, agent, train_dict, perf)
             if opt['num_epochs'] > 0 and train_dict['parleys'] >= train_dict['max_parleys']:
                 print('[ num_epochs completed: {} ]'.format(opt['num_epochs']))
                 break
             if 0 < opt['max_train_time'] < train_dict['train_time'].time():
                 print('[ max_train_time elapsed: {} ]'.format(train_dict['train_time'].time()))
                 break
-            _, agent, train_dict = __intermediate_validation(opt, world, agent, train_dict)
+            valid_world, agent, train_dict = __intermediate_validation(opt, valid_world, agent, train_dict,
+                                                                       perf, async_valid, saver, world)
 
             if train_dict['break']:
                 break
     except KeyboardInterrupt:
         print('Stopped training, starting testing')
 
+    if async_valid is not None:
+        __collect_async_validation(opt, agent, train_dict, async_valid, perf, wait=True)
+    if saver is not None:
+        with __phase(perf, 'save'):
+            saver.wait()
+        if saver.coalesced:
+            print('[ {} pending saves were replaced by newer ones ]'.format(saver.coalesced))
+
     if not train_dict['saved']:
-        world.save_agents()
+        with __paused(world), __phase(perf, 'save'):
+            world.save_agents()
 
+    # both worlds shut the agent down as well, shutting an agent down twice does nothing
     world.shutdown()
+    if valid_world is not None:
+        valid_world.shutdown()
     agent.shutdown()
 
+    # the best model was saved right after a full validation, its report is final
+    if train_dict['best_valid_report'] is not None and opt['validation_max_exs'] <= 0:
+        print('valid:' + str(train_dict['best_valid_report']))
+        return train_dict['best_valid_report']
+
     # reload best validation model
     vopt = copy.deepcopy(opt)
     if vopt.get('evaltask'):
@@ -321,24 +600,123 @@ def __train_single_model(opt):
     agent = create_agent(vopt)
     valid_world = create_task(vopt, agent)
     metrics, _ = __evaluate_model(valid_world, vopt['batchsize'], 'valid',
-                                  vopt['display_examples'], vopt['validation_max_exs'])
+                                  vopt['display_examples'], vopt['validation_max_exs'],
+                                  agent, vopt['eval_threads'])
     valid_world.shutdown()
     agent.shutdown()
     return metrics
 
 
+@contextlib.contextmanager
+def __thread_env(threads):
+    """Limit the threads of numeric libraries of the processes started in the block.
+    The libraries read the variables when imported, so they are set before a worker starts.
+    """
+    names = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+    saved = {name: os.environ.get(name) for name in names}
+    os.environ.update({name: str(threads) for name in names})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def __limit_threads(opt, threads):
+    """Restrict the TF sessions of a fold worker to its share of CPU cores.
+    - opt is a dictionary returned by arg_parse
+    - threads is the number of threads the worker is allowed to use
+    """
+    # models create their sessions from the session options of opt,
+    # ops of a training step mostly depend on each other, so one inter-op thread is enough
+    opt['intra_op_threads'] = opt.get('intra_op_threads') or threads
+    opt['inter_op_threads'] = opt.get('inter_op_threads') or 1
+
+
+def __train_fold(opt, threads, results, hooks):
+    """Train one bagging fold in a worker process and send its metrics to the parent.
+    - opt is a dictionary returned by arg_parse with the fold index set
+    - threads is the number of threads the worker is allowed to use
+    - results is a queue shared with the parent process
+    - hooks are the validation hooks of the parent process
+    """
+    fold = opt['bagging_fold_index']
+    try:
+        validation_hooks[:] = hooks
+        __limit_threads(opt, threads)
+        results.put((fold, __train_single_model(opt), None))
+    except BaseException as e:
+        results.put((fold, None, repr(e)))
+        raise
+
+
+def __train_folds_in_parallel(fold_opts, workers):
+    """Train bagging folds in at most `workers` processes at a time.
+    Returns metrics of the folds in the order of fold_opts.
+    """
+    # build the data once in the parent process, not in every worker at the same time
+    create_task_agent_from_taskname(copy.deepcopy(fold_opts[0]))
+
+    # spawn gives every worker its own TF runtime, and numeric libraries
+    # read the thread limits of __thread_env when the worker imports them
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    pending = list(fold_opts)
+    running = {}
+    metrics = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                fold_opt = pending.pop(0)
+                print('The {} fold is being trained'.format(fold_opt['bagging_fold_index'] + 1))
+                process = ctx.Process(target=__train_fold, args=(fold_opt, threads, results, validation_hooks))
+                with __thread_env(threads):
+                    process.start()
+                running[fold_opt['bagging_fold_index']] = process
+            try:
+                fold, fold_metrics, error = results.get(timeout=10)
+            except queue.Empty:
+                for fold, process in running.items():
+                    if not process.is_alive() and process.exitcode != 0:
+                        raise RuntimeError('Worker of the {} fold exited with code {}'.format(
+                            fold + 1, process.exitcode))
+                continue
+            running.pop(fold).join()
+            if error is not None:
+                raise RuntimeError('Training of the {} fold failed: {}'.format(fold + 1, error))
+            print('The {} fold is trained'.format(fold + 1))
+            metrics[fold] = fold_metrics
+    finally:
+        for process in running.values():
+            process.terminate()
+            process.join()
+    return [metrics[fold_opt['bagging_fold_index']] for fold_opt in fold_opts]
+
+
 def __create_ensemble_model(opt):
     """Create a (set of) model(s).
     opt is a dictionary returned by arg_parse
     """
-    metrics_list = []
     folds = opt['bagging_folds_number']
     print('The number of folds is', folds)
+    fold_opts = []
     for fold in range(folds):
-        print('The {} fold is being trained'.format(fold + 1))
         local_opt = copy.deepcopy(opt)
         local_opt['model_file'] = opt.get('model_file', '') + '_' + str(fold)
         local_opt['bagging_fold_index'] = fold
+        fold_opts.append(local_opt)
+
+    workers = min(opt.get('parallel_folds', 0), folds)
+    if workers > 1:
+        return __train_folds_in_parallel(fold_opts, workers)
+
+    metrics_list = []
+    for local_opt in fold_opts:
+        print('The {} fold is being trained'.format(local_opt['bagging_fold_index'] + 1))
         metrics_list.append(__train_single_model(local_opt))
     return metrics_list
 
@@ -349,6 +727,7 @@ def model(args=None):
     """
     args = args if args else sys.argv
     opt = arg_parse(args)
+    set_cpu_affinity(opt.get('cpu_affinity'))
 
     # Possibly build a dictionary (not all models do this).
     __build_bag_of_words(opt)
@@ -367,7 +746,8 @@ def model(args=None):
         agent = create_agent(opt)
         test_world = create_task(opt, agent)
         metrics, _ = __evaluate_model(test_world, opt['batchsize'], 'test',
-                                      opt['display_examples'], opt['validation_max_exs'])
+                                      opt['display_examples'], opt['validation_max_exs'],
+                                      agent, opt['eval_threads'])
         test_world.shutdown()
         agent.shutdown()
         return metrics
@@ -375,5 +755,21 @@ def model(args=None):
         raise ValueError('--datatype error, please specify "train:..." or "test:..."')
 
 
+def export(args=None):
+    """Write the inference-only artifact of a trained model, loaded with --frozen-model.
+    args could be provided instead of sys.argv
+    """
+    args = args if args else sys.argv
+    opt = arg_parse(args)
+    set_cpu_affinity(opt.get('cpu_affinity'))
+    if not opt.get('pretrained_model'):
+        opt['pretrained_model'] = opt['model_file']
+    if 'dict_file' in opt and opt['dict_file'] is None:
+        opt['dict_file'] = opt['pretrained_model'] + '.dict'
+    agent = create_agent(opt)
+    agent.export()
+    agent.shutdown()
+
+
 if __name__ == '__main__':
     model()
@@ -14,7 +14,6 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import copy
 import time
 import tensorflow as tf
 from parlai.core.agents import Agent
@@ -103,7 +102,12 @@ class CoreferenceAgent(Agent):
         self.rep_iter = opt['rep_iter']
         self.nitr = opt['nitr']
         self.model = CorefModel(opt)
-        self.saver = tf.train.Saver()
+        if self.opt.get('frozen_model'):
+            # the frozen graph has no variables to save or restore
+            self.saver = None
+            return
+        with self.model.model_graph.as_default():
+            self.saver = tf.train.Saver()
         if self.opt['pretrained_model']:
             print('[ Initializing model from checkpoint ]')
             self.model.init_from_saved(self.saver)
@@ -111,7 +115,7 @@ class CoreferenceAgent(Agent):
             print('[ Initializing model from scratch ]')
 
     def observe(self, observation):
-        self.observation = copy.deepcopy(observation)
+        self.observation = observation
         self.obs_dict = utils.conll2modeldata(self.observation)
         return self.obs_dict
 
@@ -150,6 +154,10 @@ class CoreferenceAgent(Agent):
     def save(self):
         self.model.save(self.saver)
 
+    def export(self):
+        """Export the model to the inference-only artifact loaded with --frozen-model."""
+        self.model.export()
+
     def shutdown(self):
         if not self.is_shared:
             if self.model is not None:
@@ -14,8 +14,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from ...utils import tf_session
+
 
 def add_cmdline_args(parser):
+    tf_session.add_cmdline_args(parser)
     # Runtime environment
     agent = parser.add_argument_group('Coreference Arguments')
 
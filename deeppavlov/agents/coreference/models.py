@@ -23,17 +23,19 @@ import tensorflow as tf
 from . import utils
 from os.path import isdir, join
 
+from ...utils.tf_session import ModelGraph, FrozenModel, freeze
+
 tf.NotDifferentiable("Spans")
 tf.NotDifferentiable("Antecedents")
 tf.NotDifferentiable("ExtractMentions")
 tf.NotDifferentiable("DistanceBins")
 
+GPU_OPTIONS = {'per_process_gpu_memory_fraction': 0.8}
+
 class CorefModel(object):
     def __init__(self, opt):
         self.opt = copy.deepcopy(opt)
-        
-        config = tf.ConfigProto()
-        config.gpu_options.per_process_gpu_memory_fraction = 0.8
+        self.model_graph = ModelGraph(self.opt, GPU_OPTIONS)
         
         coref_op_library = tf.load_op_library(join(opt['model_file'], "coref_kernels.so"))
         self.spans = coref_op_library.spans
@@ -54,43 +56,53 @@ class CorefModel(object):
         self.max_mention_width = self.opt["max_mention_width"]
         self.genres = {g: i for i, g in enumerate(self.opt["genres"])}
 
-        input_props = []
-        input_props.append((tf.float32, [None, None, self.embedding_size]))  # Text embeddings.
-        input_props.append((tf.int32, [None, None, None]))  # Character indices.
-        input_props.append((tf.int32, [None]))  # Text lengths.
-        input_props.append((tf.int32, [None]))  # Speaker IDs.
-        input_props.append((tf.int32, []))  # Genre.
-        input_props.append((tf.bool, []))  # Is training.
-        input_props.append((tf.int32, [None]))  # Gold starts.
-        input_props.append((tf.int32, [None]))  # Gold ends.
-        input_props.append((tf.int32, [None]))  # Cluster ids.
-
-        self.queue_input_tensors = [tf.placeholder(dtype, shape) for dtype, shape in input_props]
-        dtypes, shapes = zip(*input_props)
-        queue = tf.PaddingFIFOQueue(capacity=1, dtypes=dtypes, shapes=shapes)
-        self.enqueue_op = queue.enqueue(self.queue_input_tensors)
-        self.input_tensors = queue.dequeue()
-        
-        
-        self.predictions, self.loss = self.get_predictions_and_loss(*self.input_tensors)
-        self.global_step = tf.Variable(0, name="global_step", trainable=False)
-        self.reset_global_step = tf.assign(self.global_step, 0)
-        learning_rate = tf.train.exponential_decay(self.opt["learning_rate"], self.global_step,
-                                                   self.opt["decay_frequency"], self.opt["decay_rate"],
-                                                   staircase=True)
-        trainable_params = tf.trainable_variables()
-        gradients = tf.gradients(self.loss, trainable_params)
-        gradients, _ = tf.clip_by_global_norm(gradients, self.opt["max_gradient_norm"])
-        optimizers = {
-            "adam": tf.train.AdamOptimizer,
-            "sgd": tf.train.GradientDescentOptimizer
-        }
-        optimizer = optimizers[self.opt["optimizer"]](learning_rate)
-        self.train_op = optimizer.apply_gradients(zip(gradients, trainable_params), global_step=self.global_step)
-        
-        self.sess = tf.Session(config=config)
-        self.init_op = tf.global_variables_initializer()
-        self.sess.run(self.init_op)
+        self.frozen = None
+        if self.opt.get('frozen_model'):
+            # inference only, predictions are computed from fed inputs without the queue
+            self.sess = self.model_graph.session
+            fname = self.frozen_path()
+            print('[ Loading frozen model {} ]'.format(fname))
+            self.frozen = FrozenModel(self.model_graph, fname)
+            return
+
+        with self.model_graph.as_default():
+            input_props = []
+            input_props.append((tf.float32, [None, None, self.embedding_size]))  # Text embeddings.
+            input_props.append((tf.int32, [None, None, None]))  # Character indices.
+            input_props.append((tf.int32, [None]))  # Text lengths.
+            input_props.append((tf.int32, [None]))  # Speaker IDs.
+            input_props.append((tf.int32, []))  # Genre.
+            input_props.append((tf.bool, []))  # Is training.
+            input_props.append((tf.int32, [None]))  # Gold starts.
+            input_props.append((tf.int32, [None]))  # Gold ends.
+            input_props.append((tf.int32, [None]))  # Cluster ids.
+
+            self.queue_input_tensors = [tf.placeholder(dtype, shape) for dtype, shape in input_props]
+            dtypes, shapes = zip(*input_props)
+            queue = tf.PaddingFIFOQueue(capacity=1, dtypes=dtypes, shapes=shapes)
+            self.enqueue_op = queue.enqueue(self.queue_input_tensors)
+            self.input_tensors = queue.dequeue()
+
+
+            self.predictions, self.loss = self.get_predictions_and_loss(*self.input_tensors)
+            self.global_step = tf.Variable(0, name="global_step", trainable=False)
+            self.reset_global_step = tf.assign(self.global_step, 0)
+            learning_rate = tf.train.exponential_decay(self.opt["learning_rate"], self.global_step,
+                                                       self.opt["decay_frequency"], self.opt["decay_rate"],
+                                                       staircase=True)
+            trainable_params = tf.trainable_variables()
+            gradients = tf.gradients(self.loss, trainable_params)
+            gradients, _ = tf.clip_by_global_norm(gradients, self.opt["max_gradient_norm"])
+            optimizers = {
+                "adam": tf.train.AdamOptimizer,
+                "sgd": tf.train.GradientDescentOptimizer
+            }
+            optimizer = optimizers[self.opt["optimizer"]](learning_rate)
+            self.train_op = optimizer.apply_gradients(zip(gradients, trainable_params), global_step=self.global_step)
+
+            self.sess = self.model_graph.session
+            self.init_op = tf.global_variables_initializer()
+            self.sess.run(self.init_op)
         
     def start_enqueue_thread(self, train_example, is_training, returning=False):
         tensorized_example = self.tensorize_example(train_example, is_training=is_training)
@@ -493,7 +505,14 @@ class CorefModel(object):
             print('Init from scratch')
 
     def shutdown(self):
-        tf.reset_default_graph()
+        self.model_graph.close()
+
+    def frozen_path(self):
+        return join(self.log_root, self.opt['name'], 'model.max')
+
+    def export(self):
+        """Write the inference-only artifact loaded with --frozen-model."""
+        freeze(self.model_graph, self.input_tensors, self.predictions, self.frozen_path())
 
     def save(self, saver):
         log_dir = self.log_root
@@ -521,8 +540,12 @@ class CorefModel(object):
         return self.tf_loss
 
     def predict(self, batch, out_file):        
-        self.start_enqueue_thread(batch, False)        
-        candidate_starts, candidate_ends, mention_scores, mention_starts, mention_ends, antecedents, antecedent_scores = self.sess.run(self.predictions)
+        if self.frozen is not None:
+            outputs = self.frozen.run(self.tensorize_example(batch, is_training=False))
+        else:
+            self.start_enqueue_thread(batch, False)
+            outputs = self.sess.run(self.predictions)
+        candidate_starts, candidate_ends, mention_scores, mention_starts, mention_ends, antecedents, antecedent_scores = outputs
         
         
         tensorise = lambda example: self.tensorize_example(example, is_training=False)
@@ -25,6 +25,8 @@ from tqdm import tqdm
 from . import utils
 from .model import MentionScorerModel
 from ...utils import coreference_utils
+from ...utils import resources
+from ...utils import tf_session
 
 class EchoAgent(Agent):
 
@@ -68,6 +70,7 @@ class CoreferenceAgent(Agent):
         group.add_argument('--embeddings_path', type=str, default='')
         group.add_argument('--pretrained_model', type=str, default='')
         group.add_argument('--tensorboard', type=str, default='tensorboard_coreference_scorer', help='path to tensorboard logs')
+        tf_session.add_cmdline_args(argparser)
 
 
     def __init__(self, opt):
@@ -104,16 +107,17 @@ class CoreferenceAgent(Agent):
 
         utils.download_embeddings(self.embeddings_url, self.embeddings_path)
 
-        self.embeddings = fasttext.load_model(self.embeddings_path)
+        self.embeddings = resources.acquire('fasttext', self.embeddings_path,
+                                            lambda: fasttext.load_model(self.embeddings_path),
+                                            resources.file_nbytes(self.embeddings_path))
 
         self.data = None
         self.data_valid = None
 
         # create model and batch_generator on first observe call
         self.model = None
+        self.model_graph = None
         self.session = None
-        self.tf_config = tf.ConfigProto()
-        self.tf_config.gpu_options.allow_growth=True
         self.data_bg = None
         self.valid_bg = None
         
@@ -210,36 +214,46 @@ class CoreferenceAgent(Agent):
 
         # create model
         if self.model is None:
-            self.model = MentionScorerModel(hidden_size=self.opt['dense_hidden_size'], lr=self.opt['lr'],
-                keep_prob_input=self.opt['keep_prob_input'], keep_prob_dense=self.opt['keep_prob_dense'], features_size=self.valid_bg.dl.features_size)
-            self.session = tf.Session(config=self.tf_config)
-            tf.global_variables_initializer().run(session=self.session)
-            if self.opt['pretrained_model'] != '':
-                checkpoint = tf.train.latest_checkpoint(self.opt['pretrained_model'])
-                print('Initializing model from checkpoint: {}'.format(checkpoint))
-                saver = tf.train.Saver()
-                #print('Loading from:', checkpoint)
-                saver.restore(self.session, checkpoint)
-                with open(os.path.join(self.agent_dir, 'threshold'), 'r') as fin:
-                    self.best_threshold = float(fin.readline().strip())
-                    self.best_conll_f1 = float(fin.readline().strip().split()[-1])
+            self.model_graph = tf_session.ModelGraph(self.opt, {'allow_growth': True})
+            self.session = self.model_graph.session
+            with self.model_graph.as_default():
+                self.model = MentionScorerModel(hidden_size=self.opt['dense_hidden_size'], lr=self.opt['lr'],
+                    keep_prob_input=self.opt['keep_prob_input'], keep_prob_dense=self.opt['keep_prob_dense'], features_size=self.valid_bg.dl.features_size)
+                tf.global_variables_initializer().run(session=self.session)
+                if self.opt['pretrained_model'] != '':
+                    checkpoint = tf.train.latest_checkpoint(self.opt['pretrained_model'])
+                    print('Initializing model from checkpoint: {}'.format(checkpoint))
+                    saver = tf.train.Saver()
+                    #print('Loading from:', checkpoint)
+                    saver.restore(self.session, checkpoint)
+                    with open(os.path.join(self.agent_dir, 'threshold'), 'r') as fin:
+                        self.best_threshold = float(fin.readline().strip())
+                        self.best_conll_f1 = float(fin.readline().strip().split()[-1])
 
     
     def save(self):
         if self.session is not None:
-            saver = tf.train.Saver()
+            with self.model_graph.as_default():
+                saver = tf.train.Saver()
             saver.save(self.session, os.path.join(self.agent_dir, 'model'))
             with open(os.path.join(self.agent_dir, 'threshold'), 'w') as fout:
                 fout.write('{}\n'.format(self.best_threshold))
                 fout.write('conll-f-1: {:.5f}\n'.format(self.best_conll_f1))
 
     def shutdown(self):
-        tf.reset_default_graph()
+        if self.embeddings is not None:
+            resources.release('fasttext', self.embeddings_path)
+            self.embeddings = None
+        if self.model_graph is not None:
+            self.model_graph.close()
+            self.model_graph = None
+            self.session = None
 
 
     def _train_scorer(self):
         summary_writer = tf.summary.FileWriter(self.run_path, graph=self.session.graph)
-        saver = tf.train.Saver(max_to_keep=None)
+        with self.model_graph.as_default():
+            saver = tf.train.Saver(max_to_keep=None)
 
         while self.data_bg.epoch < self.inner_epochs:
             A, A_f, B, B_f, AB_f, C = self.data_bg.get_batch(self.batch_size)
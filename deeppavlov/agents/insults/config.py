@@ -1,4 +1,8 @@
+from ...utils import tf_session
+
+
 def add_cmdline_args(parser):
+    tf_session.add_cmdline_args(parser)
     # Runtime environment
     agent = parser.add_argument_group('Insults Arguments')
     agent.add_argument('--no_cuda', type='bool', default=False)
@@ -20,18 +20,25 @@ import numpy as np
 import urllib.request
 import fasttext
 
+from ...utils import resources
+from ...utils.saving import atomic_open
+
 
 class EmbeddingsDict(object):
     def __init__(self, opt, embedding_dim):
-        self.tok2emb = {}
         self.embedding_dim = embedding_dim
         self.opt = copy.deepcopy(opt)
-        self.load_items()
 
         if not self.opt.get('fasttext_model'):
             raise RuntimeError('No pretrained fasttext model provided')
         self.fasttext_model_file = self.opt.get('fasttext_model')
-        if not os.path.isfile(self.fasttext_model_file):
+        # token embeddings depend only on the fasttext model, so dicts of all models share them
+        # the saved embeddings are read by the first dict only
+        self.tok2emb = resources.acquire('token embeddings', self.fasttext_model_file, self.load_items,
+                                         resources.dict_nbytes)
+
+        if not resources.contains('fasttext', self.fasttext_model_file) and \
+                not os.path.isfile(self.fasttext_model_file):
             emb_path = os.environ.get('EMBEDDINGS_URL')
             if not emb_path:
                 raise RuntimeError('No pretrained fasttext model provided')
@@ -43,7 +50,17 @@ class EmbeddingsDict(object):
                 print('Downloaded a fasttext model')
             except Exception as e:
                 raise RuntimeError('Looks like the `EMBEDDINGS_URL` variable is set incorrectly', e)
-        self.fasttext_model = fasttext.load_model(self.fasttext_model_file)
+        self.fasttext_model = resources.acquire('fasttext', self.fasttext_model_file,
+                                                lambda: fasttext.load_model(self.fasttext_model_file),
+                                                resources.file_nbytes(self.fasttext_model_file))
+
+    def release(self):
+        """Release the shared fasttext model and token embeddings."""
+        if self.fasttext_model is None:
+            return
+        resources.release('fasttext', self.fasttext_model_file)
+        resources.release('token embeddings', self.fasttext_model_file)
+        self.fasttext_model = None
 
     def add_items(self, sentence_li):
         for sen in sentence_li:
@@ -54,21 +71,29 @@ class EmbeddingsDict(object):
                     self.tok2emb[tok] = self.fasttext_model[tok]
 
     def save_items(self, fname):
+        self.items_writer(fname)()
+
+    def items_writer(self, fname):
+        """Snapshot of the embeddings and a function saving it, see saving.AsyncSaver."""
         if self.opt.get('fasttext_embeddings_dict') is not None:
             fname = self.opt['fasttext_embeddings_dict']
         else:
             fname += '.emb'
-        f = open(fname, 'w')
-        string = '\n'.join([el[0] + ' ' + self.emb2str(el[1]) for el in self.tok2emb.items()])
-        f.write(string)
-        f.close()
+        # embeddings are only added, a shallow copy keeps the saved ones intact
+        items = list(self.tok2emb.items())
+
+        def write():
+            with atomic_open(fname) as f:
+                f.write('\n'.join([el[0] + ' ' + self.emb2str(el[1]) for el in items]))
+        return write
 
     def emb2str(self, vec):
         string = ' '.join([str(el) for el in vec])
         return string
 
     def load_items(self):
-        """Initialize embeddings from file."""
+        """Embeddings of tokens read from file."""
+        tok2emb = {}
         fname = None
         if self.opt.get('fasttext_embeddings_dict') is not None:
             fname = self.opt['fasttext_embeddings_dict']
@@ -87,4 +112,5 @@ class EmbeddingsDict(object):
                     assert(len(values) == self.embedding_dim + 1)
                     word = values[0]
                     coefs = np.asarray(values[1:], dtype='float32')
-                    self.tok2emb[word] = coefs
\ No newline at end of file
+                    tok2emb[word] = coefs
+        return tok2emb
@@ -1,12 +1,17 @@
 import copy
+import threading
+import numpy as np
 from parlai.core.agents import Agent
 from . import config
 from .model import InsultsModel
 from .utils import create_vectorizer_selector, get_vectorizer_selector
 from .embeddings_dict import EmbeddingsDict
+from ...utils.parallel_eval import check_numthreads
 
 class EnsembleInsultsAgent(Agent):
 
+    thread_safe_share = True
+
     @staticmethod
     def add_cmdline_args(argparser):
         config.add_cmdline_args(argparser)
@@ -19,11 +24,15 @@ class EnsembleInsultsAgent(Agent):
                               help='list of all the model coefs for the ensemble')
 
     def __init__(self, opt, shared=None):
+        check_numthreads(opt)
         self.id = 'InsultsAgent'
         self.episode_done = True
         super().__init__(opt, shared)
         if shared is not None:
             self.is_shared = True
+            self.models = shared['models']
+            self.word_dict = shared['word_dict']
+            self.model_coefs = shared['model_coefs']
             return
         # Set up params/logging/dicts
         self.is_shared = False
@@ -52,7 +61,7 @@ class EnsembleInsultsAgent(Agent):
         self.n_examples = 0
 
     def observe(self, observation):
-        observation = copy.deepcopy(observation)
+        observation = copy.copy(observation)
         if not self.episode_done:
             # if the last example wasn't the end of an episode, then we need to
             # recall what was said in that example
@@ -86,22 +95,27 @@ class EnsembleInsultsAgent(Agent):
         # call batch_act with this batch of one
         return self.batch_act([self.observation])[0]
 
-    def batch_act(self, observations):
+    def prepare_batch(self, observations):
+        """Build inputs of every model for a batch of observations."""
+        batches = []
+        for model in self.models:
+            examples = [model._build_ex(obs) for obs in observations]
+            valid_inds = [i for i in range(len(observations)) if examples[i] is not None]
+            examples = [ex for ex in examples if ex is not None]
+            batches.append((valid_inds, model._batchify(examples, self.word_dict)))
+        return batches
+
+    def batch_act(self, observations, batch=None):
 
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
+        if batch is None:
+            batch = self.prepare_batch(observations)
 
         batch_size = len(observations)
         # initialize a table of replies with this agent's id
         batch_reply = [{'id': self.getID()} for _ in range(batch_size)]
         predictions = [[] for _ in range(batch_size)]
-        for j, model in enumerate(self.models):
-            examples = [model._build_ex(obs) for obs in observations]
-            valid_inds = [i for i in range(batch_size) if examples[i] is not None]
-            examples = [ex for ex in examples if ex is not None]
-
-            batch = model._batchify(examples, self.word_dict)
-            prediction = model.predict(batch)
+        for model, (valid_inds, model_batch) in zip(self.models, batch):
+            prediction = model.predict(model_batch)
             for i in range(len(prediction)):
                 predictions[valid_inds[i]].append(prediction[i])
 
@@ -113,6 +127,25 @@ class EnsembleInsultsAgent(Agent):
 
         return batch_reply
 
+    def predict(self, texts):
+        """Return insult probabilities of the ensemble for a list of texts."""
+        if not texts:
+            return np.array([])
+        predictions = [model.predict(model.batchify_texts(texts)) for model in self.models]
+        return self.weighted_sum(predictions)
+
+    def share(self):
+        """Share the models with copies of the agent acting in other threads."""
+        shared = super().share()
+        shared['models'] = self.models
+        shared['word_dict'] = self.word_dict
+        shared['model_coefs'] = self.model_coefs
+        for model in self.models:
+            if model.model_type == 'nn':
+                # build the predict function before other threads call predict
+                model.make_predict_function()
+        return shared
+
     def weighted_sum(self, predictions):
         result = 0
         for j in range(len(predictions)):
@@ -120,8 +153,16 @@ class EnsembleInsultsAgent(Agent):
         result = result / sum(self.model_coefs)
         return result
 
+    def shutdown(self):
+        if not self.is_shared:
+            for model in self.models:
+                model.shutdown()
+            self.models = []
+
 class BoostEnsembleInsultsAgent(Agent):
 
+    thread_safe_share = True
+
     @staticmethod
     def add_cmdline_args(argparser):
         config.add_cmdline_args(argparser)
@@ -134,11 +175,15 @@ class BoostEnsembleInsultsAgent(Agent):
                               help='list of all the model coefs for the ensemble')
 
     def __init__(self, opt, shared=None):
+        check_numthreads(opt)
         self.id = 'InsultsAgent'
         self.episode_done = True
         super().__init__(opt, shared)
         if shared is not None:
             self.is_shared = True
+            self.models = shared['models']
+            self.word_dict = shared['word_dict']
+            self.model_coefs = shared['model_coefs']
             return
         # Set up params/logging/dicts
         self.is_shared = False
@@ -167,7 +212,7 @@ class BoostEnsembleInsultsAgent(Agent):
         self.n_examples = 0
 
     def observe(self, observation):
-        observation = copy.deepcopy(observation)
+        observation = copy.copy(observation)
         if not self.episode_done:
             # if the last example wasn't the end of an episode, then we need to
             # recall what was said in that example
@@ -201,22 +246,27 @@ class BoostEnsembleInsultsAgent(Agent):
         # call batch_act with this batch of one
         return self.batch_act([self.observation])[0]
 
-    def batch_act(self, observations):
+    def prepare_batch(self, observations):
+        """Build inputs of every model for a batch of observations."""
+        batches = []
+        for model in self.models:
+            examples = [model._build_ex(obs) for obs in observations]
+            valid_inds = [i for i in range(len(observations)) if examples[i] is not None]
+            examples = [ex for ex in examples if ex is not None]
+            batches.append((valid_inds, model._batchify(examples, self.word_dict)))
+        return batches
 
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
+    def batch_act(self, observations, batch=None):
+
+        if batch is None:
+            batch = self.prepare_batch(observations)
 
         batch_size = len(observations)
         # initialize a table of replies with this agent's id
         batch_reply = [{'id': self.getID()} for _ in range(batch_size)]
         predictions = [[] for _ in range(batch_size)]
-        for j, model in enumerate(self.models):
-            examples = [model._build_ex(obs) for obs in observations]
-            valid_inds = [i for i in range(batch_size) if examples[i] is not None]
-            examples = [ex for ex in examples if ex is not None]
-
-            batch = model._batchify(examples, self.word_dict)
-            prediction = model.predict(batch)
+        for model, (valid_inds, model_batch) in zip(self.models, batch):
+            prediction = model.predict(model_batch)
             for i in range(len(prediction)):
                 predictions[valid_inds[i]].append(prediction[i])
 
@@ -228,6 +278,25 @@ class BoostEnsembleInsultsAgent(Agent):
 
         return batch_reply
 
+    def predict(self, texts):
+        """Return insult probabilities of the ensemble for a list of texts."""
+        if not texts:
+            return np.array([])
+        predictions = [model.predict(model.batchify_texts(texts)) for model in self.models]
+        return self.weighted_sum(predictions)
+
+    def share(self):
+        """Share the models with copies of the agent acting in other threads."""
+        shared = super().share()
+        shared['models'] = self.models
+        shared['word_dict'] = self.word_dict
+        shared['model_coefs'] = self.model_coefs
+        for model in self.models:
+            if model.model_type == 'nn':
+                # build the predict function before other threads call predict
+                model.make_predict_function()
+        return shared
+
     def weighted_sum(self, predictions):
         result = 0
         for j in range(len(predictions)):
@@ -235,21 +304,37 @@ class BoostEnsembleInsultsAgent(Agent):
         result = result / sum(self.model_coefs)
         return result
 
+    def shutdown(self):
+        if not self.is_shared:
+            for model in self.models:
+                model.shutdown()
+            self.models = []
+
 class InsultsAgent(Agent):
 
+    thread_safe_share = True
+
     @staticmethod
     def add_cmdline_args(argparser):
         config.add_cmdline_args(argparser)
 
     def __init__(self, opt, shared=None):
+        check_numthreads(opt)
         self.id = 'InsultsAgent'
         self.episode_done = True
         super().__init__(opt, shared)
+        self.n_examples = 0
         if shared is not None:
             self.is_shared = True
+            self.model_name = shared['model'].model_name
+            self.word_dict = shared['word_dict']
+            self.model = shared['model']
+            self.lock = shared['lock']
             return
         # Set up params/logging/dicts
         self.is_shared = False
+        # updates of the model are serialized, predictions run concurrently
+        self.lock = threading.Lock()
 
         self.model_name = opt['model_name']
 
@@ -271,7 +356,7 @@ class InsultsAgent(Agent):
             self.model.vectorizers, self.model.selectors = get_vectorizer_selector(self.opt['model_file'],  self.num_ngrams)
 
     def observe(self, observation):
-        observation = copy.deepcopy(observation)
+        observation = copy.copy(observation)
         if not self.episode_done:
             # if the last example wasn't the end of an episode, then we need to
             # recall what was said in that example
@@ -285,27 +370,42 @@ class InsultsAgent(Agent):
         # call batch_act with this batch of one
         return self.batch_act([self.observation])[0]
 
-    def batch_act(self, observations):
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
+    def prepare_batch(self, observations):
+        """Build model inputs for a batch of observations."""
+        examples = [self._build_ex(obs) for obs in observations]
+        valid_inds = [i for i in range(len(observations)) if examples[i] is not None]
+        examples = [ex for ex in examples if ex is not None]
+        return valid_inds, self.model._batchify(examples)
+
+    def share(self):
+        """Share the model with copies of the agent acting in other threads."""
+        shared = super().share()
+        shared['model'] = self.model
+        shared['word_dict'] = self.word_dict
+        shared['lock'] = self.lock
+        if self.model.model_type == 'nn':
+            # build the predict function before other threads call predict
+            self.model.make_predict_function()
+        return shared
+
+    def batch_act(self, observations, batch=None):
+        if batch is None:
+            batch = self.prepare_batch(observations)
+        valid_inds, batch = batch
 
         batch_size = len(observations)
         # initialize a table of replies with this agent's id
         batch_reply = [{'id': self.getID()} for _ in range(batch_size)]
-        examples = [self._build_ex(obs) for obs in observations]
-        valid_inds = [i for i in range(batch_size) if examples[i] is not None]
-        examples = [ex for ex in examples if ex is not None]
 
         if 'labels' in observations[0]:
-            self.n_examples += len(examples)
-            batch = self.model._batchify(examples)
-            predictions = self.model.update(batch)
+            self.n_examples += len(valid_inds)
+            with self.lock:
+                predictions = self.model.update(batch)
             predictions_text = self._predictions2text(predictions)
             for i in range(len(predictions)):
                 batch_reply[valid_inds[i]]['text'] = predictions_text[i]
                 batch_reply[valid_inds[i]]['score'] = predictions[i]
         else:
-            batch = self.model._batchify(examples)
             predictions = self.model.predict(batch)
             predictions_text = self._predictions2text(predictions)
             for i in range(len(predictions)):
@@ -314,6 +414,12 @@ class InsultsAgent(Agent):
 
         return batch_reply
 
+    def predict(self, texts):
+        """Return insult probabilities for a list of texts."""
+        if not texts:
+            return np.array([])
+        return self.model.predict(self.model.batchify_texts(texts))
+
     def _build_ex(self, ex):
         if 'text' not in ex:
             return
@@ -344,18 +450,44 @@ class InsultsAgent(Agent):
         report['auc'] = self.model.train_auc
         return report
 
-    def save(self):
-        self.model.save()
+    def save(self, fname=None):
+        self.model.save(fname)
+
+    def save_snapshot(self, fname=None):
+        """Capture the parameters saved by save and return a function writing them."""
+        with self.lock:
+            return self.model.save_snapshot(fname)
+
+    def export(self, fname=None):
+        """Export the model to the inference-only artifact loaded with --frozen-model."""
+        self.model.export(fname)
+
+    def shutdown(self):
+        if not self.is_shared:
+            if self.model is not None:
+                self.model.shutdown()
+            self.model = None
 
 
 class OneEpochAgent(InsultsAgent):
 
+    # the model is trained when it is saved, which can not be done in background
+    save_snapshot = None
+    # training data is collected per instance, so shared copies can not act
+    thread_safe_share = False
+
     def __init__(self, opt, shared=None):
         super().__init__(opt, shared)
         self.observation = ''
         self.observations_ = []
 
-    def batch_act(self, observations):
+    def prepare_batch(self, observations):
+        """Build model inputs for prediction, training data is only collected."""
+        if 'labels' in observations[0]:
+            return None
+        return super().prepare_batch(observations)
+
+    def batch_act(self, observations, batch=None):
         self.observations_ += observations
 
         if self.is_shared:
@@ -364,14 +496,14 @@ class OneEpochAgent(InsultsAgent):
         batch_size = len(observations)
         # initialize a table of replies with this agent's id
         batch_reply = [{'id': self.getID()} for _ in range(batch_size)]
-        examples = [self._build_ex(obs) for obs in observations]
-        valid_inds = [i for i in range(batch_size) if examples[i] is not None]
-        examples = [ex for ex in examples if ex is not None]
 
         if 'labels' in observations[0]:
-            self.n_examples += len(examples)
+            examples = [self._build_ex(obs) for obs in observations]
+            self.n_examples += len([ex for ex in examples if ex is not None])
         else:
-            batch = self.model._batchify(examples)
+            if batch is None:
+                batch = self.prepare_batch(observations)
+            valid_inds, batch = batch
             predictions = self.model.predict(batch).reshape(-1)
             predictions_text = self._predictions2text(predictions)
             for i in range(len(predictions)):
@@ -1,11 +1,4 @@
 import tensorflow as tf
-from keras.backend.tensorflow_backend import set_session
-config = tf.ConfigProto()
-#config.gpu_options.per_process_gpu_memory_fraction = 0.95
-config.gpu_options.allow_growth=True
-config.gpu_options.visible_device_list = '0'
-set_session(tf.Session(config=config))
-
 from .metrics import roc_auc_score
 import os
 import numpy as np
@@ -31,11 +24,15 @@ import pickle
 from .utils import vectorize_select_from_data
 
 from .embeddings_dict import EmbeddingsDict
+from ...utils.tf_session import ModelGraph, in_model_graph, FrozenModel, freeze
+from ...utils.saving import atomic_open, keras_weights, write_keras_weights
 
 SEED = 23
 np.random.seed(SEED)
 tf.set_random_seed(SEED)
 
+GPU_OPTIONS = {'allow_growth': True, 'visible_device_list': '0'}
+
 class InsultsModel(object):
 
     def __init__(self, model_name, word_index, embedding_dict, opt):
@@ -47,8 +44,10 @@ class InsultsModel(object):
         self.pool_sizes = [int(x) for x in opt['pool_sizes_cnn'].split(' ')]
         self.model_type = None
         self.from_saved = False
+        self.model_graph = ModelGraph(self.opt, GPU_OPTIONS)
         np.random.seed(opt['model_seed'])
-        tf.set_random_seed(opt['model_seed'])
+        with self.model_graph.as_default():
+            tf.set_random_seed(opt['model_seed'])
 
         if self.model_name == 'cnn_word' or self.model_name == 'lstm_word':
             self.model_type = 'nn'
@@ -96,6 +95,7 @@ class InsultsModel(object):
         self.val_auc = 0.0
 
 
+    @in_model_graph
     def _init_from_scratch(self):
         if self.model_name == 'log_reg':
             self.model = self.log_reg_model()
@@ -112,6 +112,7 @@ class InsultsModel(object):
                                optimizer=optimizer,
                                metrics=['binary_accuracy'])
 
+    @in_model_graph
     def save(self, fname=None):
         """Save the parameters of the agent to a file."""
         fname = self.opt.get('model_file', None) if fname is None else fname
@@ -130,12 +131,51 @@ class InsultsModel(object):
             with open(fname + '_opt.json', 'w') as opt_file:
                 json.dump(self.opt, opt_file)
 
+    @in_model_graph
+    def save_snapshot(self, fname=None):
+        """Capture the state written by save and return a function writing it."""
+        fname = self.opt.get('model_file', None) if fname is None else fname
+        opt = copy.deepcopy(self.opt)
+        if self.model_type == 'nn':
+            weights = keras_weights(self.model)
+            write_items = self.embedding_dict.items_writer(fname) if fname else None
+        else:
+            model = pickle.dumps(self.model)
+
+        def write():
+            if not fname:
+                return
+            print("[ saving model: " + fname + " ]")
+            if self.model_type == 'nn':
+                write_keras_weights(fname + '.h5', weights)
+                write_items()
+            else:
+                with atomic_open(fname + '_cls.pkl', 'wb') as model_file:
+                    model_file.write(model)
+            with atomic_open(fname + '_opt.json') as opt_file:
+                json.dump(opt, opt_file)
+        return write
+
+    @in_model_graph
+    def export(self, fname=None):
+        """Write the inference-only artifact loaded with --frozen-model."""
+        fname = self.opt.get('model_file', None) if fname is None else fname
+        if self.model_type != 'nn':
+            print('[ {} is not a TensorFlow model, nothing to export ]'.format(self.model_name))
+            return
+        freeze(self.model_graph, self.model.inputs, self.model.outputs, fname, {K.learning_phase(): False})
+
+    @in_model_graph
     def _init_from_saved(self, fname):
+        frozen = self.opt.get('frozen_model')
 
         with open(fname + '_opt.json', 'r') as opt_file:
             self.opt = json.load(opt_file)
 
-        if self.model_type == 'nn':
+        if self.model_type == 'nn' and frozen:
+            print('[ Loading frozen model %s ]' % fname)
+            self.model = FrozenModel(self.model_graph, fname)
+        elif self.model_type == 'nn':
             if self.model_name == 'cnn_word':
                 self.model = self.cnn_word_model()
             if self.model_name == 'lstm_word':
@@ -174,29 +214,24 @@ class InsultsModel(object):
         return y
 
     def _batchify(self, batch, word_dict=None):
-        if self.model_type == 'nn':
-            question = []
-            for ex in batch:
-                question.append(ex['question'])
-            self.embedding_dict.add_items(question)
-            embedding_batch = self.create_batch(question)
-
-            if len(batch[0]) == 2:
-                y = [1 if ex['labels'][0] == 'Insult' else 0 for ex in batch]
-                return embedding_batch, y
-            else:
-                return embedding_batch
+        question = []
+        for ex in batch:
+            question.append(ex['question'])
+        x = self.batchify_texts(question)
+
+        if len(batch[0]) == 2:
+            y = [1 if ex['labels'][0] == 'Insult' else 0 for ex in batch]
+            return x, y
+        else:
+            return x
 
+    def batchify_texts(self, texts):
+        """Build model inputs from a list of texts."""
+        if self.model_type == 'nn':
+            self.embedding_dict.add_items(texts)
+            return self.create_batch(texts)
         if self.model_type == 'ngrams':
-            question = []
-            for ex in batch:
-                question.append(ex['question'])
-
-            if len(batch[0]) == 2:
-                y = [1 if ex['labels'][0] == 'Insult' else 0 for ex in batch]
-                return question, y
-            else:
-                return question
+            return texts
 
     def create_batch(self, sentence_li):
         embeddings_batch = []
@@ -217,6 +252,7 @@ class InsultsModel(object):
         embeddings_batch = np.asarray(embeddings_batch)
         return embeddings_batch
 
+    @in_model_graph
     def update(self, batch):
         x, y = batch
         y = np.array(y)
@@ -238,6 +274,7 @@ class InsultsModel(object):
         self.updates += 1
         return y_pred
 
+    @in_model_graph
     def predict(self, batch):
         if self.model_type == 'nn':
             y_pred = np.array(self.model.predict_on_batch(batch)).reshape(-1)
@@ -247,8 +284,16 @@ class InsultsModel(object):
             predictions = np.array(self.model.predict_proba(x)[:,1]).reshape(-1)
             return predictions
 
+    @in_model_graph
+    def make_predict_function(self):
+        """Build the predict function before several threads call predict."""
+        self.model._make_predict_function()
+
     def shutdown(self):
+        if self.embedding_dict is not None:
+            self.embedding_dict.release()
         self.embedding_dict = None
+        self.model_graph.close()
 
     def log_reg_model(self):
         model = linear_model.LogisticRegression(C=10.)
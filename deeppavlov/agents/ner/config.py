@@ -1,4 +1,8 @@
+from ...utils import tf_session
+
+
 def add_cmdline_args(parser):
+    tf_session.add_cmdline_args(parser)
     # Runtime environment
     agent = parser.add_argument_group('NER Agent Arguments')
     agent.add_argument('--pretrained-model', type=str)
@@ -39,9 +39,10 @@ class NERDictionaryAgent(DictionaryAgent):
         super().__init__(opt, shared)
 
     def observe(self, observation):
-        observation = copy.deepcopy(observation)
-        labels_observation = copy.deepcopy(observation)
+        # shallow copies, the values are shared with the teacher's observation
+        labels_observation = copy.copy(observation)
         labels_observation['text'] = None
+        observation = copy.copy(observation)
         observation['labels'] = None
         self.labels_dict.observe(labels_observation)
         return super().observe(observation)
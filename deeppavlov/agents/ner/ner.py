@@ -1,4 +1,5 @@
 import copy
+import threading
 import numpy as np
 from parlai.core.agents import Agent
 
@@ -6,6 +7,7 @@ from . import config
 from .dictionary import NERDictionaryAgent
 from .ner_tagger import NERTagger
 from .dictionary import get_char_dict
+from ...utils.parallel_eval import check_numthreads
 
 
 char_dict = get_char_dict()
@@ -13,6 +15,8 @@ char_dict = get_char_dict()
 
 class NERAgent(Agent):
 
+    thread_safe_share = True
+
     @staticmethod
     def dictionary_class():
         return NERDictionaryAgent
@@ -23,22 +27,36 @@ class NERAgent(Agent):
         NERAgent.dictionary_class().add_cmdline_args(argparser)
 
     def __init__(self, opt, shared=None):
+        check_numthreads(opt)
         self.id = 'NERAgent'
         self.episode_done = True
         self.loss = None
 
-        # Only create an empty dummy class when sharing
+        # Copies made for other threads use the network of the original agent
         if shared is not None:
             self.is_shared = True
+            self.word_dict = shared['word_dict']
+            self.network = shared['network']
+            self.lock = shared['lock']
+            super().__init__(opt, shared)
             return
         self.is_shared = False
         self.word_dict = NERAgent.dictionary_class()(opt)
         self.network = NERTagger(opt, self.word_dict)
+        # training steps are serialized, the session runs predictions concurrently
+        self.lock = threading.Lock()
 
         super().__init__(opt, shared)
 
+    def share(self):
+        shared = super().share()
+        shared['word_dict'] = self.word_dict
+        shared['network'] = self.network
+        shared['lock'] = self.lock
+        return shared
+
     def observe(self, observation):
-        observation = copy.deepcopy(observation)
+        observation = copy.copy(observation)
         if not self.episode_done:
             dialogue = self.observation['text'].split(' ')[:-1]
             dialogue.extend(observation['text'].split(' '))
@@ -50,15 +68,16 @@ class NERAgent(Agent):
     def act(self):
         return self.batch_act([self.observation])[0]
 
-    def batch_act(self, observations):
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
+    def prepare_batch(self, observations):
+        return self.batchify(observations)
 
-        batch = self.batchify(observations)
+    def batch_act(self, observations, batch=None):
+        if batch is None:
+            batch = self.batchify(observations)
         (x, xc), y = batch
         if 'labels' in observations[0]:
-
-            self.loss = self.network.train_on_batch(x, xc, y)
+            with self.lock:
+                self.loss = self.network.train_on_batch(x, xc, y)
             responses = self.network.predict(x, xc)
         else:
             responses = self.network.predict(x, xc)
@@ -71,30 +90,47 @@ class NERAgent(Agent):
 
         return batch_response
 
+    def predict(self, texts):
+        """Return space separated tags for a list of texts of space separated tokens."""
+        if not texts:
+            return []
+        (x, xc), _ = self.batchify_texts(texts)
+        responses = self.network.predict(x, xc)
+        lengths = [len(self.word_dict.txt2vec(text)) for text in texts]
+        return [self.word_dict.labels_dict.vec2txt(response[:n]) for response, n in zip(responses, lengths)]
+
     def batchify(self, observations):
-        batch_size = len(observations)
+        texts = []
+        tags = []
+        for observation in observations:
+            if 'text' in observation:
+                texts.append(observation['text'])
+                tags.append(observation['labels'][0] if 'labels' in observation else None)
+        return self.batchify_texts(texts, tags)
+
+    def batchify_texts(self, texts, tags=None):
+        """Build word and char index matrices and tag matrix for a list of texts."""
+        if tags is None:
+            tags = [None] * len(texts)
         x_list = []
         x_char_list = []
         y_list = []
         max_len = 0
         max_len_char = 0
-        for observation in observations:
-            if 'text' in observation:
-                text = observation['text']
-
-                current_char_list = []
-                tokens = text.split()
-                for token in tokens:
-                    characters = [self.word_dict.char_dict[ch] for ch in token]
-                    current_char_list.append(characters)
-                    max_len_char = max(max_len_char, len(token))
-                x_char_list.append(current_char_list)
-
-                tokens = self.word_dict.txt2vec(text)
-                tags = self.word_dict.labels_dict.txt2vec(observation['labels'][0]) if 'labels' in observation else None
-                max_len = max(len(tokens), max_len)
-                x_list.append(tokens)
-                y_list.append(tags)
+        for text, text_tags in zip(texts, tags):
+            current_char_list = []
+            tokens = text.split()
+            for token in tokens:
+                characters = [self.word_dict.char_dict[ch] for ch in token]
+                current_char_list.append(characters)
+                max_len_char = max(max_len_char, len(token))
+            x_char_list.append(current_char_list)
+
+            tokens = self.word_dict.txt2vec(text)
+            text_tags = self.word_dict.labels_dict.txt2vec(text_tags) if text_tags is not None else None
+            max_len = max(len(tokens), max_len)
+            x_list.append(tokens)
+            y_list.append(text_tags)
         # Handle the case of incomplete batch in the end of the dataset
         current_batch_size = len(x_list)
         x = np.ones([current_batch_size, max_len]) * self.word_dict[self.word_dict.null_token]
@@ -104,7 +140,8 @@ class NERAgent(Agent):
         for n, (x_item, x_char, y_item) in enumerate(zip(x_list, x_char_list, y_list)):
             n_tokens = len(x_item)
             x[n, :n_tokens] = x_item
-            y[n, :n_tokens] = y_item
+            if y_item is not None:
+                y[n, :n_tokens] = y_item
             for k, characters in enumerate(x_char):
                 xc[n, k, :len(characters)] = characters
         return (x, xc), y
@@ -119,6 +156,12 @@ class NERAgent(Agent):
             except BaseException:
                 print('[ WARN: Saving failed... continuing anyway. ]')
 
+    def export(self, fname=None):
+        """Export the network to the inference-only artifact loaded with --frozen-model."""
+        fname = self.opt.get('pretrained_model', None) if fname is None else fname
+        print("[ exporting model: " + fname + " ]")
+        self.network.export(fname)
+
     def load(self, fname=None):
         fname = self.opt.get('model_file', None) if fname is None else fname
         if fname:
@@ -130,6 +173,8 @@ class NERAgent(Agent):
 
     def shutdown(self):
         if not self.is_shared:
-            self.network.shutdown()
+            if self.network is not None:
+                self.network.shutdown()
+            self.network = None
 
 
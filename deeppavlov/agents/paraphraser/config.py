@@ -14,8 +14,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from ...utils import tf_session
+
 
 def add_cmdline_args(parser):
+    tf_session.add_cmdline_args(parser)
     # Runtime environment
     agent = parser.add_argument_group('Paraphraser Arguments')
     agent.add_argument('--no_cuda', type='bool', default=False)
@@ -32,6 +35,16 @@ def add_cmdline_args(parser):
                        help='fasttext trained model file name')
     agent.add_argument('-fed', '--fasttext_embeddings_dict', type=str, default=None,
                        help='saved fasttext embeddings dict')
+    agent.add_argument('--tokens_cache_size', type=int, default=100000,
+                       help='number of tokenized sentences kept in memory, 0 disables the cache')
+
+    # Distillation
+    agent.add_argument('--teacher_model_files', type=str, default=None, nargs='+',
+                       help='train on the averaged scores of these models instead of the labels')
+    agent.add_argument('--unlabeled_pairs_file', type=str, default=None,
+                       help='tab separated sentence pairs also scored by the teacher models and trained on')
+    agent.add_argument('--teacher_scores_cache_size', type=int, default=200000,
+                       help='number of teacher scores of sentence pairs kept in memory, 0 disables the cache')
 
 
 
@@ -16,26 +16,58 @@ limitations under the License.
 
 import os
 import copy
+import functools
+import threading
 import numpy as np
 import urllib.request
 import fasttext
 import nltk
 from nltk.tokenize import sent_tokenize, word_tokenize
 
+from ...utils import resources
+from ...utils.saving import atomic_open
+
+
+def download_punkt():
+    """Download the nltk sentence tokenizer unless it is installed."""
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        nltk.download('punkt')
+
+
+def tokenize(sentence):
+    """Tokens of the sentences of a text."""
+    sent_toks = sent_tokenize(sentence)
+    word_toks = [word_tokenize(el) for el in sent_toks]
+    tokens = [val for sublist in word_toks for val in sublist]
+    return tuple(el for el in tokens if el != '')
+
 
 class EmbeddingsDict(object):
     def __init__(self, opt, embedding_dim):
-        self.tok2emb = {}
         self.embedding_dim = embedding_dim
         self.opt = copy.deepcopy(opt)
-        self.load_items()
-
-        nltk.download('punkt')
+        # sentences come again every epoch, with a cache larger than the dataset
+        # every sentence is tokenized once per run
+        self.tokenize = functools.lru_cache(maxsize=self.opt.get('tokens_cache_size', 100000))(tokenize)
+        # embeddings of the tokens seen in batches as rows of one matrix, row 0 is padding
+        self.tok2index = {}
+        self.matrix = np.zeros((1024, self.embedding_dim), dtype=np.float32)
+        self.index_lock = threading.Lock()
 
         if not self.opt.get('fasttext_model'):
             raise RuntimeError('No pretrained fasttext model provided')
         self.fasttext_model_file = self.opt.get('fasttext_model')
-        if not os.path.isfile(self.fasttext_model_file):
+        # token embeddings depend only on the fasttext model, so dicts of all models share them
+        # the saved embeddings are read by the first dict only
+        self.tok2emb = resources.acquire('token embeddings', self.fasttext_model_file, self.load_items,
+                                         resources.dict_nbytes)
+
+        download_punkt()
+
+        if not resources.contains('fasttext', self.fasttext_model_file) and \
+                not os.path.isfile(self.fasttext_model_file):
             emb_path = os.environ.get('EMBEDDINGS_URL')
             if not emb_path:
                 raise RuntimeError('No pretrained fasttext model provided')
@@ -47,34 +79,73 @@ class EmbeddingsDict(object):
                 print('Downloaded a fasttext model')
             except Exception as e:
                 raise RuntimeError('Looks like the `EMBEDDINGS_URL` variable is set incorrectly', e)
-        self.fasttext_model = fasttext.load_model(self.fasttext_model_file)
+        self.fasttext_model = resources.acquire('fasttext', self.fasttext_model_file,
+                                                lambda: fasttext.load_model(self.fasttext_model_file),
+                                                resources.file_nbytes(self.fasttext_model_file))
+
+    def release(self):
+        """Release the shared fasttext model and token embeddings."""
+        if self.fasttext_model is None:
+            return
+        resources.release('fasttext', self.fasttext_model_file)
+        resources.release('token embeddings', self.fasttext_model_file)
+        self.fasttext_model = None
 
     def add_items(self, sentence_li):
-        for sen in sentence_li:
-            sent_toks = sent_tokenize(sen)
-            word_toks = [word_tokenize(el) for el in sent_toks]
-            tokens = [val for sublist in word_toks for val in sublist]
-            tokens = [el for el in tokens if el != '']
+        self.add_tokens([self.tokenize(sen) for sen in sentence_li])
+
+    def add_tokens(self, tokens_li):
+        """Add embeddings of the tokens of tokenized sentences."""
+        for tokens in tokens_li:
             for tok in tokens:
                 if self.tok2emb.get(tok) is None:
                     self.tok2emb[tok] = self.fasttext_model[tok]
+            missing = [tok for tok in tokens if tok not in self.tok2index]
+            if missing:
+                self._index_tokens(missing)
+
+    def _index_tokens(self, tokens):
+        with self.index_lock:
+            for tok in tokens:
+                if tok in self.tok2index:
+                    continue
+                index = len(self.tok2index) + 1
+                if index == len(self.matrix):
+                    # readers keep using the old matrix, its rows are still valid
+                    matrix = np.zeros((2 * len(self.matrix), self.embedding_dim), dtype=np.float32)
+                    matrix[:index] = self.matrix
+                    self.matrix = matrix
+                self.matrix[index] = self.tok2emb[tok]
+                self.tok2index[tok] = index
+
+    def token_ids(self, tokens):
+        """Rows of matrix holding the embeddings of tokens added with add_tokens."""
+        return [self.tok2index[tok] for tok in tokens]
 
     def save_items(self, fname):
+        self.items_writer(fname)()
+
+    def items_writer(self, fname):
+        """Snapshot of the embeddings and a function saving it, see saving.AsyncSaver."""
         if self.opt.get('fasttext_embeddings_dict') is not None:
             fname = self.opt['fasttext_embeddings_dict']
         else:
             fname += '.emb'
-        f = open(fname, 'w')
-        string = '\n'.join([el[0] + ' ' + self.emb2str(el[1]) for el in self.tok2emb.items()])
-        f.write(string)
-        f.close()
+        # embeddings are only added, a shallow copy keeps the saved ones intact
+        items = list(self.tok2emb.items())
+
+        def write():
+            with atomic_open(fname) as f:
+                f.write('\n'.join([el[0] + ' ' + self.emb2str(el[1]) for el in items]))
+        return write
 
     def emb2str(self, vec):
         string = ' '.join([str(el) for el in vec])
         return string
 
     def load_items(self):
-        """Initialize embeddings from file."""
+        """Embeddings of tokens read from file."""
+        tok2emb = {}
         fname = None
         if self.opt.get('fasttext_embeddings_dict') is not None:
             fname = self.opt['fasttext_embeddings_dict']
@@ -93,4 +164,5 @@ class EmbeddingsDict(object):
                     assert(len(values) == self.embedding_dim + 1)
                     word = values[0]
                     coefs = np.asarray(values[1:], dtype='float32')
-                    self.tok2emb[word] = coefs
\ No newline at end of file
+                    tok2emb[word] = coefs
+        return tok2emb
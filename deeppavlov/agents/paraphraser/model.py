@@ -18,28 +18,28 @@ import os
 import numpy as np
 import copy
 import json
-import tensorflow as tf
-from keras.backend.tensorflow_backend import set_session
-config = tf.ConfigProto()
-config.gpu_options.per_process_gpu_memory_fraction = 0.8
-config.gpu_options.visible_device_list = '0'
-set_session(tf.Session(config=config))
 
 from .metrics import fbeta_score
 from .embeddings_dict import EmbeddingsDict
-from keras.layers import Dense, Activation, Input, LSTM, Dropout, multiply, Lambda
+from keras.layers import Dense, Activation, Input, LSTM, Dropout, multiply, Lambda, average
 from keras.models import Model
 from keras.layers.wrappers import Bidirectional
 from keras.initializers import glorot_uniform, Orthogonal
 from keras import backend as K
 from keras.optimizers import Adam
-from nltk.tokenize import sent_tokenize, word_tokenize
+
+from ...utils.tf_session import ModelGraph, in_model_graph, FrozenModel, freeze
+from ...utils.saving import atomic_open, keras_weights, write_keras_weights
+
+GPU_OPTIONS = {'per_process_gpu_memory_fraction': 0.8, 'visible_device_list': '0'}
 
 
 class ParaphraserModel(object):
 
-    def __init__(self, opt, embdict=None):
+    def __init__(self, opt, embdict=None, model_graph=None):
         self.opt = copy.deepcopy(opt)
+        # models of a stacked ensemble are built in one graph
+        self.model_graph = model_graph if model_graph is not None else ModelGraph(self.opt, GPU_OPTIONS)
 
         if self.opt.get('pretrained_model'):
             self._init_from_saved()
@@ -70,8 +70,10 @@ class ParaphraserModel(object):
         self.val_f1 = 0.0
 
     def shutdown(self):
+        if self.embdict is not None:
+            self.embdict.release()
         self.embdict = None
-        # tf.reset_default_graph()
+        self.model_graph.close()
 
     def _init_params(self, param_dict=None):
         if param_dict is None:
@@ -97,6 +99,7 @@ class ParaphraserModel(object):
         self.inpdropagg_val = param_dict['inpdropagg_val']
         self.model_name = param_dict['model_name']
 
+    @in_model_graph
     def _init_from_scratch(self):
         if self.model_name == 'bmwacor':
             self.model = self.bmwacor_model()
@@ -117,12 +120,28 @@ class ParaphraserModel(object):
                            optimizer=optimizer,
                            metrics=['accuracy', fbeta_score])
 
+    @in_model_graph
     def save(self, fname):
         self.model.save_weights(fname+'.h5')
         with open(fname+'.json', 'w') as f:
             json.dump(self.opt, f)
         self.embdict.save_items(fname)
 
+    @in_model_graph
+    def save_snapshot(self, fname):
+        """Capture the state written by save and return a function writing it."""
+        weights = keras_weights(self.model)
+        opt = copy.deepcopy(self.opt)
+        write_items = self.embdict.items_writer(fname)
+
+        def write():
+            write_keras_weights(fname + '.h5', weights)
+            with atomic_open(fname + '.json') as f:
+                json.dump(opt, f)
+            write_items()
+        return write
+
+    @in_model_graph
     def _init_from_saved(self):
         fname = self.opt['pretrained_model']
         print('[ Loading model %s ]' % fname)
@@ -133,21 +152,38 @@ class ParaphraserModel(object):
         else:
             print('Error. There is no %s.json file provided.' % fname)
             exit()
-        if os.path.isfile(fname+'.h5'):
+        if self.opt.get('frozen_model'):
+            print('[ Loading frozen model %s ]' % fname)
+            self.model = FrozenModel(self.model_graph, fname)
+        elif os.path.isfile(fname+'.h5'):
             self._init_from_scratch()
             self.model.load_weights(fname+'.h5')
         else:
             print('Error. There is no %s.h5 file provided.' % fname)
             exit()
 
+    @in_model_graph
     def update(self, batch):
         x, y = batch
         self.train_loss, self.train_acc, self.train_f1 = self.model.train_on_batch(x, y)
         self.updates += 1
 
+    @in_model_graph
     def predict(self, batch):
         return self.model.predict_on_batch(batch)
 
+    @in_model_graph
+    def export(self, fname):
+        """Write the inference-only artifact loaded with --frozen-model."""
+        freeze(self.model_graph, self.model.inputs, self.model.outputs, fname, {K.learning_phase(): False})
+        with open(fname+'.json', 'w') as f:
+            json.dump(self.opt, f)
+
+    @in_model_graph
+    def make_predict_function(self):
+        """Build the predict function before several threads call predict."""
+        self.model._make_predict_function()
+
     def build_ex(self, ex):
         if 'text' not in ex:
             return
@@ -169,36 +205,34 @@ class ParaphraserModel(object):
         for ex in batch:
             question1.append(ex['question1'])
             question2.append(ex['question2'])
-        self.embdict.add_items(question1)
-        self.embdict.add_items(question2)
-        b1 = self.create_batch(question1)
-        b2 = self.create_batch(question2)
+        questions = self.batchify_questions(question1, question2)
 
         if len(batch[0]) == 3:
             y = [1 if ex['labels'][0] == 'Да' else 0 for ex in batch]
-            return [b1, b2], y
+            return questions, y
         else:
-            return [b1, b2], None
-
-    def create_batch(self, sentence_li):
-        embeddings_batch = []
-        for sen in sentence_li:
-            embeddings = []
-            sent_toks = sent_tokenize(sen)
-            word_toks = [word_tokenize(el) for el in sent_toks]
-            tokens = [val for sublist in word_toks for val in sublist]
-            tokens = [el for el in tokens if el != '']
-            for tok in tokens:
-                embeddings.append(self.embdict.tok2emb.get(tok))
-            if len(tokens) < self.max_sequence_length:
-                pads = [np.zeros(self.embedding_dim) for _ in range(self.max_sequence_length - len(tokens))]
-                embeddings = pads + embeddings
-            else:
-                embeddings = embeddings[-self.max_sequence_length:]
-            embeddings = np.asarray(embeddings)
-            embeddings_batch.append(embeddings)
-        embeddings_batch = np.asarray(embeddings_batch)
-        return embeddings_batch
+            return questions, None
+
+    def batchify_questions(self, question1, question2):
+        """Build model inputs from two lists of sentences."""
+        tokens1 = [self.embdict.tokenize(sen) for sen in question1]
+        tokens2 = [self.embdict.tokenize(sen) for sen in question2]
+        self.embdict.add_tokens(tokens1)
+        self.embdict.add_tokens(tokens2)
+        b1 = self.create_batch(tokens1)
+        b2 = self.create_batch(tokens2)
+        return [b1, b2]
+
+    def create_batch(self, tokens_li):
+        """Embeddings of tokenized sentences as a float32 array, left padded
+        with zeros or truncated to the last max_sequence_length tokens.
+        """
+        ids = np.zeros((len(tokens_li), self.max_sequence_length), dtype=np.int64)
+        for i, tokens in enumerate(tokens_li):
+            tokens = tokens[-self.max_sequence_length:]
+            if tokens:
+                ids[i, -len(tokens):] = self.embdict.token_ids(tokens)
+        return self.embdict.matrix.take(ids, axis=0)
 
     def create_lstm_layer(self, input_dim):
         inp = Input(shape=(input_dim, self.embedding_dim,))
@@ -375,102 +409,82 @@ class ParaphraserModel(object):
         shape1, shape2 = shapes
         return shape1[0], 2*shape1[1]
 
-    def create_full_matching_layer_f(self, input_dim_a, input_dim_b):
-        inp_a = Input(shape=(input_dim_a, self.hidden_dim,))
-        inp_b = Input(shape=(input_dim_b, self.hidden_dim,))
+    def perspective_weights(self):
+        """Weights of all perspectives as one [perspective_num, hidden_dim] tensor.
+        Every row is drawn as the weights of a single perspective used to be,
+        so saved models match the same way.
+        """
         W = []
         for i in range(self.perspective_num):
             wi = K.random_uniform_variable((1, self.hidden_dim), -1.0, 1.0,
                                            seed=self.seed if self.seed is not None else 243)
             W.append(wi)
+        return K.concatenate(W, 0)
+
+    def weight_perspectives(self, inp, W):
+        """Inputs [batch, time, hidden] weighted by every perspective and l2 normalized,
+        [batch, perspective, time, hidden].
+        """
+        return K.l2_normalize(K.expand_dims(inp, 1) * K.expand_dims(W, 1), -1)
+
+    def match_all(self, inputs, W):
+        """Cosine similarities of all pairs of time steps of a and b in every perspective,
+        [batch, perspective, time a, time b].
+        """
+        inp_a, inp_b = inputs
+        return K.batch_dot(self.weight_perspectives(inp_a, W),
+                           self.weight_perspectives(inp_b, W), axes=[3, 3])
+
+    def match_aligned(self, inputs, W):
+        """Cosine similarities of the same time steps of a and b in every perspective,
+        [batch, time, perspective].
+        """
+        inp_a, inp_b = inputs
+        outp = K.sum(self.weight_perspectives(inp_a, W) * self.weight_perspectives(inp_b, W), -1)
+        return K.permute_dimensions(outp, (0, 2, 1))
+
+    def create_full_matching_layer_f(self, input_dim_a, input_dim_b):
+        inp_a = Input(shape=(input_dim_a, self.hidden_dim,))
+        inp_b = Input(shape=(input_dim_b, self.hidden_dim,))
+        W = self.perspective_weights()
 
         val = np.concatenate((np.zeros((self.max_sequence_length-1,1)), np.ones((1,1))), axis=0)
         kcon = K.constant(value=val, dtype='float32')
         inp_b_perm = Lambda(lambda x: K.permute_dimensions(x, (0,2,1)))(inp_b)
         last_state = Lambda(lambda x: K.permute_dimensions(K.dot(x, kcon), (0,2,1)))(inp_b_perm)
-        m = []
-        for i in range(self.perspective_num):
-            outp_a = Lambda(lambda x: x * W[i])(inp_a)
-            outp_last = Lambda(lambda x: x * W[i])(last_state)
-            outp_a = Lambda(lambda x: K.l2_normalize(x, -1))(outp_a)
-            outp_last = Lambda(lambda x: K.l2_normalize(x, -1))(outp_last)
-            outp_last = Lambda(lambda x: K.permute_dimensions(x, (0,2,1)))(outp_last)
-            outp = Lambda(lambda x: K.batch_dot(x[0], x[1], axes=[1, 2]))([outp_last, outp_a])
-            outp = Lambda(lambda x: K.permute_dimensions(x, (0,2,1)))(outp)
-            m.append(outp)
-        if self.perspective_num > 1:
-            persp = Lambda(lambda x: K.concatenate(x, 2))(m)
-        else:
-            persp = m
+        persp = Lambda(lambda x: K.permute_dimensions(K.squeeze(self.match_all(x, W), -1), (0,2,1)))(
+            [inp_a, last_state])
         model = Model(inputs=[inp_a, inp_b], outputs=persp)
         return model
 
     def create_full_matching_layer_b(self, input_dim_a, input_dim_b):
         inp_a = Input(shape=(input_dim_a, self.hidden_dim,))
         inp_b = Input(shape=(input_dim_b, self.hidden_dim,))
-        W = []
-        for i in range(self.perspective_num):
-            wi = K.random_uniform_variable((1, self.hidden_dim), -1.0, 1.0,
-                                           seed=self.seed if self.seed is not None else 243)
-            W.append(wi)
+        W = self.perspective_weights()
 
         val = np.concatenate((np.ones((1, 1)), np.zeros((self.max_sequence_length - 1, 1))), axis=0)
         kcon = K.constant(value=val, dtype='float32')
         inp_b_perm = Lambda(lambda x: K.permute_dimensions(x, (0, 2, 1)))(inp_b)
         last_state = Lambda(lambda x: K.permute_dimensions(K.dot(x, kcon), (0, 2, 1)))(inp_b_perm)
-        m = []
-        for i in range(self.perspective_num):
-            outp_a = Lambda(lambda x: x * W[i])(inp_a)
-            outp_last = Lambda(lambda x: x * W[i])(last_state)
-            outp_a = Lambda(lambda x: K.l2_normalize(x, -1))(outp_a)
-            outp_last = Lambda(lambda x: K.l2_normalize(x, -1))(outp_last)
-            outp_last = Lambda(lambda x: K.permute_dimensions(x, (0, 2, 1)))(outp_last)
-            outp = Lambda(lambda x: K.batch_dot(x[0], x[1], axes=[1, 2]))([outp_last, outp_a])
-            outp = Lambda(lambda x: K.permute_dimensions(x, (0, 2, 1)))(outp)
-            m.append(outp)
-        if self.perspective_num > 1:
-            persp = Lambda(lambda x: K.concatenate(x, 2))(m)
-        else:
-            persp = m
+        persp = Lambda(lambda x: K.permute_dimensions(K.squeeze(self.match_all(x, W), -1), (0, 2, 1)))(
+            [inp_a, last_state])
         model = Model(inputs=[inp_a, inp_b], outputs=persp)
         return model
 
     def create_maxpool_matching_layer(self, input_dim_a, input_dim_b):
         inp_a = Input(shape=(input_dim_a, self.hidden_dim,))
         inp_b = Input(shape=(input_dim_b, self.hidden_dim,))
-        W = []
-        for i in range(self.perspective_num):
-            wi = K.random_uniform_variable((1, self.hidden_dim), -1.0, 1.0,
-                                           seed=self.seed if self.seed is not None else 243)
-            W.append(wi)
+        W = self.perspective_weights()
 
-        m = []
-        for i in range(self.perspective_num):
-            outp_a = Lambda(lambda x: x * W[i])(inp_a)
-            outp_b = Lambda(lambda x: x * W[i])(inp_b)
-            outp_a = Lambda(lambda x: K.l2_normalize(x, -1))(outp_a)
-            outp_b = Lambda(lambda x: K.l2_normalize(x, -1))(outp_b)
-            outp_b = Lambda(lambda x: K.permute_dimensions(x, (0,2,1)))(outp_b)
-            outp = Lambda(lambda x: K.batch_dot(x[0], x[1], axes=[1, 2]))([outp_b, outp_a])
-            outp = Lambda(lambda x: K.permute_dimensions(x, (0,2,1)))(outp)
-            outp = Lambda(lambda x: K.max(x, -1, keepdims=True))(outp)
-            m.append(outp)
-        if self.perspective_num > 1:
-            persp = Lambda(lambda x: K.concatenate(x, 2))(m)
-        else:
-            persp = m
+        persp = Lambda(lambda x: K.permute_dimensions(K.max(self.match_all(x, W), -1), (0,2,1)))(
+            [inp_a, inp_b])
         model = Model(inputs=[inp_a, inp_b], outputs=persp)
         return model
 
     def create_att_matching_layer(self, input_dim_a, input_dim_b):
         inp_a = Input(shape=(input_dim_a, self.hidden_dim,))
         inp_b = Input(shape=(input_dim_b, self.hidden_dim,))
-
-        w = []
-        for i in range(self.perspective_num):
-            wi = K.random_uniform_variable((1, self.hidden_dim), -1.0, 1.0,
-                                           seed=self.seed if self.seed is not None else 243)
-            w.append(wi)
+        w = self.perspective_weights()
 
         outp_a = Lambda(lambda x: K.l2_normalize(x, -1))(inp_a)
         outp_b = Lambda(lambda x: K.l2_normalize(x, -1))(inp_b)
@@ -479,34 +493,14 @@ class ParaphraserModel(object):
         alpha = Lambda(lambda x: K.l2_normalize(x, 1))(alpha)
         hmean = Lambda(lambda x: K.batch_dot(x[0], x[1], axes=[1, 2]))([alpha, outp_b])
 
-        m = []
-        for i in range(self.perspective_num):
-            outp_a = Lambda(lambda x: x * w[i])(inp_a)
-            outp_hmean = Lambda(lambda x: x * w[i])(hmean)
-            outp_a = Lambda(lambda x: K.l2_normalize(x, -1))(outp_a)
-            outp_hmean = Lambda(lambda x: K.l2_normalize(x, -1))(outp_hmean)
-            outp_hmean = Lambda(lambda x: K.permute_dimensions(x, (0, 2, 1)))(outp_hmean)
-            outp = Lambda(lambda x: K.batch_dot(x[0], x[1], axes=[1, 2]))([outp_hmean, outp_a])
-            val = np.eye(self.max_sequence_length)
-            kcon = K.constant(value=val, dtype='float32')
-            outp = Lambda(lambda x: K.sum(x * kcon, -1, keepdims=True))(outp)
-            m.append(outp)
-        if self.perspective_num > 1:
-            persp = Lambda(lambda x: K.concatenate(x, 2))(m)
-        else:
-            persp = m
+        persp = Lambda(lambda x: self.match_aligned(x, w))([inp_a, hmean])
         model = Model(inputs=[inp_a, inp_b], outputs=persp)
         return model
 
     def create_maxatt_matching_layer(self, input_dim_a, input_dim_b):
         inp_a = Input(shape=(input_dim_a, self.hidden_dim,))
         inp_b = Input(shape=(input_dim_b, self.hidden_dim,))
-
-        W = []
-        for i in range(self.perspective_num):
-            wi = K.random_uniform_variable((1, self.hidden_dim), -1.0, 1.0,
-                                           seed=self.seed if self.seed is not None else 243)
-            W.append(wi)
+        W = self.perspective_weights()
 
         outp_a = Lambda(lambda x: K.l2_normalize(x, -1))(inp_a)
         outp_b = Lambda(lambda x: K.l2_normalize(x, -1))(inp_b)
@@ -515,22 +509,7 @@ class ParaphraserModel(object):
         alpha = Lambda(lambda x: K.one_hot(K.argmax(x, 1), self.max_sequence_length))(alpha)
         hmax = Lambda(lambda x: K.batch_dot(x[0], x[1], axes=[1, 2]))([alpha, outp_b])
 
-        m = []
-        for i in range(self.perspective_num):
-            outp_a = Lambda(lambda x: x * W[i])(inp_a)
-            outp_hmax = Lambda(lambda x: x * W[i])(hmax)
-            outp_a = Lambda(lambda x: K.l2_normalize(x, -1))(outp_a)
-            outp_hmax = Lambda(lambda x: K.l2_normalize(x, -1))(outp_hmax)
-            outp_hmax = Lambda(lambda x: K.permute_dimensions(x, (0, 2, 1)))(outp_hmax)
-            outp = Lambda(lambda x: K.batch_dot(x[0], x[1], axes=[1, 2]))([outp_hmax, outp_a])
-            val = np.eye(self.max_sequence_length)
-            kcon = K.constant(value=val, dtype='float32')
-            outp = Lambda(lambda x: K.sum(x * kcon, -1, keepdims=True))(outp)
-            m.append(outp)
-        if self.perspective_num > 1:
-            persp = Lambda(lambda x: K.concatenate(x, 2))(m)
-        else:
-            persp = m
+        persp = Lambda(lambda x: self.match_aligned(x, W))([inp_a, hmax])
         model = Model(inputs=[inp_a, inp_b], outputs=persp)
         return model
 
@@ -842,3 +821,60 @@ class ParaphraserModel(object):
         model = Model([input_a, input_b], dense)
 
         return model
+
+
+class StackedParaphraserModel(object):
+    """Fold models run as one graph: the inputs are built once and fed to all
+    models, the graph outputs their averaged score. The models may differ in
+    model_name but must take inputs of the same shape.
+    """
+
+    def __init__(self, opt, model_files, embdict=None):
+        self.opt = copy.deepcopy(opt)
+        self.model_graph = ModelGraph(self.opt, GPU_OPTIONS)
+        self.embdict = embdict if embdict is not None else EmbeddingsDict(opt, opt.get('embedding_dim'))
+        self.folds = []
+        for model_file in model_files:
+            fold_opt = copy.deepcopy(opt)
+            fold_opt['pretrained_model'] = model_file
+            # a frozen graph can not be called on the shared inputs
+            fold_opt['frozen_model'] = False
+            self.folds.append(ParaphraserModel(fold_opt, self.embdict, self.model_graph))
+        shapes = set((fold.max_sequence_length, fold.embedding_dim) for fold in self.folds)
+        if len(shapes) != 1:
+            raise ValueError('Models of a stacked ensemble must take inputs of the same shape, '
+                             'got (max_sequence_length, embedding_dim) {}'.format(sorted(shapes)))
+        self.max_sequence_length, self.embedding_dim = shapes.pop()
+        self._stack()
+
+    @in_model_graph
+    def _stack(self):
+        inputs = [Input(shape=(self.max_sequence_length, self.embedding_dim,)) for _ in range(2)]
+        scores = [fold.model(inputs) for fold in self.folds]
+        outputs = average(scores) if len(scores) > 1 else scores[0]
+        self.model = Model(inputs=inputs, outputs=outputs)
+
+    def build_ex(self, ex):
+        return self.folds[0].build_ex(ex)
+
+    def batchify(self, batch):
+        return self.folds[0].batchify(batch)
+
+    def batchify_questions(self, question1, question2):
+        return self.folds[0].batchify_questions(question1, question2)
+
+    @in_model_graph
+    def predict(self, batch):
+        return self.model.predict_on_batch(batch)
+
+    @in_model_graph
+    def make_predict_function(self):
+        """Build the predict function before several threads call predict."""
+        self.model._make_predict_function()
+
+    def shutdown(self):
+        if self.embdict is not None:
+            self.embdict.release()
+        self.embdict = None
+        self.folds = []
+        self.model_graph.close()
@@ -14,13 +14,17 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
 import copy
+import threading
 
+import numpy as np
 from parlai.core.agents import Agent
 
 from . import config
 from .embeddings_dict import EmbeddingsDict
-from .model import ParaphraserModel
+from .model import ParaphraserModel, StackedParaphraserModel
+from ...utils.parallel_eval import check_numthreads
 
 
 def prediction2text(prediction):
@@ -31,33 +35,64 @@ def predictions2text(predictions):
     return [prediction2text(ex) for ex in predictions]
 
 
+def read_pairs(fname):
+    """Sentence pairs of a file with a tab separated pair on every line."""
+    pairs = []
+    with open(fname, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2:
+                pairs.append((fields[0], fields[1]))
+    return pairs
+
+
 class EnsembleParaphraserAgent(Agent):
 
+    thread_safe_share = True
+
     @staticmethod
     def add_cmdline_args(argparser):
         config.add_cmdline_args(argparser)
         ensemble = argparser.add_argument_group('Ensemble parameters')
         ensemble.add_argument('--model_files', type=str, default=None, nargs='+',
                               help='list of all the model files for the ensemble')
+        ensemble.add_argument('--stacked_ensemble', type='bool', default=False,
+                              help='run all the models as one graph on inputs built once, '
+                                   'the models must take inputs of the same shape')
 
     def __init__(self, opt, shared=None):
+        check_numthreads(opt)
         self.id = 'ParaphraserAgent'
         self.episode_done = True
         super().__init__(opt, shared)
         if shared is not None:
             self.is_shared = True
+            self.models = shared['models']
             return
 
         # Set up params/logging/dicts
         self.is_shared = False
         embdict = EmbeddingsDict(opt, opt.get('embedding_dim'))
         self.models = []
+        if opt.get('stacked_ensemble'):
+            # a single model averaging the scores of all the models
+            self.models.append(StackedParaphraserModel(opt, opt.get('model_files', []), embdict))
+            return
         for model_file in opt.get('model_files', []):
             opt['pretrained_model'] = model_file
             self.models.append(ParaphraserModel(opt, embdict))
 
+    def share(self):
+        """Share the models with copies of the agent acting in other threads."""
+        shared = super().share()
+        shared['models'] = self.models
+        for model in self.models:
+            # build the predict function before other threads call predict
+            model.make_predict_function()
+        return shared
+
     def observe(self, observation):
-        observation = copy.deepcopy(observation)
+        observation = copy.copy(observation)
         if not self.episode_done:
             # if the last example wasn't the end of an episode, then we need to
             # recall what was said in that example
@@ -71,21 +106,28 @@ class EnsembleParaphraserAgent(Agent):
         # call batch_act with this batch of one
         return self.batch_act([self.observation])[0]
 
-    def batch_act(self, observations):
+    def prepare_batch(self, observations):
+        """Build inputs of every model for a batch of observations."""
+        batches = []
+        for model in self.models:
+            examples = [model.build_ex(obs) for obs in observations]
+            valid_inds = [i for i in range(len(observations)) if examples[i] is not None]
+            examples = [ex for ex in examples if ex is not None]
+            batch, _ = model.batchify(examples)
+            batches.append((valid_inds, batch))
+        return batches
+
+    def batch_act(self, observations, batch=None):
 
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
+        if batch is None:
+            batch = self.prepare_batch(observations)
 
         batch_size = len(observations)
         # initialize a table of replies with this agent's id
         batch_reply = [{'id': self.getID()} for _ in range(batch_size)]
         predictions = [[] for _ in range(batch_size)]
-        for model in self.models:
-            examples = [model.build_ex(obs) for obs in observations]
-            valid_inds = [i for i in range(batch_size) if examples[i] is not None]
-            examples = [ex for ex in examples if ex is not None]
-            batch, _ = model.batchify(examples)
-            prediction = model.predict(batch)
+        for model, (valid_inds, model_batch) in zip(self.models, batch):
+            prediction = model.predict(model_batch)
             for i in range(len(prediction)):
                 predictions[valid_inds[i]].append(prediction[i])
         for i in range(batch_size):
@@ -96,28 +138,79 @@ class EnsembleParaphraserAgent(Agent):
 
         return batch_reply
 
+    def predict(self, pairs):
+        """Return paraphrase probabilities averaged over the ensemble
+        for a list of (sentence, sentence) pairs.
+        """
+        if not pairs:
+            return np.array([])
+        question1, question2 = (list(q) for q in zip(*pairs))
+        predictions = [model.predict(model.batchify_questions(question1, question2)).reshape(-1)
+                       for model in self.models]
+        return sum(predictions) / len(predictions)
+
+    def shutdown(self):
+        if not self.is_shared:
+            for model in self.models:
+                model.shutdown()
+            self.models = []
+
 
 class ParaphraserAgent(Agent):
 
+    thread_safe_share = True
+
     @staticmethod
     def add_cmdline_args(argparser):
         config.add_cmdline_args(argparser)
 
     def __init__(self, opt, shared=None):
+        check_numthreads(opt)
         self.id = 'ParaphraserAgent'
         self.episode_done = True
         super().__init__(opt, shared)
+        self.n_examples = 0
         if shared is not None:
             self.is_shared = True
+            self.model = shared['model']
+            self.lock = shared['lock']
+            self.teacher = shared['teacher']
+            self.teacher_scores = shared['teacher_scores']
+            self.unlabeled = shared['unlabeled']
             return
 
         # Set up params/logging/dicts
         self.is_shared = False
         self.model = ParaphraserModel(opt)
-        self.n_examples = 0
+        # updates of the model are serialized, predictions run concurrently
+        self.lock = threading.Lock()
+
+        # distillation: the model learns the averaged scores of an ensemble
+        self.teacher = None
+        self.teacher_scores = collections.OrderedDict()
+        self.unlabeled = {'pairs': [], 'next': 0}
+        if opt.get('teacher_model_files') and not opt.get('pretrained_model'):
+            teacher_opt = copy.deepcopy(opt)
+            teacher_opt['model_files'] = opt['teacher_model_files']
+            self.teacher = EnsembleParaphraserAgent(teacher_opt)
+            if opt.get('unlabeled_pairs_file'):
+                self.unlabeled['pairs'] = read_pairs(opt['unlabeled_pairs_file'])
+                print('[ {} unlabeled pairs for distillation ]'.format(len(self.unlabeled['pairs'])))
+
+    def share(self):
+        """Share the model with copies of the agent acting in other threads."""
+        shared = super().share()
+        shared['model'] = self.model
+        shared['lock'] = self.lock
+        shared['teacher'] = self.teacher
+        shared['teacher_scores'] = self.teacher_scores
+        shared['unlabeled'] = self.unlabeled
+        # build the predict function before other threads call predict
+        self.model.make_predict_function()
+        return shared
 
     def observe(self, observation):
-        observation = copy.deepcopy(observation)
+        observation = copy.copy(observation)
         if not self.episode_done:
             # if the last example wasn't the end of an episode, then we need to
             # recall what was said in that example
@@ -131,22 +224,34 @@ class ParaphraserAgent(Agent):
         # call batch_act with this batch of one
         return self.batch_act([self.observation])[0]
 
-    def batch_act(self, observations):
+    def prepare_batch(self, observations):
+        """Build model inputs for a batch of observations."""
+        examples = [self.model.build_ex(obs) for obs in observations]
+        valid_inds = [i for i in range(len(observations)) if examples[i] is not None]
+        examples = [ex for ex in examples if ex is not None]
+        return valid_inds, self.model.batchify(examples)
+
+    def batch_act(self, observations, batch=None):
 
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
+        if batch is None:
+            batch = self.prepare_batch(observations)
+        valid_inds, batch = batch
 
         batch_size = len(observations)
         # initialize a table of replies with this agent's id
         batch_reply = [{'id': self.getID()} for _ in range(batch_size)]
-        examples = [self.model.build_ex(obs) for obs in observations]
-        valid_inds = [i for i in range(batch_size) if examples[i] is not None]
-        examples = [ex for ex in examples if ex is not None]
-        batch = self.model.batchify(examples)
 
         if 'labels' in observations[0] and not self.opt.get('pretrained_model'):
-            self.n_examples += len(examples)
-            self.model.update(batch)
+            self.n_examples += len(valid_inds)
+            if self.teacher is not None:
+                examples = [self.model.build_ex(observations[i]) for i in valid_inds]
+                pairs = [(ex['question1'], ex['question2']) for ex in examples]
+            with self.lock:
+                if self.teacher is not None:
+                    batch = batch[0], self.soft_targets(pairs)
+                self.model.update(batch)
+            if self.unlabeled['pairs']:
+                self.update_unlabeled(len(valid_inds))
         else:
             batch, _ = batch
             predictions = self.model.predict(batch)
@@ -157,6 +262,36 @@ class ParaphraserAgent(Agent):
 
         return batch_reply
 
+    def predict(self, pairs):
+        """Return paraphrase probabilities for a list of (sentence, sentence) pairs."""
+        if not pairs:
+            return np.array([])
+        question1, question2 = (list(q) for q in zip(*pairs))
+        return self.model.predict(self.model.batchify_questions(question1, question2)).reshape(-1)
+
+    def soft_targets(self, pairs):
+        """Averaged scores of the teacher models, the scores of the last
+        teacher_scores_cache_size pairs are kept. Called under the lock.
+        """
+        scores = {pair: self.teacher_scores[pair] for pair in set(pairs) if pair in self.teacher_scores}
+        missing = [pair for pair in set(pairs) if pair not in scores]
+        if missing:
+            for pair, score in zip(missing, self.teacher.predict(missing)):
+                scores[pair] = self.teacher_scores[pair] = float(score)
+            while len(self.teacher_scores) > self.opt.get('teacher_scores_cache_size', 200000):
+                self.teacher_scores.popitem(last=False)
+        return np.array([scores[pair] for pair in pairs])
+
+    def update_unlabeled(self, batch_size):
+        """Train on the soft targets of the next batch of unlabeled pairs."""
+        with self.lock:
+            pairs = self.unlabeled['pairs']
+            start = self.unlabeled['next']
+            batch = [pairs[(start + i) % len(pairs)] for i in range(batch_size)]
+            self.unlabeled['next'] = (start + batch_size) % len(pairs)
+            question1, question2 = (list(q) for q in zip(*batch))
+            self.model.update((self.model.batchify_questions(question1, question2), self.soft_targets(batch)))
+
     def save(self, fname=None):
         """Save the parameters of the agent to a file."""
         fname = self.opt.get('model_file', None) if fname is None else fname
@@ -164,6 +299,25 @@ class ParaphraserAgent(Agent):
             print("[ saving model: " + fname + " ]")
             self.model.save(fname)
 
+    def save_snapshot(self, fname=None):
+        """Capture the parameters saved by save and return a function writing them."""
+        fname = self.opt.get('model_file', None) if fname is None else fname
+        if not fname:
+            return lambda: None
+        with self.lock:
+            write_model = self.model.save_snapshot(fname)
+
+        def write():
+            print("[ saving model: " + fname + " ]")
+            write_model()
+        return write
+
+    def export(self, fname=None):
+        """Export the model to the inference-only artifact loaded with --frozen-model."""
+        fname = self.opt.get('pretrained_model', None) if fname is None else fname
+        print("[ exporting model: " + fname + " ]")
+        self.model.export(fname)
+
     def report(self):
         return (
             '[train] updates = %d | exs = %d | loss = %.4f | acc = %.4f | f1 = %.4f'%
@@ -176,6 +330,9 @@ class ParaphraserAgent(Agent):
 
     def shutdown(self):
         if not self.is_shared:
+            if self.teacher is not None:
+                self.teacher.shutdown()
+            self.teacher = None
             if self.model is not None:
                 self.model.shutdown()
             self.model = None
@@ -2,7 +2,10 @@ import os
 import sys
 import logging
 
+from ...utils import tf_session
+
 def add_cmdline_args(parser):
+    tf_session.add_cmdline_args(parser)
     # Runtime environment
     agent = parser.add_argument_group('Paraphraser Arguments')
     agent.add_argument('--random_seed', type=int, default=1013)
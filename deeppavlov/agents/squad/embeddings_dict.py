@@ -1,16 +1,9 @@
 import os
 import copy
+import threading
 import numpy as np
 
 
-try:
-    import spacy
-except ImportError:
-    raise ImportError(
-        "Please install spacy and spacy 'en' model: go to spacy.io"
-    )
-
-
 from parlai.core.agents import Agent
 from parlai.core.dict import DictionaryAgent
 from . import config
@@ -18,7 +11,25 @@ from .utils import build_feature_dict, vectorize, batchify, normalize_text
 import urllib
 
 
-NLP = spacy.load('en')
+_nlp = None
+_nlp_lock = threading.Lock()
+
+
+def nlp():
+    """spaCy English pipeline, loaded on first use."""
+    global _nlp
+    # the lock is only taken until the pipeline is loaded
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                try:
+                    import spacy
+                except ImportError:
+                    raise ImportError(
+                        "Please install spacy and spacy 'en' model: go to spacy.io"
+                    )
+                _nlp = spacy.load('en')
+    return _nlp
 
 
 class SimpleDictionaryAgent(DictionaryAgent):
@@ -61,11 +72,15 @@ class SimpleDictionaryAgent(DictionaryAgent):
             self.embedding_words = None
 
     def tokenize(self, text, **kwargs):
-        tokens = NLP.tokenizer(text)
+        tokens = nlp().tokenizer(text)
         return [t.text for t in tokens]
 
+    def tokenize_texts(self, texts):
+        """Tokenize a list of texts with one pass of the spaCy tokenizer pipe."""
+        return [[t.text for t in tokens] for tokens in nlp().tokenizer.pipe(texts, batch_size=1000)]
+
     def span_tokenize(self, text):
-        tokens = NLP.tokenizer(text)
+        tokens = nlp().tokenizer(text)
         return [(t.idx, t.idx + len(t.text)) for t in tokens]
 
     def add_to_dict(self, tokens):
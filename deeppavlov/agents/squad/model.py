@@ -17,15 +17,14 @@ from keras.callbacks import ModelCheckpoint
 from .utils import AverageMeter, getOptimizer, score
 
 import tensorflow as tf
-from keras.backend.tensorflow_backend import set_session
-config = tf.ConfigProto()
-config.gpu_options.per_process_gpu_memory_fraction = 0.95
-config.gpu_options.visible_device_list = '0'
-set_session(tf.Session(config=config))
+from ...utils.tf_session import ModelGraph, in_model_graph, FrozenModel, freeze
+from ...utils.saving import atomic_open, keras_weights, write_keras_weights
 
 # import layers
 from .layers import *
 
+GPU_OPTIONS = {'per_process_gpu_memory_fraction': 0.95, 'visible_device_list': '0'}
+
 '''
 --------------- Model ----------------------------
 '''
@@ -34,6 +33,7 @@ class SquadModel(object):
     def __init__(self, opt, word_dict = None, feature_dict = None, weights_path = None ):
 
         self.opt = copy.deepcopy(opt)
+        self.model_graph = ModelGraph(self.opt, GPU_OPTIONS)
 
         for k, v in opt.items():
             setattr(self, k, v)
@@ -49,6 +49,14 @@ class SquadModel(object):
         self.train_em = AverageMeter()
 
 
+        if weights_path is not None and self.opt.get('frozen_model'):
+            print('[ Loading frozen model %s ]' % weights_path)
+            self.model = FrozenModel(self.model_graph, weights_path)
+        else:
+            self._init_model(weights_path)
+
+    @in_model_graph
+    def _init_model(self, weights_path=None):
         if self.type == 'fastqa_default':
             self.model = self.fastqa_default()
         elif self.type == 'fastqa_hybrid':
@@ -72,6 +80,23 @@ class SquadModel(object):
                            metrics=['accuracy'])
 
 
+    @in_model_graph
+    def export(self, fname):
+        """Write the inference-only artifact loaded with --frozen-model."""
+        freeze(self.model_graph, self.model.inputs, self.model.outputs, fname, {K.learning_phase(): False})
+
+    @in_model_graph
+    def make_predict_function(self):
+        self.model._make_predict_function()
+
+    @in_model_graph
+    def drop_lr(self, factor):
+        self.model.optimizer.lr = self.model.optimizer.lr * factor
+
+    def shutdown(self):
+        self.model_graph.close()
+
+    @in_model_graph
     def save(self, fname):
 
         self.model.save_weights(fname+'.h5')
@@ -85,6 +110,24 @@ class SquadModel(object):
         with open(fname+'.pkl', 'wb') as f:
             pickle.dump(params, f)
 
+    @in_model_graph
+    def save_snapshot(self, fname):
+        """Capture the state written by save and return a function writing it."""
+        weights = keras_weights(self.model)
+        # copied, so that the background write does not pickle dictionaries being updated
+        params = {
+            'word_dict': copy.deepcopy(self.word_dict),
+            'feature_dict': copy.deepcopy(self.feature_dict),
+            'config': copy.deepcopy(self.opt),
+        }
+
+        def write():
+            write_keras_weights(fname + '.h5', weights)
+            with atomic_open(fname + '.pkl', 'wb') as f:
+                pickle.dump(params, f)
+        return write
+
+    @in_model_graph
     def update(self, batch):
 
         def cat(target):
@@ -117,6 +160,7 @@ class SquadModel(object):
             self.train_f1.update(scorer[1])
             self.train_em.update(scorer[0])
 
+    @in_model_graph
     def predict(self, batch):
 
         score_s, score_e = self.model.predict_on_batch([batch[0], batch[1], batch[3], batch[2], batch[4]])
@@ -1,6 +1,7 @@
 import copy
 import os
 import pickle
+import threading
 import numpy as np
 from numpy.random import seed
 from . import config
@@ -9,9 +10,12 @@ from parlai.core.agents import Agent
 from parlai.core.params import class2str
 from .embeddings_dict import SimpleDictionaryAgent
 from .utils import build_feature_dict, vectorize, batchify, load_embeddings
+from ...utils.parallel_eval import check_numthreads
 
 class SquadAgent(Agent):
 
+    thread_safe_share = True
+
     @staticmethod
     def add_cmdline_args(argparser):
         config.add_cmdline_args(argparser)
@@ -23,27 +27,34 @@ class SquadAgent(Agent):
 
     def __init__(self, opt, shared=None):
         seed(1)
-
-        if opt['numthreads'] >1:
-            raise RuntimeError("numthreads > 1 not supported for this model.")
+        check_numthreads(opt)
 
         # Load dict.
         if not shared:
             word_dict = SquadAgent.dictionary_class()(opt)
         # All agents keep track of the episode (for multiple questions)
         self.episode_done = True
+        self.id = self.__class__.__name__
+        self.n_examples = 0
 
-        # Only create an empty dummy class when sharing
+        # Copies made for other threads use the model of the original agent
         if shared is not None:
             self.is_shared = True
+            self.opt = shared['opt']
+            self.word_dict = shared['word_dict']
+            self.feature_dict = shared['feature_dict']
+            self.embeddings = shared['embeddings']
+            self.model = shared['model']
+            self.lock = shared['lock']
             return
 
         # Set up params/logging/dicts
         self.is_shared = False
-        self.id = self.__class__.__name__
         self.word_dict = word_dict
         self.opt = copy.deepcopy(opt)
         config.set_defaults(self.opt)
+        # updates of the model are serialized, predictions run concurrently
+        self.lock = threading.Lock()
 
         if self.opt.get('model_file') and os.path.isfile(opt['model_file']):
             self._init_from_saved(opt['model_file'])
@@ -54,7 +65,18 @@ class SquadAgent(Agent):
                 self._init_from_scratch()
 
         self.embeddings = load_embeddings(opt, word_dict)
-        self.n_examples = 0
+
+    def share(self):
+        """Share the model with copies of the agent acting in other threads."""
+        shared = {'class': type(self), 'opt': self.opt}
+        shared['word_dict'] = self.word_dict
+        shared['feature_dict'] = self.feature_dict
+        shared['embeddings'] = self.embeddings
+        shared['model'] = self.model
+        shared['lock'] = self.lock
+        # build the predict function before other threads call predict
+        self.model.make_predict_function()
+        return shared
 
 
     def _init_from_scratch(self):
@@ -87,7 +109,7 @@ class SquadAgent(Agent):
 
 
     def observe(self, observation):
-        observation = copy.deepcopy(observation)
+        observation = copy.copy(observation)
         if not self.episode_done:
             # if the last example wasn't the end of an episode, then we need to
             # recall what was said in that example
@@ -99,9 +121,6 @@ class SquadAgent(Agent):
 
     def act(self):
         """Update or predict on a single example (batchsize = 1)."""
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
-
         reply = {'id': self.getID()}
 
         ex = self._build_ex(self.observation)
@@ -114,40 +133,51 @@ class SquadAgent(Agent):
         # Either train or predict
         if 'labels' in self.observation:
             self.n_examples += 1
-            self.model.update(batch)
+            with self.lock:
+                self.model.update(batch)
         else:
             reply['text'] = self.model.predict(batch)[0]
 
         return reply
 
-    def batch_act(self, observations):
-        """Update or predict on a batch of examples.
-        More efficient than act().
+    def prepare_batch(self, observations):
+        """Vectorize a batch of observations.
+        Returns indices of valid examples and the batch, which is None if
+        all examples are invalid.
         """
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
-
-        batchsize = len(observations)
-        batch_reply = [{'id': self.getID()} for _ in range(batchsize)]
-
         # Some examples will be None (no answer found). Filter them.
         examples = [self._build_ex(obs) for obs in observations]
-        valid_inds = [i for i in range(batchsize) if examples[i] is not None]
+        valid_inds = [i for i in range(len(observations)) if examples[i] is not None]
         examples = [ex for ex in examples if ex is not None]
 
-        # If all examples are invalid, return an empty batch.
         if len(examples) == 0:
-            return batch_reply
+            return valid_inds, None
 
         # Else, use what we have (hopefully everything).
-        batch = batchify(
+        return valid_inds, batchify(
             examples, null=self.word_dict[self.word_dict.null_token]
         )
 
+    def batch_act(self, observations, batch=None):
+        """Update or predict on a batch of examples.
+        More efficient than act().
+        """
+        batchsize = len(observations)
+        batch_reply = [{'id': self.getID()} for _ in range(batchsize)]
+
+        if batch is None:
+            batch = self.prepare_batch(observations)
+        valid_inds, batch = batch
+
+        # If all examples are invalid, return an empty batch.
+        if batch is None:
+            return batch_reply
+
         # Either train or predict
         if 'labels' in observations[0]:
-            self.n_examples += len(examples)
-            self.model.update(batch)
+            self.n_examples += len(valid_inds)
+            with self.lock:
+                self.model.update(batch)
         else:
             predictions = self.model.predict(batch)
             for i in range(len(predictions)):
@@ -155,9 +185,19 @@ class SquadAgent(Agent):
 
         return batch_reply
 
+    def predict(self, inputs):
+        """Return answers extracted from contexts for a list of (context, question) pairs."""
+        if not inputs:
+            return []
+        examples = [self._vectorize(document, question) for document, question in inputs]
+        batch = batchify(
+            examples, null=self.word_dict[self.word_dict.null_token]
+        )
+        return self.model.predict(batch)
+
     def drop_lr(self):
         ''' Reset optimizer and reset learning rate if validation score is not increasing'''
-        self.model.model.optimizer.lr = self.model.model.optimizer.lr * self.opt['lr_drop']
+        self.model.drop_lr(self.opt['lr_drop'])
 
     def save(self, fname=None):
         """Save the parameters of the agent to a file."""
@@ -166,6 +206,31 @@ class SquadAgent(Agent):
             print("[ saving model: " + fname + " ]")
             self.model.save(fname)
 
+    def save_snapshot(self, fname=None):
+        """Capture the parameters saved by save and return a function writing them."""
+        fname = self.opt.get('model_file', None) if fname is None else fname
+        if not fname:
+            return lambda: None
+        with self.lock:
+            write_model = self.model.save_snapshot(fname)
+
+        def write():
+            print("[ saving model: " + fname + " ]")
+            write_model()
+        return write
+
+    def export(self, fname=None):
+        """Export the model to the inference-only artifact loaded with --frozen-model."""
+        fname = self.opt.get('pretrained_model', None) if fname is None else fname
+        print("[ exporting model: " + fname + " ]")
+        self.model.export(fname)
+
+    def shutdown(self):
+        if not self.is_shared:
+            if self.model is not None:
+                self.model.shutdown()
+            self.model = None
+
     def report(self):
 
         output = (
@@ -194,7 +259,6 @@ class SquadAgent(Agent):
             return
 
         # Split out document + question
-        inputs = {}
         fields = ex['text'].strip().split('\n')
 
         # Data is expected to be text + '\n' + question
@@ -202,15 +266,21 @@ class SquadAgent(Agent):
             raise RuntimeError('Invalid input. Is task a QA task?')
 
         document, question = ' '.join(fields[:-1]), fields[-1]
+        return self._vectorize(document, question, ex.get('labels'))
+
+    def _vectorize(self, document, question, labels=None):
+        """Tokenize and vectorize a document and a question.
+        If labels are given and the answer span cannot be found, return None.
+        """
+        inputs = {}
         inputs['document'] = self.word_dict.tokenize(document)
         inputs['question'] = self.word_dict.tokenize(question)
         inputs['target'] = None
 
         # Find targets (if labels provided).
         # Return if we were unable to find an answer.
-        if 'labels' in ex:
-            inputs['target'] = self._find_target(inputs['document'],
-                                                 ex['labels'])
+        if labels is not None:
+            inputs['target'] = self._find_target(inputs['document'], labels)
             if inputs['target'] is None:
                 return
 
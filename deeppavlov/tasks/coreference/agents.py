@@ -16,7 +16,6 @@ limitations under the License.
 
 import os
 from os.path import join
-import copy
 import random
 from parlai.core.agents import Teacher
 from .build import build
@@ -84,7 +83,7 @@ class DefaultTeacher(Teacher):
         return act_dict
             
     def observe(self, observation):
-        self.observation = copy.deepcopy(observation)
+        self.observation = observation
         if self.observation['epoch_done']:
             self.doc_id = 0
             self.epoch += 1
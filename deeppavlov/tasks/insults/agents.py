@@ -4,9 +4,11 @@ from sklearn.model_selection import KFold
 from .build import build
 import os
 import csv
-import sklearn.metrics
+import functools
 import random
 
+from ...utils.streaming_metrics import ConfusionCounts, LogLoss, HistogramAUC
+
 
 def _path(opt):
     # ensure data is built
@@ -17,6 +19,28 @@ def _path(opt):
     return datafile
 
 
+@functools.lru_cache(maxsize=2)
+def _read_data(path):
+    """Parse a csv file into comments and label indexes once,
+    the last two files, train and test, are kept.
+
+    Teachers of all bagging folds trained in one process read the same file,
+    the parsed rows are shared read-only.
+    """
+    questions = []
+    labels = []
+
+    with open(path) as labels_file:
+        context = csv.reader(labels_file)
+        next(context)
+
+        for item in context:
+            label, text = item
+            questions.append(text)
+            labels.append(int(label))
+    return questions, labels
+
+
 class DefaultTeacher(DialogTeacher):
 
     @staticmethod
@@ -27,6 +51,8 @@ class DefaultTeacher(DialogTeacher):
         teacher.add_argument('--teacher-random-seed', type=int, default=270)
         teacher.add_argument('--bagging-fold-index', type=int)
         teacher.add_argument('--bagging-folds-number', type=int, default=5)
+        teacher.add_argument('--auc-bins', type=int, default=10000,
+                             help='number of score bins the AUC is computed from, 0 computes it exactly')
 
     def __init__(self, opt, shared=None):
         # store datatype
@@ -43,20 +69,26 @@ class DefaultTeacher(DialogTeacher):
         random.seed(opt.get('teacher_random_seed'))
         self.random_state = random.getstate()
         random.setstate(random_state)
+        # validation and test data are shuffled once, so that evaluations limited to
+        # the first examples always see the same examples
+        self.shuffled = False
 
         super().__init__(opt, shared)
 
         if shared:
-            self.observations = shared['observations']
-            self.labels = shared['labels']
+            self.counts = shared['counts']
+            self.loss = shared['loss']
+            self.auc = shared['auc']
         else:
-            self.observations = []
-            self.labels = []
+            self.counts = ConfusionCounts()
+            self.loss = LogLoss()
+            self.auc = HistogramAUC(opt.get('auc_bins', 10000) or None)
 
     def share(self):
         shared = super().share()
-        shared['observations'] = self.observations
-        shared['labels'] = self.labels
+        shared['counts'] = self.counts
+        shared['loss'] = self.loss
+        shared['auc'] = self.auc
         return shared
 
     def label_candidates(self):
@@ -65,19 +97,10 @@ class DefaultTeacher(DialogTeacher):
     def setup_data(self, path):
         print('loading: ' + path)
 
-        questions = []
-        y = []
-
-        # open data file with labels
+        # read data file with labels
         # (path will be provided to setup_data from opt['datafile'] defined above)
-        with open(path) as labels_file:
-            context = csv.reader(labels_file)
-            next(context)
-
-            for item in context:
-                label, text = item
-                questions.append(text)
-                y.append([self.answer_candidates[int(label)]])
+        questions, labels = _read_data(path)
+        y = [[self.answer_candidates[label]] for label in labels]
 
         episode_done = True
 
@@ -115,39 +138,38 @@ class DefaultTeacher(DialogTeacher):
         if self.lastY is not None:
             self.metrics.update(observation, self.lastY)
             if 'text' in observation.keys():
-                self.labels += self._text2predictions(self.lastY)
-                self.observations += [observation['score']]
+                label = self._text2predictions(self.lastY)[0]
+                score = float(observation['score'])
+                self.counts.update(label, score > 0.5)
+                self.loss.update(label, score)
+                self.auc.update(label, score)
             self.lastY = None
         return observation
 
     def reset_metrics(self):
         super().reset_metrics()
-        del self.observations[:]
-        del self.labels[:]
+        self.counts.clear()
+        self.loss.clear()
+        self.auc.clear()
 
     def report(self):
-        loss = sklearn.metrics.log_loss(self.labels, self.observations)
-        acc = sklearn.metrics.accuracy_score(self.labels,
-                                             self._text2predictions(self._predictions2text(self.observations)))
-        try:
-            auc = sklearn.metrics.roc_auc_score(self.labels, self.observations)
-        except ValueError:
-            auc = 0
         report = dict()
-        report['comments'] = len(self.observations)
-        report['loss'] = loss
-        report['accuracy'] = acc
-        report['auc'] = auc
+        report['comments'] = self.counts.count
+        report['loss'] = self.loss.value()
+        report['accuracy'] = self.counts.accuracy()
+        report['auc'] = self.auc.value()
         return report
 
     def reset(self):
         super().reset()
 
-        random_state = random.getstate()
-        random.setstate(self.random_state)
-        random.shuffle(self.data.data)
-        self.random_state = random.getstate()
-        random.setstate(random_state)
+        if self.datatype_strict == 'train' or not self.shuffled:
+            random_state = random.getstate()
+            random.setstate(self.random_state)
+            random.shuffle(self.data.data)
+            self.random_state = random.getstate()
+            random.setstate(random_state)
+            self.shuffled = True
 
 
 class FullTeacher(DefaultTeacher):
@@ -164,19 +186,10 @@ class FullTeacher(DefaultTeacher):
     def setup_data(self, path):
         print('loading: ' + path)
 
-        questions = []
-        y = []
-
-        # open data file with labels
+        # read data file with labels
         # (path will be provided to setup_data from opt['datafile'] defined above)
-        with open(path) as labels_file:
-            context = csv.reader(labels_file)
-            next(context)
-
-            for item in context:
-                label, text = item
-                questions.append(text)
-                y.append([self.answer_candidates[int(label)]])
+        questions, labels = _read_data(path)
+        y = [[self.answer_candidates[label]] for label in labels]
 
         episode_done = True
 
@@ -46,6 +46,9 @@ class DefaultTeacher(DialogTeacher):
         random.seed(opt.get('teacher_seed'))
         self.random_state = random.getstate()
         random.setstate(random_state)
+        # validation and test data are shuffled once, so that evaluations limited to
+        # the first examples always see the same examples
+        self.shuffled = False
 
         if shared and shared.get('metrics'):
             self.metrics = shared['metrics']
@@ -139,11 +142,13 @@ class DefaultTeacher(DialogTeacher):
             yield (questions[i], y[i]), episode_done
 
     def reset(self):
-        random_state = random.getstate()
-        random.setstate(self.random_state)
-        random.shuffle(self.data.data)
-        self.random_state = random.getstate()
-        random.setstate(random_state)
+        if self.dt == 'train' or not self.shuffled:
+            random_state = random.getstate()
+            random.setstate(self.random_state)
+            random.shuffle(self.data.data)
+            self.random_state = random.getstate()
+            random.setstate(random_state)
+            self.shuffled = True
 
         self.lastY = None
         self.episode_idx = self.data_offset - self.step_size
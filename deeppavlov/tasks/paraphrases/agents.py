@@ -20,6 +20,7 @@ from .metric import BinaryClassificationMetrics
 from .build import build
 import os
 import csv
+import functools
 from sklearn.model_selection import KFold
 import random
 
@@ -38,6 +39,29 @@ def _path(opt):
     return datafile
 
 
+@functools.lru_cache(maxsize=2)
+def _read_data(path):
+    """Parse a tsv file into question pairs and labels once,
+    the last two files, train and test, are kept.
+
+    Teachers of all bagging folds trained in one process read the same file,
+    the parsed rows are shared read-only.
+    """
+    questions = []
+    y = []
+
+    with open(path) as labels_file:
+        tsv_reader = csv.reader(labels_file, delimiter='\t')
+
+        for row in tsv_reader:
+            if len(row) != 3:
+                print('Warn: expected 3 columns in a tsv row, got ' + str(row))
+                continue
+            y.append(['Да' if row[0] == '1' else 'Нет'])
+            questions.append(row[1] + '\n' + row[2])
+    return questions, y
+
+
 class DefaultTeacher(DialogTeacher):
 
     @staticmethod
@@ -64,6 +88,9 @@ class DefaultTeacher(DialogTeacher):
         random.seed(opt.get('teacher_random_seed'))
         self.random_state = random.getstate()
         random.setstate(random_state)
+        # validation and test data are shuffled once, so that evaluations limited to
+        # the first examples always see the same examples
+        self.shuffled = False
 
         if shared and shared.get('metrics'):
             self.metrics = shared['metrics']
@@ -78,20 +105,9 @@ class DefaultTeacher(DialogTeacher):
     def setup_data(self, path):
         print('loading: ' + path)
 
-        questions = []
-        y = []
-
-        # open data file with labels
+        # read data file with labels
         # (path will be provided to setup_data from opt['datafile'] defined above)
-        with open(path) as labels_file:
-            tsv_reader = csv.reader(labels_file, delimiter='\t')
-
-            for row in tsv_reader:
-                if len(row) != 3:
-                    print('Warn: expected 3 columns in a tsv row, got ' + str(row))
-                    continue
-                y.append(['Да' if row[0] == '1' else 'Нет'])
-                questions.append(row[1] + '\n' + row[2])
+        questions, y = _read_data(path)
 
         episode_done = True
         if not y:
@@ -121,8 +137,10 @@ class DefaultTeacher(DialogTeacher):
     def reset(self):
         super().reset()
 
-        random_state = random.getstate()
-        random.setstate(self.random_state)
-        random.shuffle(self.data.data)
-        self.random_state = random.getstate()
-        random.setstate(random_state)
+        if self.datatype_strict == 'train' or not self.shuffled:
+            random_state = random.getstate()
+            random.setstate(self.random_state)
+            random.shuffle(self.data.data)
+            self.random_state = random.getstate()
+            random.setstate(random_state)
+            self.shuffled = True
@@ -1,5 +1,7 @@
 import numpy as np
 
+from ...utils.streaming_metrics import ConfusionCounts
+
 
 def precision(y_true, y_pred):
     """Precision metric.
@@ -70,24 +72,21 @@ class BinaryClassificationMetrics(object):
 
     def __init__(self, true_str):
         self.true_str = true_str
-        self.y_pred = []
-        self.y_true = []
+        self.counts = ConfusionCounts()
 
     def clear(self):
-        del self.y_pred[:]
-        del self.y_true[:]
+        self.counts.clear()
 
     def update(self, observation, y):
         if y and 'text' in observation:
-            self.y_pred.append(1 if observation['text'] == self.true_str else 0)
-            self.y_true.append(1 if y[0] == self.true_str else 0)
+            self.counts.update(y[0] == self.true_str, observation['text'] == self.true_str)
 
     def report(self):
-        if len(self.y_pred) > 0:
+        if self.counts.count > 0:
             report = {
-                'f1': fbeta_score(self.y_true, self.y_pred),
-                'accuracy': accuracy(self.y_true, self.y_pred),
-                'cnt': len(self.y_pred)
+                'f1': self.counts.fbeta(),
+                'accuracy': self.counts.accuracy(),
+                'cnt': self.counts.count
             }
             return report
         return dict()
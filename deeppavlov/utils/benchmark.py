@@ -0,0 +1,597 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import copy
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+from parlai.core.agents import create_agent, create_task_agent_from_taskname
+from parlai.core.params import str2class
+
+from . import resources
+from .perf import percentile
+from .tf_session import ModelGraph, set_cpu_affinity
+
+
+def paraphraser_input(observation):
+    """(sentence, sentence) pair from a paraphrases teacher action."""
+    texts = observation['text'].split('\n')
+    return texts[1], texts[2]
+
+
+def text_input(observation):
+    """Text of an insults or NER teacher action."""
+    return observation['text']
+
+
+def squad_input(observation):
+    """(context, question) pair from a SQuAD teacher action."""
+    fields = observation['text'].strip().split('\n')
+    return ' '.join(fields[:-1]), fields[-1]
+
+
+def _best_time(fn, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def predict_overhead(opt, to_input, max_exs=1024, repeats=3):
+    """Compare agent.predict with observe + batch_act on the same examples.
+    - opt is a dictionary returned by build_utils.arg_parse for a trained model
+    - to_input converts a teacher action to the input of agent.predict
+    Returns seconds per example of both paths and their difference.
+    """
+    opt = copy.deepcopy(opt)
+    teacher = create_task_agent_from_taskname(opt)[0]
+    observations = []
+    while len(observations) < max_exs:
+        observation = teacher.act()
+        if 'text' in observation:
+            observation.pop('labels', None)
+            observations.append(observation)
+        if teacher.epoch_done():
+            break
+    inputs = [to_input(observation) for observation in observations]
+    batchsize = opt['batchsize']
+    agent = create_agent(opt)
+
+    def world_path():
+        for i in range(0, len(observations), batchsize):
+            batch = [agent.observe(observation) for observation in observations[i:i + batchsize]]
+            agent.batch_act(batch)
+
+    def direct_path():
+        for i in range(0, len(inputs), batchsize):
+            agent.predict(inputs[i:i + batchsize])
+
+    # warm up caches and the model before timing
+    direct_path()
+    world_time = _best_time(world_path, repeats) / len(observations)
+    predict_time = _best_time(direct_path, repeats) / len(observations)
+    agent.shutdown()
+
+    result = {'exs': len(observations),
+              'batch_act': world_time,
+              'predict': predict_time,
+              'overhead': world_time - predict_time}
+    print('[ batch_act: {:.1f}us/ex predict: {:.1f}us/ex overhead removed: {:.1f}us/ex ]'.format(
+        1e6 * world_time, 1e6 * predict_time, 1e6 * result['overhead']))
+    return result
+
+
+# Synthetic benchmarks: tiny randomly initialised models fed with generated
+# inputs of realistic shapes, runnable offline without datasets and downloads.
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+NER_TAGS = ['O', 'B-PER', 'I-PER', 'B-LOC', 'I-LOC', 'B-ORG', 'I-ORG']
+
+
+class RandomFastText(object):
+    """Stand-in for a fastText model, returns a fixed random vector of every word."""
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def __getitem__(self, word):
+        rng = np.random.RandomState(zlib.crc32(word.encode('utf-8')))
+        return rng.uniform(-1.0, 1.0, self.dim).astype(np.float32)
+
+
+def vocabulary(rng, size=5000):
+    """Random lowercase words."""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(list(LETTERS), rng.randint(2, 11))))
+    return sorted(words)
+
+
+def sentence(rng, vocab, min_len, max_len):
+    """Space separated words with a Zipf-like frequency distribution."""
+    indices = (rng.zipf(1.3, rng.randint(min_len, max_len + 1)) - 1) % len(vocab)
+    return ' '.join(vocab[i] for i in indices)
+
+
+def paraphraser_observation(rng, vocab, labels=True):
+    observation = {'text': 'Are these sentences paraphrases?\n{}\n{}'.format(sentence(rng, vocab, 4, 20),
+                                                                          sentence(rng, vocab, 4, 20)),
+                   'episode_done': True}
+    if labels:
+        observation['labels'] = [str(rng.choice(['Да', 'Нет']))]
+    return observation
+
+
+def insults_observation(rng, vocab, labels=True):
+    observation = {'text': sentence(rng, vocab, 5, 100), 'episode_done': True}
+    if labels:
+        observation['labels'] = [str(rng.choice(['Insult', 'Non-insult']))]
+    return observation
+
+
+def ner_observation(rng, vocab, labels=True):
+    text = sentence(rng, vocab, 5, 40)
+    observation = {'text': text, 'episode_done': True}
+    if labels:
+        observation['labels'] = [' '.join(rng.choice(NER_TAGS) for _ in text.split(' '))]
+    return observation
+
+
+def squad_observation(rng, vocab, labels=True):
+    context = sentence(rng, vocab, 60, 200)
+    observation = {'text': '{}\n{}'.format(context, sentence(rng, vocab, 5, 15)), 'episode_done': True}
+    if labels:
+        tokens = context.split(' ')
+        # the answer span is looked up among all but the last tokens of the context
+        start = rng.randint(len(tokens) - 4)
+        observation['labels'] = [' '.join(tokens[start:start + rng.randint(1, 4)])]
+    return observation
+
+
+def conll_document(rng, vocab, n_sentences, doc_name='bench'):
+    """CoNLL-2012 formatted document with random single and two word mentions."""
+    lines = ['#begin document ({}); part 0'.format(doc_name)]
+    for _ in range(n_sentences):
+        words = sentence(rng, vocab, 5, 30).split(' ')
+        word_id = 0
+        while word_id < len(words):
+            chain = rng.randint(max(2, n_sentences))
+            width = rng.randint(1, 3) if rng.rand() < 0.2 else 0
+            width = min(width, len(words) - word_id)
+            corefs = ['-'] * width if width else ['-']
+            if width == 1:
+                corefs = ['({})'.format(chain)]
+            elif width == 2:
+                corefs = ['({}'.format(chain), '{})'.format(chain)]
+            for coref in corefs:
+                lines.append('\t'.join([doc_name, '0', str(word_id), words[word_id], 'NN',
+                                        '-', '-', '-', 'speaker', '-', '-', '-', coref]))
+                word_id += 1
+        lines.append('')
+    lines.append('#end document')
+    return '\n'.join(lines)
+
+
+def write_vectors(path, words, dim, header=False):
+    """Write random word vectors in word2vec text format."""
+    fasttext = RandomFastText(dim)
+    with open(path, 'w') as f:
+        if header:
+            f.write('{} {}\n'.format(len(words), dim))
+        for word in words:
+            f.write(word + ' ' + ' '.join('{:.5f}'.format(x) for x in fasttext[word]) + '\n')
+
+
+def build_dictionary(opt, observations):
+    """Build and save the dictionary of the agent from observations."""
+    dictionary = str2class(opt['model']).dictionary_class()(opt)
+    for observation in observations:
+        dictionary.observe(observation)
+        dictionary.act()
+    dictionary.save(opt['dict_file'], sort=True)
+
+
+def make_dirs(opt):
+    """Create the directories of the files a benchmark writes."""
+    for name in ['model_file', 'dict_file', 'embedding_file', 'fasttext_model', 'fasttext_embeddings_dict']:
+        if opt.get(name) and os.path.dirname(opt[name]):
+            os.makedirs(os.path.dirname(opt[name]), exist_ok=True)
+
+
+def _rss_mb(rss):
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def peak_rss_mb():
+    return _rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _timings(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def _stats(times, exs):
+    return {'p50_ms': 1e3 * percentile(times, 50),
+            'p90_ms': 1e3 * percentile(times, 90),
+            'p95_ms': 1e3 * percentile(times, 95),
+            'exs_per_sec': exs / percentile(times, 50) if percentile(times, 50) > 0 else 0.0}
+
+
+def measure(prepare, step, act, batch_sizes, repeats):
+    """Time batching, model steps and end-to-end acts for every batch size.
+    - prepare(batch_size) builds a training batch
+    - step(batch_size, batch) runs a model step on it
+    - act(batch_size) answers a batch of unlabelled inputs
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        # the first calls build functions and fill caches
+        batch = prepare(batch_size)
+        step(batch_size, batch)
+        act(batch_size)
+        results[str(batch_size)] = {
+            'batching': _stats(_timings(lambda: prepare(batch_size), repeats), batch_size),
+            'step': _stats(_timings(lambda: step(batch_size, batch), repeats), batch_size),
+            'batch_act': _stats(_timings(lambda: act(batch_size), repeats), batch_size)}
+        print('[ batch {}: batching {p50_ms:.1f}ms '.format(batch_size, **results[str(batch_size)]['batching']) +
+              'step {p50_ms:.1f}ms '.format(**results[str(batch_size)]['step']) +
+              'batch_act {p50_ms:.1f}ms p90 {p90_ms:.1f}ms ]'.format(**results[str(batch_size)]['batch_act']))
+    return results
+
+
+def _peak_kb(fn, *args):
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def observe_allocations(agent, observations):
+    """Mean peak memory allocated by an observe call, next to the deep copy of the
+    observation that observe used to start with.
+    """
+    results = {'observe_kb': float(np.mean([_peak_kb(agent.observe, obs) for obs in observations])),
+               'deepcopy_kb': float(np.mean([_peak_kb(copy.deepcopy, obs) for obs in observations]))}
+    print('[ observe {observe_kb:.1f}KB per call, deepcopy of the observation {deepcopy_kb:.1f}KB ]'.format(
+        **results))
+    return results
+
+
+def _agent_benchmark(opt, make_observation, vocab, batch_sizes, repeats, seed):
+    rng = np.random.RandomState(seed)
+    start = time.perf_counter()
+    agent = create_agent(opt)
+    startup = time.perf_counter() - start
+    observe = observe_allocations(agent, [make_observation(rng, vocab) for _ in range(100)])
+    train = {n: [agent.observe(make_observation(rng, vocab)) for _ in range(n)] for n in batch_sizes}
+    test = {n: [make_observation(rng, vocab, labels=False) for _ in range(n)] for n in batch_sizes}
+
+    def act(n):
+        agent.batch_act([agent.observe(observation) for observation in test[n]])
+
+    results = measure(lambda n: agent.prepare_batch(train[n]),
+                      lambda n, batch: agent.batch_act(train[n], batch),
+                      act, batch_sizes, repeats)
+    agent.shutdown()
+    return startup, results, observe
+
+
+def _fasttext_benchmark(make_observation):
+    def run(opt, vocab, batch_sizes, repeats, seed):
+        resources.register('fasttext', opt['fasttext_model'], RandomFastText(opt['embedding_dim']))
+        try:
+            return _agent_benchmark(opt, make_observation, vocab, batch_sizes, repeats, seed)
+        finally:
+            resources.release('fasttext', opt['fasttext_model'])
+    return run
+
+
+def _ner_benchmark(opt, vocab, batch_sizes, repeats, seed):
+    rng = np.random.RandomState(seed + 1)
+    build_dictionary(opt, [ner_observation(rng, vocab) for _ in range(1000)])
+    return _agent_benchmark(opt, ner_observation, vocab, batch_sizes, repeats, seed)
+
+
+def _squad_benchmark(opt, vocab, batch_sizes, repeats, seed):
+    rng = np.random.RandomState(seed + 1)
+    write_vectors(opt['embedding_file'], vocab, opt['word_embedding_dim'])
+    build_dictionary(opt, [squad_observation(rng, vocab) for _ in range(200)])
+    return _agent_benchmark(opt, squad_observation, vocab, batch_sizes, repeats, seed)
+
+
+def _coreference_benchmark(opt, vocab, batch_sizes, repeats, seed):
+    """Batches of the end-to-end coreference model are documents of batch_size sentences."""
+    rng = np.random.RandomState(seed)
+    dpath = os.path.join(opt['model_file'], opt['language'], 'agent')
+    os.makedirs(os.path.join(dpath, 'embeddings'), exist_ok=True)
+    os.makedirs(os.path.join(dpath, 'vocab'), exist_ok=True)
+    write_vectors(os.path.join(dpath, 'embeddings', 'embeddings_lenta_100.vec'), vocab,
+                  opt['embedding_size'], header=True)
+    with open(os.path.join(dpath, 'vocab', 'char_vocab.russian.txt'), 'w') as f:
+        f.write('\n'.join(LETTERS) + '\n')
+
+    start = time.perf_counter()
+    agent = create_agent(opt)
+    startup = time.perf_counter() - start
+    documents = {n: conll_document(rng, vocab, n) for n in batch_sizes}
+
+    def observation(n, mode):
+        return {'conll_str': documents[n], 'mode': mode, 'iter_id': 0, 'epoch_done': False}
+
+    observe = observe_allocations(agent, [observation(n, 'train') for n in batch_sizes])
+
+    def prepare(n):
+        example = agent.observe(observation(n, 'train'))
+        agent.model.tensorize_example(example, is_training=True)
+        return example
+
+    def act(n):
+        agent.observe(observation(n, 'valid'))
+        agent.act()
+
+    results = measure(prepare, lambda n, batch: agent.model.train(batch), act, batch_sizes, repeats)
+    agent.shutdown()
+    return startup, results, observe
+
+
+def _coreference_scorer_benchmark(opt, vocab, batch_sizes, repeats, seed):
+    """The scorer agent trains on a whole dataset per act, so its parts are timed directly:
+    mention features and the batch generator, and steps of the mention pair scorer.
+    """
+    import tensorflow as tf
+    from ..agents.coreference_scorer_model import utils
+    from ..agents.coreference_scorer_model.model import MentionScorerModel
+
+    rng = np.random.RandomState(seed)
+    # 50 dimensional embeddings give the default features_size of the scorer
+    fasttext = RandomFastText(50)
+    start = time.perf_counter()
+    data = [utils.extract_data_from_conll(conll_document(rng, vocab, 20, 'bench_{}'.format(i)).split('\n'))
+            for i in range(20)]
+    data = {doc['doc_name']: doc for doc in data}
+    data_smpl = {doc: utils.generate_simple_features(data[doc]) for doc in data}
+    data_emb = {doc: utils.generate_emb_features(data[doc], fasttext) for doc in data}
+    generator = utils.MentionPairsBatchGenerator(data, data_emb, data_smpl, seed=seed)
+    model_graph = ModelGraph(opt)
+    session = model_graph.session
+    with model_graph.as_default():
+        model = MentionScorerModel(hidden_size=opt['dense_hidden_size'], lr=opt['lr'],
+                                   keep_prob_input=opt['keep_prob_input'], keep_prob_dense=opt['keep_prob_dense'],
+                                   features_size=generator.dl.features_size)
+        tf.global_variables_initializer().run(session=session)
+    startup = time.perf_counter() - start
+
+    def act(n):
+        model.test_batch(session, *generator.get_batch(n))
+
+    results = measure(generator.get_batch, lambda n, batch: model.train_batch(session, *batch),
+                      act, batch_sizes, repeats)
+    model_graph.close()
+    return startup, results, None
+
+
+SKILLS = {
+    'paraphraser': _fasttext_benchmark(paraphraser_observation),
+    'insults': _fasttext_benchmark(insults_observation),
+    'ner': _ner_benchmark,
+    'squad': _squad_benchmark,
+    'coreference': _coreference_benchmark,
+    'coreference_scorer_model': _coreference_scorer_benchmark,
+}
+
+
+def run_synthetic(skill, opt, batch_sizes=(1, 8, 32, 128), repeats=5, out_dir='./build/benchmarks', seed=13):
+    """Benchmark a skill on synthetic inputs and write the results to a JSON file.
+    - opt is a dictionary returned by build_utils.arg_parse for a tiny untrained model
+    Returns the results: startup time, peak RSS, timings of batching,
+    model steps and batch_act for every batch size and memory allocated
+    per observe call.
+    """
+    opt = copy.deepcopy(opt)
+    make_dirs(opt)
+    set_cpu_affinity(opt.get('cpu_affinity'))
+    vocab = vocabulary(np.random.RandomState(seed))
+    startup, timings, observe = SKILLS[skill](opt, vocab, list(batch_sizes), repeats, seed)
+    results = {'skill': skill,
+               'timestamp': datetime.datetime.now().isoformat(),
+               'startup_sec': startup,
+               'peak_rss_mb': peak_rss_mb(),
+               'batch_sizes': timings}
+    if observe is not None:
+        results['observe'] = observe
+    print('[ {}: startup {:.1f}s peak RSS {:.0f}MB ]'.format(skill, startup, results['peak_rss_mb']))
+    save_results(skill, results, out_dir)
+    return results
+
+
+def save_results(name, results, out_dir):
+    """Write results to a timestamped JSON file, so that runs can be compared."""
+    os.makedirs(out_dir, exist_ok=True)
+    fname = os.path.join(out_dir, '{}_{}.json'.format(name, datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+    with open(fname, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('[ benchmark results saved to {} ]'.format(fname))
+
+
+SKILL_MODULES = {
+    'paraphraser': 'deeppavlov.agents.paraphraser.paraphraser',
+    'insults': 'deeppavlov.agents.insults.insults_agents',
+    'ner': 'deeppavlov.agents.ner.ner',
+    'squad': 'deeppavlov.agents.squad.squad',
+    'coreference': 'deeppavlov.agents.coreference.agents',
+    'coreference_scorer_model': 'deeppavlov.agents.coreference_scorer_model.agents',
+}
+
+_IMPORT_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(json.dumps({'sec': time.perf_counter() - start,
+                  'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+
+def import_cost(module, repeats=3):
+    """Cold-start time and peak RSS of importing a module in a fresh interpreter."""
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', _IMPORT_SCRIPT, module])
+        runs.append(json.loads(output.decode('utf-8').strip().split('\n')[-1]))
+    return {'import_sec': percentile(sorted(run['sec'] for run in runs), 50),
+            'peak_rss_mb': _rss_mb(max(run['rss'] for run in runs))}
+
+
+def run_imports(repeats=3, out_dir='./build/benchmarks'):
+    """Measure the import cost of every skill and write the results to a JSON file."""
+    results = {'timestamp': datetime.datetime.now().isoformat(), 'skills': {}}
+    for skill, module in sorted(SKILL_MODULES.items()):
+        results['skills'][skill] = import_cost(module, repeats)
+        print('[ import {}: {import_sec:.2f}s peak RSS {peak_rss_mb:.0f}MB ]'.format(
+            skill, **results['skills'][skill]))
+    save_results('imports', results, out_dir)
+    return results
+
+
+def embeddings_loading(opt, n_words=20000, repeats=3, seed=13):
+    """Time loading of a saved fastText embeddings dict of n_words random words.
+    - opt is a dictionary returned by build_utils.arg_parse for an insults model
+    with fasttext_model and fasttext_embeddings_dict set
+    """
+    from ..agents.insults.embeddings_dict import EmbeddingsDict
+
+    opt = copy.deepcopy(opt)
+    make_dirs(opt)
+    dim = opt['embedding_dim']
+    write_vectors(opt['fasttext_embeddings_dict'], vocabulary(np.random.RandomState(seed), n_words), dim)
+    resources.register('fasttext', opt['fasttext_model'], RandomFastText(dim))
+    try:
+        def load():
+            embdict = EmbeddingsDict(opt, dim)
+            embdict.release()
+
+        times = _timings(load, repeats)
+    finally:
+        resources.release('fasttext', opt['fasttext_model'])
+    results = {'load_sec': percentile(times, 50),
+               'words_per_sec': n_words / percentile(times, 50),
+               'peak_rss_mb': peak_rss_mb()}
+    print('[ embeddings: {load_sec:.2f}s {words_per_sec:.0f} words/s peak RSS {peak_rss_mb:.0f}MB ]'.format(
+        **results))
+    return results
+
+
+def _batchify_before_cache(model, question1, question2):
+    """Batching path of the paraphraser before the tokens cache: every sentence is
+    tokenized by the dictionary update and again by create_batch, which stacks
+    the embeddings of every token.
+    """
+    from ..agents.paraphraser.embeddings_dict import tokenize
+
+    embdict = model.embdict
+    batches = []
+    for sentences in [question1, question2]:
+        for sen in sentences:
+            for tok in tokenize(sen):
+                if embdict.tok2emb.get(tok) is None:
+                    embdict.tok2emb[tok] = embdict.fasttext_model[tok]
+        embeddings_batch = []
+        for sen in sentences:
+            embeddings = [embdict.tok2emb.get(tok) for tok in tokenize(sen)]
+            if len(embeddings) < model.max_sequence_length:
+                pads = [np.zeros(model.embedding_dim) for _ in range(model.max_sequence_length - len(embeddings))]
+                embeddings = pads + embeddings
+            else:
+                embeddings = embeddings[-model.max_sequence_length:]
+            embeddings_batch.append(np.asarray(embeddings))
+        batches.append(np.asarray(embeddings_batch))
+    return batches
+
+
+def paraphraser_tokenization(opt, n_pairs=5000, batch_size=32, epochs=3, repeats=3,
+                             out_dir='./build/benchmarks', seed=13):
+    """Tokens per second of the batching path of a paraphraser agent over several epochs
+    of random sentence pairs, compared in three ways:
+    - before: the path before the tokens cache, every sentence is tokenized twice per batch;
+    - uncached: batchify_questions tokenizing every sentence once per batch, tokens_cache_size 0;
+    - cached: batchify_questions with the tokens cache, every sentence is tokenized once per run.
+    - opt is a dictionary returned by build_utils.arg_parse for a tiny untrained model
+    """
+    opt = copy.deepcopy(opt)
+    make_dirs(opt)
+    rng = np.random.RandomState(seed)
+    vocab = vocabulary(rng)
+    pairs = [(sentence(rng, vocab, 4, 20), sentence(rng, vocab, 4, 20)) for _ in range(n_pairs)]
+    batches = [[list(q) for q in zip(*pairs[i:i + batch_size])] for i in range(0, n_pairs, batch_size)]
+
+    results = {'timestamp': datetime.datetime.now().isoformat(),
+               'pairs': n_pairs,
+               'batch_size': batch_size,
+               'epochs': epochs}
+    resources.register('fasttext', opt['fasttext_model'], RandomFastText(opt['embedding_dim']))
+    try:
+        for name, cache_size in [('before', 0), ('uncached', 0), ('cached', opt['tokens_cache_size'])]:
+            agent = create_agent(dict(opt, tokens_cache_size=cache_size))
+            try:
+                model = agent.model
+                results['tokens'] = epochs * sum(len(model.embdict.tokenize(sen)) for pair in pairs for sen in pair)
+                batchify = _batchify_before_cache if name == 'before' else type(model).batchify_questions
+
+                def run():
+                    # every run tokenizes its first epoch
+                    model.embdict.tokenize.cache_clear()
+                    for _ in range(epochs):
+                        for question1, question2 in batches:
+                            batchify(model, question1, question2)
+
+                results[name] = {'sec': percentile(_timings(run, repeats), 50)}
+                results[name]['tokens_per_sec'] = results['tokens'] / results[name]['sec']
+            finally:
+                agent.shutdown()
+    finally:
+        resources.release('fasttext', opt['fasttext_model'])
+    print('[ tokenization: {:.0f} tokens/s before the cache (tokenized twice per batch), '
+          '{:.0f} tokens/s tokenized once per batch, {:.0f} tokens/s with the cache ]'.format(
+              results['before']['tokens_per_sec'], results['uncached']['tokens_per_sec'],
+              results['cached']['tokens_per_sec']))
+    save_results('tokenization', results, out_dir)
+    return results
+
+
+def run_isolated(fn, *args, **kwargs):
+    """Run a benchmark in a fresh process, so that peak RSS and startup time
+    do not depend on benchmarks run before it.
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, args, kwargs)
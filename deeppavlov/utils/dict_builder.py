@@ -0,0 +1,125 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Dictionary building without a world.
+
+Examples are read from the teachers directly and streamed in chunks to worker
+processes, which only tokenize. The tokens are counted in the main process in
+the order of the examples, the same way DictionaryAgent.act counts them, so the
+saved dictionary is the same as the one built by parleying the teacher with
+the dictionary agent.
+"""
+
+import copy
+import itertools
+import multiprocessing
+
+from parlai.core.agents import create_task_agent_from_taskname
+
+_worker_dictionary = None
+
+
+def teacher_examples(opt):
+    """Examples of the teachers of opt['task'], one epoch in order."""
+    for teacher in create_task_agent_from_taskname(opt):
+        while not teacher.epoch_done():
+            yield teacher.act()
+
+
+def counting_dictionaries(dictionary):
+    """Dictionaries counting the text and the labels of examples.
+    NER counts its labels in a dictionary of their own.
+    """
+    return dictionary, getattr(dictionary, 'labels_dict', dictionary)
+
+
+def tokenize_texts(dictionary, texts):
+    """Tokenize a list of texts, in one call if the dictionary supports it."""
+    if hasattr(dictionary, 'tokenize_texts'):
+        return dictionary.tokenize_texts(texts)
+    return [dictionary.tokenize(text) for text in texts]
+
+
+def tokenize_examples(dictionary, examples):
+    """Tokens of the text and of every label of every example."""
+    text_dict, labels_dict = counting_dictionaries(dictionary)
+    texts = [ex.get('text') or '' for ex in examples]
+    labels = [[label for label in (ex.get('labels') or []) if label] for ex in examples]
+    text_tokens = tokenize_texts(text_dict, [text for text in texts if text])
+    label_tokens = tokenize_texts(labels_dict, [label for ex_labels in labels for label in ex_labels])
+    text_tokens, label_tokens = iter(text_tokens), iter(label_tokens)
+    return [(next(text_tokens) if text else None, [next(label_tokens) for _ in ex_labels])
+            for text, ex_labels in zip(texts, labels)]
+
+
+def _init_worker(dict_class, opt):
+    global _worker_dictionary
+    _worker_dictionary = dict_class(opt)
+
+
+def _tokenize_chunk(examples):
+    return tokenize_examples(_worker_dictionary, examples)
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def build(dictionary, opt, workers=1, chunk_size=1000):
+    """Count the train examples of opt['task'] in dictionary.
+    - workers is the number of processes tokenizing the examples, 1 tokenizes
+      them in this process
+    Returns the number of counted examples.
+    """
+    ordered_opt = copy.deepcopy(opt)
+    ordered_opt['datatype'] = 'train:ordered'
+    if 'stream' in opt['datatype']:
+        ordered_opt['datatype'] += ':stream'
+    ordered_opt['numthreads'] = 1
+    ordered_opt['batchsize'] = 1
+    examples = teacher_examples(ordered_opt)
+    if opt.get('dict_maxexs', 0) > 0:
+        examples = itertools.islice(examples, opt['dict_maxexs'])
+    chunks = _chunks(examples, chunk_size)
+
+    if workers > 1:
+        worker_opt = copy.deepcopy(opt)
+        # workers only tokenize, SQuAD's dictionary does not need to index the embeddings for that
+        worker_opt['pretrained_words'] = False
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(type(dictionary), worker_opt))
+        tokenized = pool.imap(_tokenize_chunk, chunks)
+    else:
+        pool = None
+        tokenized = (tokenize_examples(dictionary, chunk) for chunk in chunks)
+
+    text_dict, labels_dict = counting_dictionaries(dictionary)
+    count = 0
+    try:
+        for chunk in tokenized:
+            for text_tokens, label_tokens in chunk:
+                if text_tokens is not None:
+                    text_dict.add_to_dict(text_tokens)
+                for tokens in label_tokens:
+                    labels_dict.add_to_dict(tokens)
+            count += len(chunk)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return count
@@ -0,0 +1,284 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+HTTP/JSON inference server with dynamic micro-batching.
+
+Skills are configured with a JSON file:
+
+    {"skills": {"insults": {"args": ["-m", "deeppavlov.agents.insults.insults_agents:InsultsAgent",
+                                     "--model_file", "./build/insults/cnn_word_0", ...],
+                            "max_batch_size": 64, "max_delay": 0.01, "max_queue": 1024}}}
+
+where args are command line arguments of the agent. Requests are sent as
+
+    POST /<skill>  {"inputs": [<input>, ...]}
+
+and answered with {"outputs": [<output>, ...]}. Inputs are the ones of the
+agent's predict(): texts, [sentence, sentence] or [context, question] pairs.
+Concurrent requests of a skill are coalesced into one predict() call of at most
+max_batch_size inputs, waiting at most max_delay seconds for the batch to fill.
+Larger requests are split over several calls. A skill with max_queue batch
+parts waiting answers 503. GET /metrics returns
+per-skill latency and throughput.
+
+Run with:
+
+python -m deeppavlov.utils.inference_server --config skills.json --port 8080
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import resources
+from .perf import percentile
+from .tf_session import set_cpu_affinity
+
+
+class SkillBatcher(object):
+    """Coalesces requests to one agent into batches."""
+
+    def __init__(self, name, agent, max_batch_size=64, max_delay=0.01, max_queue=1024, loop=None):
+        self.name = name
+        self.agent = agent
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = asyncio.Queue(max_queue)
+        # the agent is not thread safe, so all its batches run on one thread
+        self.executor = ThreadPoolExecutor(1)
+
+        self.start_time = time.time()
+        self.requests = 0
+        self.inputs = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batches = 0
+        self.latencies = collections.deque(maxlen=10000)
+        self.batch_sizes = collections.deque(maxlen=10000)
+        self.finished = collections.deque(maxlen=10000)
+
+    def full(self, n_inputs=1):
+        """Whether the queue has no room for a request of n_inputs inputs."""
+        parts = max(1, -(-n_inputs // self.max_batch_size))
+        return 0 < self.queue.maxsize < self.queue.qsize() + parts
+
+    async def predict(self, inputs):
+        """Return outputs for a list of inputs once its batches are computed,
+        inputs above max_batch_size are split over several batches.
+        """
+        received = time.time()
+        futures = []
+        for start in range(0, len(inputs), self.max_batch_size):
+            futures.append(self.loop.create_future())
+            self.queue.put_nowait((inputs[start:start + self.max_batch_size], futures[-1]))
+        parts = await asyncio.gather(*futures, return_exceptions=True)
+        errors = [part for part in parts if isinstance(part, Exception)]
+        if errors:
+            self.errors += 1
+            raise errors[0]
+        now = time.time()
+        self.requests += 1
+        self.inputs += len(inputs)
+        self.latencies.append(now - received)
+        self.finished.append(now)
+        return [x for part in parts for x in part]
+
+    async def run(self):
+        request = None
+        while True:
+            requests = [request or await self.queue.get()]
+            request = None
+            size = len(requests[0][0])
+            deadline = self.loop.time() + self.max_delay
+            while size < self.max_batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if size + len(request[0]) > self.max_batch_size:
+                    # it starts the next batch
+                    break
+                requests.append(request)
+                size += len(request[0])
+                request = None
+            await self._process(requests)
+
+    async def _process(self, requests):
+        inputs = [x for request in requests for x in request[0]]
+        try:
+            outputs = await self.loop.run_in_executor(self.executor, self.agent.predict, inputs)
+            outputs = _to_json(outputs)
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.batch_sizes.append(len(inputs))
+        start = 0
+        for request_inputs, future in requests:
+            if not future.done():
+                future.set_result(outputs[start:start + len(request_inputs)])
+            start += len(request_inputs)
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+        now = time.time()
+        recent = [t for t in self.finished if now - t <= 60]
+        return {'requests': self.requests,
+                'inputs': self.inputs,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'batches': self.batches,
+                'queued': self.queue.qsize(),
+                'mean_batch_size': sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0,
+                'requests_per_sec': self.requests / (now - self.start_time),
+                'requests_per_sec_last_minute': len(recent) / min(60, now - self.start_time),
+                'latency_p50': percentile(latencies, 50),
+                'latency_p90': percentile(latencies, 90),
+                'latency_p99': percentile(latencies, 99)}
+
+
+def _to_json(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return [x.tolist() if hasattr(x, 'tolist') else x for x in value]
+
+
+class InferenceServer(object):
+    """Minimal HTTP/1.1 server routing requests to skill batchers."""
+
+    def __init__(self, batchers, loop=None):
+        self.batchers = batchers
+        self.loop = loop or asyncio.get_event_loop()
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, response = await self.route(method, path, body)
+        except Exception as e:
+            status, response = 400, {'error': repr(e)}
+        data = json.dumps(response).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, _REASONS[status], len(data)).encode('latin-1'))
+        writer.write(data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        name = path.strip('/')
+        if method == 'GET' and name == 'metrics':
+            return 200, {name: batcher.metrics() for name, batcher in self.batchers.items()}
+        if method == 'GET' and name == 'health':
+            return 200, {'skills': sorted(self.batchers)}
+        if method != 'POST' or name not in self.batchers:
+            return 404, {'error': 'unknown skill ' + name}
+        batcher = self.batchers[name]
+        inputs = json.loads(body.decode('utf-8'))['inputs']
+        if batcher.full(len(inputs)):
+            batcher.rejected += 1
+            return 503, {'error': 'queue of ' + name + ' is full, retry later'}
+        try:
+            outputs = await batcher.predict(inputs)
+        except Exception as e:
+            return 500, {'error': repr(e)}
+        return 200, {'outputs': outputs}
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def load_skills(config, loop=None):
+    """Create agents and their batchers from a config dictionary."""
+    from parlai.core.agents import create_agent
+    from parlai.core.params import ParlaiParser
+
+    batchers = {}
+    for name, skill in config['skills'].items():
+        print('[ loading skill ' + name + ' ]')
+        opt = ParlaiParser(True, True, model_argv=skill['args']).parse_args(args=skill['args'])
+        opt['datatype'] = 'test'
+        batchers[name] = SkillBatcher(name, create_agent(opt),
+                                      max_batch_size=skill.get('max_batch_size', 64),
+                                      max_delay=skill.get('max_delay', 0.01),
+                                      max_queue=skill.get('max_queue', 1024),
+                                      loop=loop)
+    resources.print_memory_report()
+    return batchers
+
+
+def serve(config, host='0.0.0.0', port=8080, gpu=False, cpu_affinity=None):
+    """Load skills from a config dictionary and serve them until interrupted."""
+    if not gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    # pins the whole process, --cpu-affinity of a skill only sizes its thread pool
+    set_cpu_affinity(cpu_affinity)
+    loop = asyncio.get_event_loop()
+    batchers = load_skills(config, loop)
+    server = InferenceServer(batchers, loop)
+    tasks = [loop.create_task(batcher.run()) for batcher in batchers.values()]
+    http = loop.run_until_complete(asyncio.start_server(server.handle, host, port))
+    print('[ serving {} on {}:{} ]'.format(', '.join(sorted(batchers)), host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http.close()
+        for t in tasks:
+            t.cancel()
+        loop.run_until_complete(http.wait_closed())
+        for batcher in batchers.values():
+            batcher.executor.shutdown()
+            batcher.agent.shutdown()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serve trained agents over HTTP/JSON.')
+    parser.add_argument('--config', required=True, help='JSON file with skills')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--gpu', action='store_true', help='allow models to use GPUs')
+    parser.add_argument('--cpu-affinity', default=None, help='cpus the server runs on, e.g. 0-3,8')
+    args = parser.parse_args(args)
+    with open(args.config) as f:
+        config = json.load(f)
+    serve(config, args.host, args.port, args.gpu, args.cpu_affinity)
+
+
+if __name__ == '__main__':
+    main()
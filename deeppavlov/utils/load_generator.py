@@ -0,0 +1,99 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Load generator for the inference server.
+
+Run with, e.g.:
+
+python -m deeppavlov.utils.load_generator --skill insults --inputs inputs.json --concurrency 32 --duration 30
+
+where inputs.json is a JSON list of inputs sent to the skill one per request.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from .perf import percentile
+
+
+async def _post(host, port, path, payload):
+    reader, writer = await asyncio.open_connection(host, port)
+    data = json.dumps(payload).encode('utf-8')
+    writer.write('POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                 'Connection: close\r\n\r\n'.format(path, host, len(data)).encode('latin-1'))
+    writer.write(data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status = int(response.split(b' ', 2)[1])
+    return status, json.loads(response.split(b'\r\n\r\n', 1)[1].decode('utf-8'))
+
+
+async def _client(host, port, skill, inputs, offset, deadline, stats):
+    i = offset
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            status, _ = await _post(host, port, '/' + skill, {'inputs': [inputs[i % len(inputs)]]})
+        except (OSError, ValueError):
+            status = None
+        stats.setdefault(status, []).append(time.time() - start)
+        i += 1
+
+
+def generate_load(host, port, skill, inputs, concurrency=16, duration=10.0):
+    """Send requests from `concurrency` clients for `duration` seconds.
+    Returns throughput and latency percentiles of successful requests.
+    """
+    loop = asyncio.get_event_loop()
+    stats = {}
+    deadline = time.time() + duration
+    start = time.time()
+    loop.run_until_complete(asyncio.gather(*[_client(host, port, skill, inputs, n, deadline, stats)
+                                             for n in range(concurrency)]))
+    elapsed = time.time() - start
+    latencies = sorted(stats.get(200, []))
+    result = {'requests': sum(len(v) for v in stats.values()),
+              'ok': len(latencies),
+              'rejected': len(stats.get(503, [])),
+              'failed': sum(len(v) for k, v in stats.items() if k not in (200, 503)),
+              'requests_per_sec': len(latencies) / elapsed,
+              'latency_p50': percentile(latencies, 50),
+              'latency_p90': percentile(latencies, 90),
+              'latency_p99': percentile(latencies, 99)}
+    print('[ {} ok:{} rejected:{} failed:{} rps:{:.1f} p50:{:.1f}ms p90:{:.1f}ms p99:{:.1f}ms ]'.format(
+        skill, result['ok'], result['rejected'], result['failed'], result['requests_per_sec'],
+        1000 * result['latency_p50'], 1000 * result['latency_p90'], 1000 * result['latency_p99']))
+    return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Generate load for the inference server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--skill', required=True)
+    parser.add_argument('--inputs', required=True, help='JSON file with a list of inputs')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args(args)
+    with open(args.inputs) as f:
+        inputs = json.load(f)
+    return generate_load(args.host, args.port, args.skill, inputs, args.concurrency, args.duration)
+
+
+if __name__ == '__main__':
+    main()
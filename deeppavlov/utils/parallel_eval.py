@@ -0,0 +1,83 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import threading
+
+from parlai.core.agents import create_agent_from_shared
+
+
+def check_numthreads(opt):
+    """Reject Hogwild, agents of TF models act in several threads with --eval-threads instead."""
+    if opt.get('numthreads', 1) > 1:
+        # Hogwild forks processes, which can not share the TF session of the model
+        raise RuntimeError("numthreads > 1 not supported for this model, "
+                           "use --eval-threads to evaluate in several threads.")
+
+
+def supported(world, agent, threads):
+    """Threaded evaluation needs a batch world with at least one sub-world per thread
+    and an agent whose shared copies act concurrently, marked by thread_safe_share.
+    Other agents are evaluated in one thread.
+    """
+    return threads > 1 and hasattr(world, 'worlds') and len(world.worlds) >= threads and \
+        getattr(agent, 'thread_safe_share', False)
+
+
+def evaluate_in_threads(world, agent, threads, max_exs=-1):
+    """Run an evaluation epoch of a batch world with several threads.
+
+    Sub-worlds of the batch world are split between the threads. Every thread
+    acts with its own shared copy of the agent, so the model is called from
+    all threads at once. Returns the report of the world.
+    """
+    lock = threading.Lock()
+    counter = {'exs': 0}
+    errors = []
+
+    def run(worlds, thread_agent):
+        try:
+            teachers = [w.get_agents()[0] for w in worlds]
+            copies = [w.get_agents()[1] for w in worlds]
+            while not all(teacher.epoch_done() for teacher in teachers):
+                with lock:
+                    if 0 < max_exs <= counter['exs']:
+                        return
+                    counter['exs'] += len(teachers)
+                acts = [teacher.act() for teacher in teachers]
+                observations = [a.observe(act) for a, act in zip(copies, acts)]
+                replies = thread_agent.batch_act(observations)
+                # teachers share their metrics
+                with lock:
+                    for w, act, reply in zip(worlds, acts, replies):
+                        w.get_acts()[0] = act
+                        w.get_acts()[1] = reply
+                        w.get_agents()[0].observe(reply)
+        except BaseException as e:
+            errors.append(e)
+
+    shared = agent.share()
+    workers = []
+    for n in range(threads):
+        thread_agent = create_agent_from_shared(shared)
+        worker = threading.Thread(target=run, args=(world.worlds[n::threads], thread_agent),
+                                  name='eval-{}'.format(n))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    return world.report()
@@ -0,0 +1,137 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    index = int(round(q / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class PhaseTimer(object):
+    """Collects durations of training loop phases between two summaries.
+
+    Phases may be nested, a phase is charged only with the time not spent in
+    its nested phases. Absorbing phases (validation, saving) are charged with
+    all the time spent inside them. Phases can be timed from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._durations = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name, absorb=False):
+        stack = self._local.__dict__.setdefault('stack', [])
+        if stack and stack[-1]['absorb']:
+            yield
+            return
+        frame = {'start': time.perf_counter(), 'nested': 0.0, 'absorb': absorb}
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed = time.perf_counter() - frame['start']
+            if stack:
+                stack[-1]['nested'] += elapsed
+            with self._lock:
+                self._durations.setdefault(name, []).append(elapsed - frame['nested'])
+
+    def wrap(self, name, method):
+        """Return the method timed as the given phase."""
+        def timed(*args, **kwargs):
+            with self.phase(name):
+                return method(*args, **kwargs)
+        return timed
+
+    def summary(self):
+        """Return phase statistics since the last summary and start a new interval."""
+        with self._lock:
+            durations, self._durations = self._durations, {}
+            now = time.perf_counter()
+            wall, self._start = now - self._start, now
+        phases = {}
+        for name, values in durations.items():
+            values.sort()
+            total = sum(values)
+            phases[name] = {'count': len(values),
+                            'total': total,
+                            'share': total / wall if wall > 0 else 0.0,
+                            'p50': percentile(values, 50),
+                            'p90': percentile(values, 90),
+                            'p99': percentile(values, 99)}
+        exs = phases['teacher_act']['count'] if 'teacher_act' in phases else 0
+        return {'wall': wall,
+                'exs': exs,
+                'exs_per_sec': exs / wall if wall > 0 else 0.0,
+                'phases': phases}
+
+
+def instrument_world(world, timer):
+    """Time teacher act/observe, agent observe, batch building and the model step of a world."""
+    wrapped = set()
+
+    def wrap(obj, method, name):
+        if obj is None or not hasattr(obj, method) or (id(obj), method) in wrapped:
+            return
+        wrapped.add((id(obj), method))
+        setattr(obj, method, timer.wrap(name, getattr(obj, method)))
+
+    if hasattr(world, 'worlds'):
+        # BatchWorld acts with the original agent and observes with its copies
+        agent = world.world.get_agents()[-1]
+        worlds = world.worlds
+    else:
+        agent = world.get_agents()[-1]
+        worlds = [world]
+    wrap(agent, 'prepare_batch', 'prepare_batch')
+    if hasattr(agent, 'batch_act'):
+        wrap(agent, 'batch_act', 'model_step')
+    else:
+        wrap(agent, 'act', 'model_step')
+    for w in worlds:
+        agents = w.get_agents()
+        wrap(agents[0], 'act', 'teacher_act')
+        wrap(agents[0], 'observe', 'teacher_observe')
+        for a in agents[1:]:
+            wrap(a, 'observe', 'observe')
+
+
+def format_summary(summary):
+    """One line log of a summary."""
+    logs = ['exs/s:{:.1f}'.format(summary['exs_per_sec'])]
+    for name, stats in sorted(summary['phases'].items(), key=lambda x: -x[1]['total']):
+        logs.append('{}:{:.0%}(p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms)'.format(
+            name, stats['share'], 1000 * stats['p50'], 1000 * stats['p90'], 1000 * stats['p99']))
+    return '[ perf {} ]'.format(' '.join(logs))
+
+
+def write_summary(path, summary, **fields):
+    """Append a summary with extra fields as a JSON line."""
+    record = dict(fields)
+    record.update(summary)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
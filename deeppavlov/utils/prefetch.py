@@ -0,0 +1,210 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import contextlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from parlai.core.worlds import validate
+
+
+class PrefetchWorld(object):
+    """Training world wrapper that prepares the next batches in background threads.
+
+    One producer thread drives the teachers and the agent's observe() in the
+    usual order, so teacher shuffling is the same as without prefetching.
+    Batches are built with agent.prepare_batch() and handed to the main thread
+    through a queue of at most `prefetch_batches` batches, while the main thread
+    runs agent.batch_act() and lets the teachers observe the replies.
+
+    In deterministic mode batches are prepared one by one by the producer, so
+    random draws made during preparation keep their order. Otherwise they are
+    prepared by `prefetch_workers` threads. Batches are always consumed in order.
+
+    The training loop pauses the preparation with paused() while it validates or
+    saves the agent, as preparing batches changes the agent's dictionaries.
+    """
+
+    def __init__(self, opt, world):
+        self.world = world
+        # BatchWorld keeps one sub-world per example of the batch
+        self.worlds = getattr(world, 'worlds', [world])
+        if hasattr(world, 'worlds'):
+            self.agent = world.world.get_agents()[1]
+        else:
+            self.agent = world.get_agents()[1]
+        self.prefetch_batches = max(1, opt.get('prefetch_batches', 1))
+        self.deterministic = opt.get('prefetch_deterministic', True)
+        self.workers = max(1, opt.get('prefetch_workers', 1))
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(self.prefetch_batches)
+        self._stop = threading.Event()
+        self._resume = threading.Event()
+        # batches are prepared while not paused, see paused()
+        self._pause = threading.Condition()
+        self._paused = False
+        self._preparing = 0
+        self._producer = None
+        self._executor = None
+        self._epoch_done = False
+
+    @staticmethod
+    def supported(world):
+        """Prefetching needs two-agent worlds, dialog teachers and a batch_act agent."""
+        worlds = getattr(world, 'worlds', [world])
+        for w in worlds:
+            agents = w.get_agents()
+            if len(agents) != 2 or not hasattr(agents[0], 'lastY'):
+                return False
+        agent = world.world.get_agents()[1] if hasattr(world, 'worlds') else worlds[0].get_agents()[1]
+        return hasattr(agent, 'batch_act')
+
+    @contextlib.contextmanager
+    def _using_agent(self):
+        with self._pause:
+            while self._paused:
+                self._pause.wait()
+            self._preparing += 1
+        try:
+            yield
+        finally:
+            with self._pause:
+                self._preparing -= 1
+                self._pause.notify_all()
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Wait for the batches being prepared and prepare no others in the block."""
+        with self._pause:
+            self._paused = True
+            while self._preparing:
+                self._pause.wait()
+        try:
+            yield
+        finally:
+            with self._pause:
+                self._paused = False
+                self._pause.notify_all()
+
+    def _prepare(self, observations):
+        if hasattr(self.agent, 'prepare_batch'):
+            return self.agent.prepare_batch(observations)
+        return None
+
+    def _prepare_in_worker(self, observations):
+        with self._using_agent():
+            return self._prepare(observations)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    acts = [w.get_agents()[0].act() for w in self.worlds]
+                    labels = [w.get_agents()[0].lastY for w in self.worlds]
+                    epoch_done = self.world.epoch_done()
+                with self._using_agent():
+                    observations = [w.get_agents()[1].observe(validate(act))
+                                    for w, act in zip(self.worlds, acts)]
+                    if self.deterministic:
+                        batch = self._prepare(observations)
+                if not self.deterministic:
+                    batch = self._executor.submit(self._prepare_in_worker, observations)
+                if epoch_done:
+                    self._resume.clear()
+                if not self._put((acts, labels, observations, batch, epoch_done, None)):
+                    return
+                if epoch_done:
+                    # the main thread resets the world before the next epoch starts
+                    while not self._resume.wait(0.1):
+                        if self._stop.is_set():
+                            return
+        except BaseException as e:
+            self._put((None, None, None, None, None, e))
+
+    def _start(self):
+        if not self.deterministic:
+            self._executor = ThreadPoolExecutor(self.workers)
+        self._producer = threading.Thread(target=self._produce, name='prefetch')
+        self._producer.daemon = True
+        self._producer.start()
+
+    def parley(self):
+        if self._producer is None:
+            self._start()
+        acts, labels, observations, batch, epoch_done, error = self._queue.get()
+        if error is not None:
+            raise error
+        if not self.deterministic:
+            batch = batch.result()
+
+        if hasattr(self.agent, 'prepare_batch'):
+            replies = self.agent.batch_act(observations, batch)
+        else:
+            replies = self.agent.batch_act(observations)
+
+        with self._lock:
+            for w, act, y, reply in zip(self.worlds, acts, labels, replies):
+                teacher = w.get_agents()[0]
+                # the producer may already have moved the teacher to the next batch
+                teacher.lastY = y
+                w.get_acts()[0] = act
+                w.get_acts()[1] = reply
+                teacher.observe(reply)
+        self._epoch_done = epoch_done
+
+    def epoch_done(self):
+        return self._epoch_done
+
+    def reset(self):
+        with self._lock:
+            self.world.reset()
+        self._epoch_done = False
+        self._resume.set()
+
+    def report(self):
+        with self._lock:
+            return self.world.report()
+
+    def reset_metrics(self):
+        with self._lock:
+            self.world.reset_metrics()
+
+    def shutdown(self):
+        self._stop.set()
+        if self._producer is not None:
+            self._producer.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.world.shutdown()
+
+    def __len__(self):
+        return len(self.world)
+
+    def __getattr__(self, name):
+        if name == 'world':
+            raise AttributeError(name)
+        return getattr(self.world, name)
@@ -0,0 +1,105 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Process-wide registry of heavy resources shared between agents.
+
+Resources are keyed by kind and path (e.g. 'fasttext' and the model file),
+loaded once on first acquire() and dropped when the last user releases them.
+"""
+
+import os
+import sys
+import threading
+
+_lock = threading.RLock()
+_resources = {}
+
+
+class _Resource(object):
+    def __init__(self, value, sizeof):
+        self.value = value
+        self.sizeof = sizeof
+        self.refs = 0
+
+
+def acquire(kind, key, loader, sizeof=None):
+    """Return a shared resource, calling loader() to create it on first use.
+    sizeof(value) estimates the memory used by the resource in bytes.
+    """
+    with _lock:
+        resource = _resources.get((kind, key))
+        if resource is None:
+            resource = _Resource(loader(), sizeof)
+            _resources[(kind, key)] = resource
+            print('[ loaded {} {}: {} ]'.format(kind, key, _format_bytes(_nbytes(resource))))
+        else:
+            print('[ reusing {} {} ]'.format(kind, key))
+        resource.refs += 1
+        return resource.value
+
+
+def release(kind, key):
+    """Drop a reference to a resource, the resource is freed with the last one."""
+    with _lock:
+        resource = _resources.get((kind, key))
+        if resource is None:
+            return
+        resource.refs -= 1
+        if resource.refs <= 0:
+            del _resources[(kind, key)]
+
+
+def register(kind, key, value, sizeof=None):
+    """Put an already created resource into the registry for reuse, if absent."""
+    return acquire(kind, key, lambda: value, sizeof)
+
+
+def contains(kind, key):
+    """Check whether a resource is loaded, e.g. to skip downloading its file."""
+    with _lock:
+        return (kind, key) in _resources
+
+
+def file_nbytes(path):
+    """Size estimate of a resource loaded fully from a file."""
+    return lambda value: os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def dict_nbytes(d):
+    """Size estimate of a dictionary of numpy arrays."""
+    return sys.getsizeof(d) + sum(sys.getsizeof(k) + getattr(v, 'nbytes', sys.getsizeof(v))
+                                  for k, v in list(d.items()))
+
+
+def _nbytes(resource):
+    return resource.sizeof(resource.value) if resource.sizeof is not None else 0
+
+
+def _format_bytes(n):
+    return '{:.1f}MB'.format(n / 2 ** 20)
+
+
+def memory_report():
+    """Return kind, key, number of references and estimated bytes of every resource."""
+    with _lock:
+        return [{'kind': kind, 'key': key, 'refs': resource.refs, 'bytes': _nbytes(resource)}
+                for (kind, key), resource in sorted(_resources.items(), key=lambda x: str(x[0]))]
+
+
+def print_memory_report():
+    report = memory_report()
+    for item in report:
+        print('[ {kind} {key}: refs {refs}, '.format(**item) + _format_bytes(item['bytes']) + ' ]')
+    print('[ shared resources total: ' + _format_bytes(sum(item['bytes'] for item in report)) + ' ]')
@@ -0,0 +1,131 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Saving models without stalling training.
+
+Agents supporting it implement save_snapshot(fname=None): it captures the
+state that save() writes in memory and returns a function writing that state.
+AsyncSaver runs these functions in a background thread. Files are written to
+a temporary name and renamed, so a reader never sees a half written file.
+"""
+
+import collections
+import contextlib
+import os
+import threading
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w'):
+    """Open a temporary file that replaces path when closed without an error."""
+    tmp = path + '.tmp'
+    with open(tmp, mode) as f:
+        yield f
+    os.replace(tmp, path)
+
+
+def keras_weights(model):
+    """Snapshot of the weights of a Keras model, written by write_keras_weights.
+    Must be called within the graph and session of the model.
+    """
+    from keras import backend as K
+    layers = [(layer.name, layer.weights) for layer in model.layers]
+    values = iter(K.batch_get_value([w for _, weights in layers for w in weights]))
+    return [(name, [(w.name if getattr(w, 'name', None) else 'param_{}'.format(i), next(values))
+                    for i, w in enumerate(weights)])
+            for name, weights in layers]
+
+
+def write_keras_weights(path, snapshot):
+    """Write a snapshot of keras_weights in the HDF5 layout of Model.save_weights,
+    so that Model.load_weights reads it.
+    """
+    import h5py
+    import keras
+    from keras import backend as K
+    tmp = path + '.tmp'
+    with h5py.File(tmp, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _ in snapshot]
+        f.attrs['backend'] = K.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+        for name, weights in snapshot:
+            group = f.create_group(name)
+            group.attrs['weight_names'] = [weight_name.encode('utf8') for weight_name, _ in weights]
+            for weight_name, value in weights:
+                dataset = group.create_dataset(weight_name, value.shape, dtype=value.dtype)
+                if not value.shape:
+                    dataset[()] = value
+                else:
+                    dataset[:] = value
+    os.replace(tmp, path)
+
+
+class AsyncSaver(object):
+    """Runs save functions one by one in a background thread.
+
+    A save submitted under a key replaces the save of that key that has not
+    started yet, so only the latest state is written when saves come faster
+    than they are written. Writing is timed as the 'save_write' phase of perf.
+    An error of a background save is raised by the next submit or wait.
+    """
+
+    def __init__(self, perf=None):
+        self.perf = perf
+        self.coalesced = 0
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._writing = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='AsyncSaver', daemon=True)
+        self._thread.start()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Saving in background failed: {}'.format(repr(error))) from error
+
+    def submit(self, key, write):
+        with self._cond:
+            self._raise_error()
+            if key in self._pending:
+                self.coalesced += 1
+                del self._pending[key]
+            self._pending[key] = write
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                _, write = self._pending.popitem(last=False)
+                self._writing = True
+            try:
+                with self.perf.phase('save_write') if self.perf is not None else contextlib.suppress():
+                    write()
+            except BaseException as e:
+                with self._cond:
+                    self._error = e
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def wait(self):
+        """Block until every submitted save is written."""
+        with self._cond:
+            while self._pending or self._writing:
+                self._cond.wait()
+            self._raise_error()
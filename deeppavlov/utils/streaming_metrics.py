@@ -0,0 +1,134 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Binary classification metrics updated one example at a time.
+
+Teachers keep these accumulators instead of the lists of all labels and
+predictions, so reporting costs the same however many examples were seen.
+"""
+
+import collections
+import math
+
+import numpy as np
+
+
+class ConfusionCounts(object):
+    """Confusion matrix of a binary classifier."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.tp = self.fp = self.tn = self.fn = 0
+
+    def update(self, y_true, y_pred):
+        if y_true:
+            if y_pred:
+                self.tp += 1
+            else:
+                self.fn += 1
+        elif y_pred:
+            self.fp += 1
+        else:
+            self.tn += 1
+
+    @property
+    def count(self):
+        return self.tp + self.fp + self.tn + self.fn
+
+    def accuracy(self):
+        return (self.tp + self.tn) / self.count if self.count else 0
+
+    def precision(self):
+        return self.tp / (self.tp + self.fp + 10e-8)
+
+    def recall(self):
+        return self.tp / (self.tp + self.fn + 10e-8)
+
+    def fbeta(self, beta=1):
+        """F score computed as paraphrases.metric.fbeta_score, 0 without positive examples."""
+        if beta < 0:
+            raise ValueError('The lowest choosable beta is zero (only precision).')
+        if self.tp + self.fn == 0:
+            return 0
+        p = self.precision()
+        r = self.recall()
+        bb = beta ** 2
+        return (1 + bb) * (p * r) / (bb * p + r + 10e-8)
+
+
+class LogLoss(object):
+    """Mean binary cross entropy, scores are clipped to [eps, 1 - eps] as in sklearn's log_loss."""
+
+    def __init__(self, eps=1e-15):
+        self.eps = eps
+        self.clear()
+
+    def clear(self):
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, y_true, score):
+        score = min(max(score, self.eps), 1 - self.eps)
+        self.total -= math.log(score) if y_true else math.log(1 - score)
+        self.count += 1
+
+    def value(self):
+        return self.total / self.count if self.count else 0
+
+
+class HistogramAUC(object):
+    """ROC AUC from the counts of positive and negative examples by score.
+
+    Scores in [0, 1] are counted in bins of equal width and examples of one
+    bin are taken as ties, so the error is at most half the share of
+    positive-negative pairs falling into one bin. With bins=None every
+    distinct score is counted and the AUC equals sklearn's roc_auc_score.
+    The AUC is 0 until examples of both classes are seen.
+    """
+
+    def __init__(self, bins=10000):
+        self.bins = bins
+        self.clear()
+
+    def clear(self):
+        if self.bins:
+            self.positive = np.zeros(self.bins, dtype=np.int64)
+            self.negative = np.zeros(self.bins, dtype=np.int64)
+        else:
+            self.positive = collections.Counter()
+            self.negative = collections.Counter()
+
+    def update(self, y_true, score):
+        if self.bins:
+            score = min(max(int(score * self.bins), 0), self.bins - 1)
+        if y_true:
+            self.positive[score] += 1
+        else:
+            self.negative[score] += 1
+
+    def value(self):
+        if self.bins:
+            positive, negative = self.positive, self.negative
+        else:
+            scores = sorted(set(self.positive) | set(self.negative))
+            positive = np.array([self.positive[s] for s in scores], dtype=np.int64)
+            negative = np.array([self.negative[s] for s in scores], dtype=np.int64)
+        n_positive, n_negative = positive.sum(), negative.sum()
+        if n_positive == 0 or n_negative == 0:
+            return 0
+        negative_below = np.cumsum(negative) - negative
+        return float((positive * (negative_below + 0.5 * negative)).sum() / (n_positive * n_negative))
@@ -0,0 +1,215 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+TensorFlow session factory used by every model.
+
+Every model owns a private graph and session (ModelGraph) and never touches
+the default graph, so models of several skills can live in one process.
+Sessions are created with the models instead of at import time. Thread pools
+are set from the --intra-op-threads and --inter-op-threads options, see
+README.MD for choosing them when several models share a node. --cpu-affinity
+pins the whole process, so entry points apply it once with set_cpu_affinity
+before loading models. GPU options default to the ones of each model and
+are overridden by the --gpu-* options.
+
+Trained models are exported with freeze() to inference-only artifacts that
+FrozenModel loads when --frozen-model is set.
+"""
+
+import contextlib
+import functools
+import json
+import os
+
+
+def add_cmdline_args(argparser):
+    group = argparser.add_argument_group('TensorFlow Session Arguments')
+    group.add_argument('--intra-op-threads', type=int, default=0,
+                       help='threads used to run a single op, 0 uses one thread per available cpu')
+    group.add_argument('--inter-op-threads', type=int, default=0,
+                       help='threads used to run independent ops at the same time, '
+                            '0 lets TensorFlow choose')
+    group.add_argument('--cpu-affinity', type=str, default=None,
+                       help='cpus the process runs on, e.g. 0-3,8')
+    group.add_argument('--gpu-memory-fraction', type=float, default=0,
+                       help='share of the GPU memory a session allocates, 0 keeps the default of the model')
+    group.add_argument('--gpu-allow-growth', type='bool', default=None,
+                       help='allocate GPU memory as needed, by default as the model does')
+    group.add_argument('--gpu-devices', type=str, default=None,
+                       help='GPUs visible to the sessions, e.g. 0,1, by default as the model does')
+    group.add_argument('--frozen-model', type='bool', default=False,
+                       help='load the inference-only artifact written by pyb export_<skill> '
+                            'instead of the trainable model')
+
+
+def parse_cpus(spec):
+    """Set of cpus from a list of cpus and cpu ranges, e.g. 0-3,8."""
+    cpus = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+def set_cpu_affinity(spec):
+    """Pin the process to the cpus of spec, if the platform supports it."""
+    if not spec:
+        return
+    if not hasattr(os, 'sched_setaffinity'):
+        print('[ cpu affinity is not supported on this platform, ignoring --cpu-affinity ]')
+        return
+    os.sched_setaffinity(0, parse_cpus(spec))
+
+
+def _available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def session_config(opt=None, gpu_options=None):
+    """ConfigProto of the sessions created for skills.
+    gpu_options are the GPUOptions fields a model sets by default.
+    With --cpu-affinity and no --intra-op-threads the op thread pool is sized
+    to the pinned cpus instead of all cpus of the machine.
+    """
+    import tensorflow as tf
+    opt = opt or {}
+    gpu_options = dict(gpu_options or {})
+    if opt.get('gpu_memory_fraction'):
+        gpu_options['per_process_gpu_memory_fraction'] = opt['gpu_memory_fraction']
+    if opt.get('gpu_allow_growth') is not None:
+        gpu_options['allow_growth'] = opt['gpu_allow_growth']
+    if opt.get('gpu_devices') is not None:
+        gpu_options['visible_device_list'] = opt['gpu_devices']
+    config = tf.ConfigProto()
+    for name, value in gpu_options.items():
+        setattr(config.gpu_options, name, value)
+    intra_op_threads = opt.get('intra_op_threads') or 0
+    if not intra_op_threads and opt.get('cpu_affinity'):
+        intra_op_threads = len(parse_cpus(opt['cpu_affinity']))
+    config.intra_op_parallelism_threads = intra_op_threads
+    config.inter_op_parallelism_threads = opt.get('inter_op_threads') or 0
+    return config
+
+
+def new_session(opt=None, graph=None, gpu_options=None):
+    """Create a session configured by the session options of opt."""
+    import tensorflow as tf
+    config = session_config(opt, gpu_options)
+    print('[ TensorFlow session: {} intra-op, {} inter-op threads on {} cpus ]'.format(
+        config.intra_op_parallelism_threads or 'default', config.inter_op_parallelism_threads or 'default',
+        _available_cpus()))
+    return tf.Session(graph=graph, config=config)
+
+
+class ModelGraph(object):
+    """Private graph and session of a model."""
+
+    def __init__(self, opt=None, gpu_options=None):
+        import tensorflow as tf
+        self.graph = tf.Graph()
+        self.session = new_session(opt, graph=self.graph, gpu_options=gpu_options)
+
+    @contextlib.contextmanager
+    def as_default(self):
+        """Make the graph and the session default for TensorFlow and Keras calls.
+        Keras uses the default session over its global one, so Keras models
+        built and run within this context stay in the private graph.
+        """
+        with self.graph.as_default(), self.session.as_default():
+            yield
+
+    def close(self):
+        self.session.close()
+
+
+def in_model_graph(method):
+    """Run a method of a model within the ModelGraph in its model_graph attribute."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.model_graph.as_default():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def frozen_files(fname):
+    """Graph and metadata files of the frozen artifact of a model saved to fname."""
+    return fname + '.frozen.pb', fname + '.frozen.json'
+
+
+def freeze(model_graph, inputs, outputs, fname, feed=None):
+    """Write an inference-only artifact of a model: the subgraph computing outputs
+    with variables folded into constants, so optimizer slots and training ops
+    are dropped. feed maps tensors to values fed on every run, e.g. the Keras
+    learning phase.
+    """
+    import tensorflow as tf
+    graph_file, meta_file = frozen_files(fname)
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        model_graph.session, model_graph.graph.as_graph_def(), [t.op.name for t in outputs])
+    with open(graph_file, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    meta = {
+        'inputs': [t.name for t in inputs],
+        'outputs': [t.name for t in outputs],
+        'feed': {t.name: value for t, value in (feed or {}).items()}
+    }
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+    print('[ frozen model with {} ops saved to {} ]'.format(len(graph_def.node), graph_file))
+
+
+class FrozenModel(object):
+    """Inference-only model imported from an artifact written by freeze().
+    predict_on_batch mirrors the Keras method, so it stands in for a Keras model
+    at prediction time.
+    """
+
+    def __init__(self, model_graph, fname):
+        import tensorflow as tf
+        graph_file, meta_file = frozen_files(fname)
+        with open(meta_file) as f:
+            meta = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(graph_file, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.model_graph = model_graph
+        graph = model_graph.graph
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.inputs = [graph.get_tensor_by_name(name) for name in meta['inputs']]
+        self.outputs = [graph.get_tensor_by_name(name) for name in meta['outputs']]
+        # tensors such as the learning phase may be pruned away with the training ops
+        ops = set(op.name for op in graph.get_operations())
+        self.feed = {graph.get_tensor_by_name(name): value for name, value in meta['feed'].items()
+                     if name.split(':')[0] in ops}
+
+    def run(self, inputs):
+        feed_dict = dict(self.feed)
+        feed_dict.update(zip(self.inputs, inputs))
+        return self.model_graph.session.run(self.outputs, feed_dict=feed_dict)
+
+    def predict_on_batch(self, x):
+        outputs = self.run(x if isinstance(x, list) else [x])
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def _make_predict_function(self):
+        pass
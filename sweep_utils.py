@@ -0,0 +1,302 @@
+"""
+Copyright 2017 Neural Networks and Deep Learning lab, MIPT
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Hyperparameter sweeps over build_utils.model on a single machine.
+
+A sweep is described by a JSON file, e.g.
+
+    {
+        "args": ["-t", "deeppavlov.tasks.insults.agents",
+                 "-m", "deeppavlov.agents.insults.insults_agents:InsultsAgent", ...],
+        "space": {
+            "--learning_rate": {"loguniform": [0.0001, 0.01]},
+            "--filters_cnn": [128, 256],
+            "--dropout_rate": {"uniform": [0.2, 0.6]}
+        },
+        "trials": 16,
+        "metric": "auc",
+        "mode": "max",
+        "workers": 4,
+        "cpus_per_trial": 2,
+        "median_stopping": {"grace_reports": 2, "min_trials": 3}
+    }
+
+Without "trials" the space must consist of lists and the full grid is run.
+Every trial trains in a process of its own pinned to cpus_per_trial cpus.
+Its validation reports go to <dir>/reports/<trial>.jsonl and it is stopped
+early when its best metric is worse than the median of the other trials after
+as many validations. "mode" is "max" when a higher metric is better (the
+default) and "min" when a lower one is, e.g. for a loss. Finished trials are kept in <dir>/results.csv, running the
+sweep again skips them, so an interrupted sweep resumes where it stopped.
+<dir> is the "dir" of the config or the config file name without extension.
+"""
+
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import time
+
+import build_utils as bu
+from deeppavlov.utils.tf_session import set_cpu_affinity
+
+FINISHED = ('done', 'stopped')
+
+
+def sample_trials(space, n_trials=None, seed=0):
+    """Parameters of the trials: the grid of the lists of space if n_trials is not set,
+    else n_trials random draws. Values are drawn from lists uniformly and from
+    {"uniform": [low, high]}, {"loguniform": [low, high]} and {"randint": [low, high]}.
+    """
+    names = sorted(space)
+    if n_trials is None:
+        if not all(isinstance(space[name], list) for name in names):
+            raise ValueError('Set "trials" to sample from ranges, only lists of values make a grid')
+        return [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+    rng = random.Random(seed)
+    return [{name: _sample(space[name], rng) for name in names} for _ in range(n_trials)]
+
+
+def _sample(values, rng):
+    if isinstance(values, list):
+        return rng.choice(values)
+    (kind, (low, high)), = values.items()
+    if kind == 'uniform':
+        return rng.uniform(low, high)
+    if kind == 'loguniform':
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    if kind == 'randint':
+        return rng.randint(low, high)
+    raise ValueError('Unknown distribution: {}'.format(kind))
+
+
+def _report_file(sweep_dir, trial_id):
+    return os.path.join(sweep_dir, 'reports', trial_id + '.jsonl')
+
+
+def read_reports(path):
+    """Best metric values of a trial after each of its validations."""
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line)['best'] for line in f if line.strip()]
+
+
+class MedianStopping(object):
+    """Validation hook of a trial, see build_utils.validation_hooks.
+    Records the best metric after every validation and stops the trial when it
+    is worse than the median of the other trials after the same number of validations.
+    """
+
+    def __init__(self, sweep_dir, trial_id, metric, mode='max', grace_reports=2, min_trials=3):
+        if mode not in ('min', 'max'):
+            raise ValueError('Unknown mode: {}, use "min" or "max"'.format(mode))
+        self.sweep_dir = sweep_dir
+        self.trial_id = trial_id
+        self.metric = metric
+        self.mode = mode
+        self.grace_reports = grace_reports
+        self.min_trials = min_trials
+        self.path = _report_file(sweep_dir, trial_id)
+        self.best = []
+        self.stopped = False
+        # a restarted trial reports from scratch
+        open(self.path, 'w').close()
+
+    def _other_trials(self):
+        reports_dir = os.path.dirname(self.path)
+        return [read_reports(os.path.join(reports_dir, fname)) for fname in os.listdir(reports_dir)
+                if fname.endswith('.jsonl') and fname != os.path.basename(self.path)]
+
+    def __call__(self, opt, valid_report):
+        if self.metric not in valid_report:
+            return False
+        value = float(valid_report[self.metric])
+        better = max if self.mode == 'max' else min
+        self.best.append(better(value, self.best[-1]) if self.best else value)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'value': value, 'best': self.best[-1]}) + '\n')
+
+        step = len(self.best)
+        if step < self.grace_reports:
+            return False
+        others = sorted(best[step - 1] for best in self._other_trials() if len(best) >= step)
+        if len(others) < self.min_trials:
+            return False
+        middle = len(others) // 2
+        median = others[middle] if len(others) % 2 else (others[middle - 1] + others[middle]) / 2
+        if better(self.best[-1], median) != self.best[-1]:
+            print('[ {}: best {} {:.4f} is worse than the median {:.4f} of {} trials after {} validations, '
+                  'stopping ]'.format(self.trial_id, self.metric, self.best[-1], median, len(others), step))
+            self.stopped = True
+        return self.stopped
+
+
+def _metric_value(metrics, metric):
+    # bagging returns the reports of all folds
+    if isinstance(metrics, list):
+        values = [m[metric] for m in metrics if m and metric in m]
+        return float(sum(values) / len(values)) if values else None
+    return float(metrics[metric]) if metrics and metric in metrics else None
+
+
+def _run_trial(trial_id, args, cpus, sweep_dir, metric, mode, rule, results):
+    """Train a model in a trial process and send its metric to the parent."""
+    try:
+        if cpus:
+            set_cpu_affinity(','.join(str(cpu) for cpu in cpus))
+        stopping = MedianStopping(sweep_dir, trial_id, metric, mode, **rule)
+        bu.validation_hooks.append(stopping)
+        metrics = bu.model(args)
+        results.put((trial_id, _metric_value(metrics, metric), stopping.stopped, None))
+    except BaseException as e:
+        results.put((trial_id, None, False, repr(e)))
+
+
+def read_results(path):
+    """Rows of the results table by trial."""
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return {row['trial']: row for row in csv.DictReader(f)}
+
+
+def write_results(path, rows, metric):
+    fields = ['trial', 'status', metric, 'validations', 'seconds', 'params', 'model_file']
+    ordered = sorted(rows.values(), key=lambda row: row['trial'])
+    with open(path + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(ordered)
+    os.replace(path + '.tmp', path)
+
+
+def _available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def sweep(config_file):
+    """Run the trials of a sweep config that are not finished yet.
+    Returns the rows of the results table, the best trial first.
+    """
+    with open(config_file) as f:
+        config = json.load(f)
+    sweep_dir = config.get('dir') or os.path.splitext(config_file)[0]
+    os.makedirs(os.path.join(sweep_dir, 'reports'), exist_ok=True)
+    metric = config['metric']
+    mode = config.get('mode', 'max')
+    rule = config.get('median_stopping', {})
+    table = os.path.join(sweep_dir, 'results.csv')
+
+    trials = sample_trials(config['space'], config.get('trials'), config.get('seed', 0))
+    trials = [('trial_{:03d}'.format(i), params) for i, params in enumerate(trials)]
+    rows = read_results(table)
+    pending = [(trial_id, params) for trial_id, params in trials
+               if not (trial_id in rows and rows[trial_id]['status'] in FINISHED and
+                       json.loads(rows[trial_id]['params']) == params)]
+    print('[ sweep: {} trials, {} to run ]'.format(len(trials), len(pending)))
+    if not pending:
+        return _ranked(rows, metric, mode)
+
+    # trials share one dictionary, built before they start
+    opt = bu.arg_parse(list(config['args']))
+    bu.__build_bag_of_words(opt)
+
+    workers = config.get('workers', 1)
+    cpus = _available_cpus()
+    cpus_per_trial = config.get('cpus_per_trial') or max(1, len(cpus) // workers)
+    slots = [[cpus[(slot * cpus_per_trial + i) % len(cpus)] for i in range(cpus_per_trial)]
+             for slot in range(workers)]
+
+    # spawn gives every trial its own TF runtime
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                trial_id, params = pending.pop(0)
+                slot = [s for s in range(workers) if s not in [r['slot'] for r in running.values()]][0]
+                model_dir = os.path.join(sweep_dir, 'models', trial_id)
+                os.makedirs(model_dir, exist_ok=True)
+                args = list(config['args'])
+                for name, value in sorted(params.items()):
+                    args += [name, str(value)]
+                args += ['-mf', os.path.join(model_dir, 'model')]
+                if opt.get('dict_file'):
+                    args += ['--dict-file', opt['dict_file']]
+                if 'cpu_affinity' in opt:
+                    args += ['--cpu-affinity', ','.join(str(cpu) for cpu in slots[slot]),
+                             '--intra-op-threads', str(cpus_per_trial)]
+                print('[ {} is started with {} ]'.format(trial_id, params))
+                process = ctx.Process(target=_run_trial,
+                                      args=(trial_id, args, slots[slot], sweep_dir, metric, mode, rule, results))
+                # numeric libraries read their thread limits when the trial imports them
+                with bu.__thread_env(cpus_per_trial):
+                    process.start()
+                running[trial_id] = {'process': process, 'slot': slot, 'start': time.time()}
+                rows[trial_id] = {'trial': trial_id, 'status': 'running', metric: '', 'validations': 0,
+                                  'seconds': '', 'params': json.dumps(params),
+                                  'model_file': os.path.join(model_dir, 'model')}
+                write_results(table, rows, metric)
+            try:
+                trial_id, value, stopped, error = results.get(timeout=10)
+            except queue.Empty:
+                for trial_id, trial in list(running.items()):
+                    if not trial['process'].is_alive() and trial['process'].exitcode != 0:
+                        print('[ {} exited with code {} ]'.format(trial_id, trial['process'].exitcode))
+                        running.pop(trial_id)
+                        rows[trial_id]['status'] = 'failed'
+                        write_results(table, rows, metric)
+                continue
+            if trial_id not in running:
+                continue
+            trial = running.pop(trial_id)
+            trial['process'].join()
+            row = rows[trial_id]
+            row['status'] = 'failed' if error is not None else 'stopped' if stopped else 'done'
+            row[metric] = '' if value is None else value
+            row['validations'] = len(read_reports(_report_file(sweep_dir, trial_id)))
+            row['seconds'] = round(time.time() - trial['start'], 1)
+            if error is not None:
+                print('[ {} failed: {} ]'.format(trial_id, error))
+            else:
+                print('[ {} is {}, {}: {} ]'.format(trial_id, row['status'], metric, value))
+            write_results(table, rows, metric)
+    finally:
+        for trial in running.values():
+            trial['process'].terminate()
+            trial['process'].join()
+    ranked = _ranked(rows, metric, mode)
+    if ranked:
+        print('[ best trial: {}, {}: {} with {} ]'.format(ranked[0]['trial'], metric, ranked[0][metric],
+                                                       ranked[0]['params']))
+    return ranked
+
+
+def _ranked(rows, metric, mode='max'):
+    finished = [row for row in rows.values() if row['status'] in FINISHED and row[metric] != '']
+    return sorted(finished, key=lambda row: float(row[metric]), reverse=mode == 'max')
+
+
+if __name__ == '__main__':
+    sweep(sys.argv[1])
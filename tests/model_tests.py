@@ -1,5 +1,8 @@
+import json
+import os
 import unittest
 import build_utils as bu
+from deeppavlov.utils.benchmark import run_synthetic, embeddings_loading, run_isolated
 
 
 class KPIException(Exception):
@@ -145,6 +148,156 @@ class TestKPIs(unittest.TestCase):
                         'KPI for Coreference resolution is not satisfied. \
                         Got {}, expected more than {}'.format(metrics['f1'], expected_KPI))
 
+
+class TestPerformanceKPIs(unittest.TestCase):
+    """Class for tests of speed and memory KPIs of tiny models on synthetic data.
+
+    Thresholds are kept in tests/performance_baseline.json. They are relaxed by
+    the tolerance of the baseline file or the PERF_TOLERANCE variable (0.5 allows
+    half the throughput and 1.5 times the latency and memory), and
+    PERF_UPDATE_BASELINE=1 replaces them with the measured values. A skill
+    without a measured baseline fails until it is recorded this way on the
+    reference machine.
+    """
+
+    baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'performance_baseline.json')
+    batch_sizes = (1, 32)
+    repeats = 20
+
+    @classmethod
+    def setUpClass(cls):
+        with open(cls.baseline_file) as f:
+            cls.baseline = json.load(f)
+        cls.tolerance = float(os.getenv('PERF_TOLERANCE', default=cls.baseline['tolerance']))
+        cls.update = os.getenv('PERF_UPDATE_BASELINE') == '1'
+
+    def expected(self, name):
+        if not self.update and name not in self.baseline['skills']:
+            self.fail('No measured baseline for {}, record it on the reference machine '
+                      'with PERF_UPDATE_BASELINE=1.'.format(name))
+        return self.baseline['skills'].get(name)
+
+    def benchmark(self, skill, args):
+        self.expected(skill)
+        results = run_isolated(run_synthetic, skill, bu.arg_parse(args),
+                               batch_sizes=self.batch_sizes, repeats=self.repeats)
+        if self.update:
+            self.update_baseline(skill, {
+                'max_peak_rss_mb': results['peak_rss_mb'],
+                'batch_act': {bs: {'min_exs_per_sec': stats['batch_act']['exs_per_sec'],
+                                   'max_p95_ms': stats['batch_act']['p95_ms']}
+                              for bs, stats in results['batch_sizes'].items()}})
+            return
+        expected = self.expected(skill)
+        self.assertLessEqual(results['peak_rss_mb'], expected['max_peak_rss_mb'] * (1 + self.tolerance),
+                             'Peak memory KPI for {} is not satisfied.'.format(skill))
+        for bs, kpi in expected['batch_act'].items():
+            stats = results['batch_sizes'][bs]['batch_act']
+            self.assertGreaterEqual(stats['exs_per_sec'], kpi['min_exs_per_sec'] * (1 - self.tolerance),
+                                    'Throughput KPI for {} with batch size {} is not satisfied.'.format(skill, bs))
+            self.assertLessEqual(stats['p95_ms'], kpi['max_p95_ms'] * (1 + self.tolerance),
+                                 'Latency KPI for {} with batch size {} is not satisfied.'.format(skill, bs))
+
+    def update_baseline(self, name, kpis):
+        with open(self.baseline_file) as f:
+            baseline = json.load(f)
+        baseline['skills'][name] = kpis
+        with open(self.baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def test_paraphraser(self):
+        self.benchmark('paraphraser', ['-m', 'deeppavlov.agents.paraphraser.paraphraser:ParaphraserAgent',
+                                       '--model_file', './build/benchmarks/paraphraser/paraphraser',
+                                       '--fasttext_model', './build/benchmarks/paraphraser/random_fasttext.bin',
+                                       '--max_sequence_length', '28',
+                                       '--embedding_dim', '16',
+                                       '--hidden_dim', '16',
+                                       '--attention_dim', '8',
+                                       '--perspective_num', '4',
+                                       '--aggregation_dim', '16',
+                                       '--dense_dim', '8'
+                                       ])
+
+    def test_insults(self):
+        self.benchmark('insults', ['-m', 'deeppavlov.agents.insults.insults_agents:InsultsAgent',
+                                   '--model_file', './build/benchmarks/insults/cnn_word',
+                                   '--model_name', 'cnn_word',
+                                   '--fasttext_model', './build/benchmarks/insults/random_fasttext.bin',
+                                   '--max_sequence_length', '100',
+                                   '--embedding_dim', '16',
+                                   '--filters_cnn', '16',
+                                   '--kernel_sizes_cnn', '1 2 3',
+                                   '--dense_dim', '16'
+                                   ])
+
+    def test_ner(self):
+        self.benchmark('ner', ['-m', 'deeppavlov.agents.ner.ner:NERAgent',
+                               '-mf', './build/benchmarks/ner/ner',
+                               '--dict-file', './build/benchmarks/ner/ner.dict'
+                               ])
+
+    def test_squad(self):
+        self.benchmark('squad', ['-m', 'deeppavlov.agents.squad.squad:SquadAgent',
+                                 '--model-file', './build/benchmarks/squad/squad',
+                                 '--dict-file', './build/benchmarks/squad/squad.dict',
+                                 '--embedding_file', './build/benchmarks/squad/random_vectors.txt',
+                                 '--type', 'fastqa_default',
+                                 '--word_embedding_dim', '16',
+                                 '--context_embedding_dim', '19',
+                                 '--question_embedding_dim', '16',
+                                 '--aligned_question_dim', '16',
+                                 '--context_enc_layers', '1',
+                                 '--question_enc_layers', '1',
+                                 '--encoder_hidden_dim', '16',
+                                 '--projection_dim', '16',
+                                 '--pointer_dim', '16'
+                                 ])
+
+    def test_coreference(self):
+        mf = './build/benchmarks/coreference/'
+        if not os.path.isfile(mf + 'coref_kernels.so'):
+            self.skipTest('coref_kernels.so is not compiled, run `pyb benchmark_coreference` first')
+        self.benchmark('coreference', ['-t', 'deeppavlov.tasks.coreference.agents',
+                                       '-m', 'deeppavlov.agents.coreference.agents:CoreferenceAgent',
+                                       '-mf', mf,
+                                       '--language', 'russian',
+                                       '--embedding_size', '16',
+                                       '--char_embedding_size', '8',
+                                       '--filter_size', '8',
+                                       '--lstm_size', '16',
+                                       '--ffnn_size', '16',
+                                       '--feature_size', '8',
+                                       '--max_antecedents', '50'
+                                       ])
+
+    def test_coreference_scorer_model(self):
+        self.benchmark('coreference_scorer_model', [
+            '-m', 'deeppavlov.agents.coreference_scorer_model.agents:CoreferenceAgent',
+            '--model-file', './build/benchmarks/coreference_scorer_model',
+            '--dense_hidden_size', '16'
+            ])
+
+    def test_embeddings_loading(self):
+        self.expected('embeddings')
+        opt = bu.arg_parse(['-m', 'deeppavlov.agents.insults.insults_agents:InsultsAgent',
+                            '--model_name', 'cnn_word',
+                            '--embedding_dim', '100',
+                            '--fasttext_model', './build/benchmarks/embeddings/random_fasttext.bin',
+                            '--fasttext_embeddings_dict', './build/benchmarks/embeddings/emb_dict.emb'
+                            ])
+        results = run_isolated(embeddings_loading, opt)
+        if self.update:
+            self.update_baseline('embeddings', {'min_words_per_sec': results['words_per_sec'],
+                                                'max_peak_rss_mb': results['peak_rss_mb']})
+            return
+        expected = self.expected('embeddings')
+        self.assertGreaterEqual(results['words_per_sec'], expected['min_words_per_sec'] * (1 - self.tolerance),
+                                'Throughput KPI for embeddings loading is not satisfied.')
+        self.assertLessEqual(results['peak_rss_mb'], expected['max_peak_rss_mb'] * (1 + self.tolerance),
+                             'Peak memory KPI for embeddings loading is not satisfied.')
+
+
 if __name__ == '__main__':
     unittest.main()
 